@@ -1,26 +1,137 @@
 import sys
 import os
+import json
 
-# Add the current directory to the Python path
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# Make maestro_core and the maestro scripts importable from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
 
-from flask import Flask, render_template, request, redirect, url_for
-import maestro_anyapi
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, stream_with_context
+from maestro_core.api import Maestro
+from maestro_core.events import END_EVENT, EventBus, emit
+from maestro_core.jobs import DEFAULT_CONCURRENCY, JobQueue
+
+# Which maestro script runs the jobs, how many run at once, and where jobs and their output are kept
+VARIANT = os.environ.get("MAESTRO_VARIANT", os.path.join(ROOT, "maestro-anyapi.py"))
+WORKERS = int(os.environ.get("MAESTRO_WORKERS", DEFAULT_CONCURRENCY))
+JOBS_DB = os.environ.get("MAESTRO_JOBS_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "maestro_jobs.db"))
+JOBS_DIR = os.environ.get("MAESTRO_JOBS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs"))
+# Seconds between comments that keep an idle event stream open through proxies
+KEEPALIVE_INTERVAL = 15
+
+# Loaded once: every job reuses the script's clients, caches and connection pools
+maestro = Maestro(VARIANT)
+# Live progress of the running jobs, one channel per job id
+events = EventBus()
+
+
+async def run_job(job):
+    # Each job has its own output directory, so a job interrupted by a restart resumes from its checkpoint
+    output_dir = os.path.join(JOBS_DIR, job["id"])
+    with events.publishing(job["id"]):
+        emit("status", status="running")
+        try:
+            result = await maestro.arun(job["objective"], search=job["params"].get("use_search", False), output_dir=output_dir, resume=True)
+        except Exception as e:
+            emit("status", status="error", error=f"{type(e).__name__}: {e}")
+            raise
+        emit("status", status="done", project_dir=result.project_dir)
+    return {"refined_output": result.refined_output, "project_dir": result.project_dir, "log_file": result.log_file}
+
+
+jobs = JobQueue(JOBS_DB, run_job, concurrency=WORKERS)
+jobs.start()
 
 app = Flask(__name__)
 
+
+def job_status(job):
+    status = {key: job[key] for key in ("id", "objective", "status", "created", "started", "finished")}
+    if job["status"] == "queued":
+        status["position"] = jobs.position(job["id"])
+    if job["status"] == "error":
+        status["error"] = job["error"].splitlines()[0]
+    status["status_url"] = url_for("get_job", job_id=job["id"])
+    status["result_url"] = url_for("get_result", job_id=job["id"])
+    status["events_url"] = url_for("get_events", job_id=job["id"])
+    return status
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         objective = request.form.get('objective')
         if objective:
-            results = maestro_anyapi.run_maestro(objective)
-            return render_template('results.html', objective=objective, results=results)
-    return render_template('index.html')
+            job_id = jobs.submit(objective, use_search=request.form.get('search') == 'on')
+            return redirect(url_for('index', job=job_id))
+    return render_template('index.html', job_id=request.args.get('job'), recent=jobs.recent())
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json(silent=True) or request.form
+    objective = data.get('objective')
+    if not objective:
+        return jsonify(error="'objective' is required"), 400
+    job_id = jobs.submit(objective, use_search=bool(data.get('search', False)))
+    return jsonify(job_status(jobs.get(job_id))), 202, {"Location": url_for("get_job", job_id=job_id)}
+
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job_status(job))
+
+
+@app.route('/jobs/<job_id>/result')
+def get_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    if job["status"] == "error":
+        return jsonify(id=job_id, status="error", error=job["error"]), 500
+    if job["status"] != "done":
+        # Not finished yet: poll the status URL
+        return jsonify(job_status(job)), 202
+    return jsonify(id=job_id, status="done", **job["result"])
+
+
+@app.route('/jobs/<job_id>/events')
+def get_events(job_id):
+    """Server-sent events of a job: orchestrator and sub-agent results, streamed tokens and written files."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    # Jobs finished before this process started, or by another process, have no events here
+    finished = job["status"] in ("done", "error")
+    # A reconnecting EventSource sends the id of the last event it got
+    try:
+        last_id = int(request.headers.get("Last-Event-ID") or request.args.get("after") or 0)
+    except ValueError:
+        return jsonify(error="Last-Event-ID and after must be event ids"), 400
+
+    def stream():
+        with events.subscribe(job_id, last_id) as subscription:
+            while True:
+                record = subscription.get(timeout=0 if finished else KEEPALIVE_INTERVAL)
+                if record is None:
+                    job = jobs.get(job_id)
+                    if finished or job is None or job["status"] in ("done", "error"):
+                        yield f"event: {END_EVENT}\ndata: {{}}\n\n"
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                data = {key: value for key, value in record.items() if key not in ("id", "event")}
+                yield f"id: {record['id']}\nevent: {record['event']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                if record["event"] == END_EVENT:
+                    return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers=headers)
 
-@app.route('/results')
-def results():
-    return "This page will display the results."
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # The reloader would start a second set of workers
+    app.run(debug=True, use_reloader=False)
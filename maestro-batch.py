@@ -0,0 +1,60 @@
+import asyncio
+import argparse
+import os
+from rich.console import Console
+from maestro_core.batch import DEFAULT_WORKERS, RESULTS_FILE, completed_job_ids, load_variant, read_objectives, run_batch
+
+console = Console()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run many objectives through a maestro script without prompting")
+    parser.add_argument('objectives', help='JSONL file with one {"objective": ..., "file": ..., "search": ...} per line')
+    parser.add_argument('--variant', default='maestro.py', help='maestro script to run each objective with (default: maestro.py)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='number of objectives processed concurrently')
+    parser.add_argument('--output-dir', default='batch_output', help='each objective gets its own directory under this one')
+    parser.add_argument('--resume', action='store_true', help='skip objectives that already finished successfully in --output-dir and continue interrupted ones from their checkpoint')
+    parser.add_argument('--quiet', action='store_true', help="hide the variant's per-call output, only show progress")
+    args = parser.parse_args()
+
+    jobs = read_objectives(args.objectives)
+    if args.resume:
+        done = completed_job_ids(args.output_dir)
+        jobs = [job for job in jobs if job["id"] not in done]
+
+    module = load_variant(args.variant)
+    if args.quiet:
+        module.console.quiet = True
+
+    total = len(jobs)
+    finished = 0
+
+    def on_result(record):
+        nonlocal finished
+        finished += 1
+        style = "green" if record["status"] == "ok" else "red"
+        detail = record.get("log_file") or record.get("error")
+        console.print(f"[{finished}/{total}] [{style}]{record['status']}[/{style}] {record['id']} ({record['seconds']}s): {detail}")
+
+    console.print(f"Running {total} objectives with {args.variant} on {args.workers} workers")
+    try:
+        records = await run_batch(
+            module, jobs, args.output_dir, args.workers,
+            base_dir=os.path.dirname(os.path.abspath(args.objectives)),
+            on_result=on_result,
+            resume=args.resume,
+        )
+    finally:
+        if getattr(module, "response_cache", None):
+            console.print(module.response_cache.report())
+        scheduler = getattr(getattr(module, "client", None), "scheduler", None)
+        if scheduler is not None:
+            console.print(scheduler.report())
+        await module.aclose_providers()
+
+    failed = sum(1 for record in records if record["status"] != "ok")
+    console.print(f"Done: {len(records) - failed} succeeded, {failed} failed. Results in {os.path.join(args.output_dir, RESULTS_FILE)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
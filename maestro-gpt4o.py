@@ -1,16 +1,31 @@
 import os
+import asyncio
 import re
 from rich.console import Console
 from rich.panel import Panel
 from datetime import datetime
 import json
-from openai import OpenAI
-from anthropic import Anthropic
-from tavily import TavilyClient
-
-# Initialize OpenAI and Anthropic API clients
-openai_client = OpenAI(api_key="YOUR API KEY")
-anthropic_client = Anthropic(api_key="YOUR API KEY")
+from maestro_core import OpenAIProvider, AnthropicProvider, aclose_providers
+from maestro_core.compaction import ContextCompactor, provider_summarizer
+from maestro_core.budget import token_budget
+from maestro_core.streaming import stream_to_console, task_complete_detector
+from maestro_core.continuation import stream_with_continuation
+from maestro_core.cache import ResponseCache
+from maestro_core.journal import JOURNAL_SUFFIX, RunJournal, render_report
+from maestro_core.checkpoint import Checkpoint
+from maestro_core.materialize import ProjectWriter, project_path
+from maestro_core.refined_output import RefinedOutputParser
+from maestro_core.large_input import digest_large_input, preview
+from maestro_core.ingest import attach, split_path_specs
+from maestro_core.retrieval import ORCHESTRATOR_CONTEXT_TOKENS, index_attachment, with_file_context
+from maestro_core.search import SEARCH_QUERIES_INSTRUCTIONS, SearchCache, TavilySearch, parse_search_queries
+
+# Opt-in on-disk response cache: set MAESTRO_CACHE_DIR to replay identical calls between runs
+response_cache = ResponseCache.from_env()
+
+# Initialize OpenAI and Anthropic API providers (each keeps a pooled HTTP connection)
+openai_client = OpenAIProvider(api_key="YOUR API KEY", cache=response_cache)
+anthropic_client = AnthropicProvider(api_key="YOUR API KEY", cache=response_cache)
 
 # Available OpenAI models
 ORCHESTRATOR_MODEL = "gpt-4o"
@@ -19,6 +34,13 @@ SUB_AGENT_MODEL = "gpt-4o"
 # Available Claude models for Anthropic API
 REFINER_MODEL = "claude-3-opus-20240229"
 
+# Token budget for the task history each role sees; older exchanges are replaced by cached summaries
+CONTEXT_BUDGETS = {"orchestrator": 8000, "sub_agent": 6000}
+compactor = ContextCompactor(provider_summarizer(openai_client, SUB_AGENT_MODEL), CONTEXT_BUDGETS)
+
+# One Tavily client per process; answers are cached on disk for a day
+search = TavilySearch(api_key="YOUR_API_KEY", cache=SearchCache())
+
 # Initialize the Rich Console
 console = Console()
 
@@ -37,11 +59,14 @@ def calculate_subagent_cost(model, input_tokens, output_tokens):
 
     return total_cost
 
-def gpt_orchestrator(objective, file_content=None, previous_results=None, use_search=False):
+async def gpt_orchestrator(objective, file_content=None, previous_results=None, use_search=False):
     console.print(f"\n[bold]Calling Orchestrator for your objective[/bold]")
+    # Drop the oldest results that don't fit the orchestrator's context window
+    budget = token_budget(ORCHESTRATOR_MODEL)
+    previous_results = budget.fit(previous_results, reserved=objective + (file_content or ""))
     previous_results_text = "\n".join(previous_results) if previous_results else "None"
     if file_content:
-        console.print(Panel(f"File content:\n{file_content}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
+        console.print(Panel(f"File content:\n{preview(file_content)}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
     
     messages = [
         {"role": "system", "content": "You are a helpful assistant."},
@@ -49,19 +74,19 @@ def gpt_orchestrator(objective, file_content=None, previous_results=None, use_se
     ]
 
     if use_search:
-        messages.append({"role": "user", "content": "Please also generate a JSON object containing a single 'search_query' key, which represents a question that, when asked online, would yield important information for solving the subtask. The question should be specific and targeted to elicit the most relevant and helpful resources. Format your JSON like this, with no additional text before or after:\n{\"search_query\": \"<question>\"}\n"})
+        messages.append({"role": "user", "content": SEARCH_QUERIES_INSTRUCTIONS})
 
-    gpt_response = openai_client.chat.completions.create(
-        model=ORCHESTRATOR_MODEL,
-        messages=messages,
-        max_tokens=4096
-    )
+    max_tokens = budget.max_tokens(messages, cap=4096)
+    gpt_response = await stream_to_console(openai_client.stream(
+        ORCHESTRATOR_MODEL,
+        messages,
+        max_tokens=max_tokens
+    ), console, "Orchestrator", "green", stop_when=task_complete_detector())
 
-    response_text = gpt_response.choices[0].message.content
-    usage = gpt_response.usage
+    response_text = gpt_response.text
 
     console.print(Panel(response_text, title=f"[bold green]gpt Orchestrator[/bold green]", title_align="left", border_style="green", subtitle="Sending task to gpt 👇"))
-    console.print(f"Input Tokens: {usage.prompt_tokens}, Output Tokens: {usage.completion_tokens}, Total Tokens: {usage.total_tokens}")
+    console.print(f"Input Tokens: {gpt_response.input_tokens}, Output Tokens: {gpt_response.output_tokens}, Total Tokens: {gpt_response.input_tokens + gpt_response.output_tokens}")
 
     search_query = None
     if use_search:
@@ -69,10 +94,10 @@ def gpt_orchestrator(objective, file_content=None, previous_results=None, use_se
         if json_match:
             json_string = json_match.group()
             try:
-                search_query = json.loads(json_string)["search_query"]
-                console.print(Panel(f"Search Query: {search_query}", title="[bold blue]Search Query[/bold blue]", title_align="left", border_style="blue"))
+                search_query = parse_search_queries(json.loads(json_string))
+                console.print(Panel("Search Queries:\n" + "\n".join(search_query), title="[bold blue]Search Queries[/bold blue]", title_align="left", border_style="blue"))
                 response_text = response_text.replace(json_string, "").strip()
-            except json.JSONDecodeError as e:
+            except (json.JSONDecodeError, TypeError) as e:
                 console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
                 console.print(Panel(f"Skipping search query extraction.", title="[bold yellow]Search Query Extraction Skipped[/bold yellow]", title_align="left", border_style="yellow"))
         else:
@@ -80,19 +105,20 @@ def gpt_orchestrator(objective, file_content=None, previous_results=None, use_se
 
     return response_text, file_content, search_query
 
-def gpt_sub_agent(prompt, search_query=None, previous_gpt_tasks=None, use_search=False, continuation=False):
+async def gpt_sub_agent(prompt, search_query=None, previous_gpt_tasks=None, use_search=False):
     if previous_gpt_tasks is None:
         previous_gpt_tasks = []
 
-    continuation_prompt = "Continuing from the previous answer, please complete the response."
+    # Drop the oldest tasks that don't fit the sub-agent's context window
+    budget = token_budget(SUB_AGENT_MODEL)
+    previous_gpt_tasks = budget.fit(previous_gpt_tasks, reserved=prompt)
+
     system_message = "Previous gpt tasks:\n" + "\n".join(f"Task: {task['task']}\nResult: {task['result']}" for task in previous_gpt_tasks)
-    if continuation:
-        prompt = continuation_prompt
 
     qna_response = None
     if search_query and use_search:
-        tavily = TavilyClient(api_key="YOUR_API_KEY")
-        qna_response = tavily.qna_search(query=search_query)
+        # Run every query concurrently and keep the most relevant passages that fit the budget
+        qna_response = await search.search_context(search_query, prompt, count_tokens=budget.count)
         console.print(f"QnA response: {qna_response}", style="yellow")
 
     messages = [
@@ -103,27 +129,21 @@ def gpt_sub_agent(prompt, search_query=None, previous_gpt_tasks=None, use_search
     if qna_response:
         messages.append({"role": "user", "content": f"\nSearch Results:\n{qna_response}"})
 
-    gpt_response = openai_client.chat.completions.create(
-        model=SUB_AGENT_MODEL,
-        messages=messages,
-        max_tokens=4096
-    )
+    max_tokens = budget.max_tokens(messages, cap=4096)
+    gpt_response = await stream_with_continuation(openai_client, SUB_AGENT_MODEL, messages, console, "Sub-agent", "blue", max_tokens=max_tokens, budget=budget)
 
-    response_text = gpt_response.choices[0].message.content
-    usage = gpt_response.usage
+    response_text = gpt_response.text
 
     console.print(Panel(response_text, title="[bold blue]gpt Sub-agent Result[/bold blue]", title_align="left", border_style="blue", subtitle="Task completed, sending result to gpt 👇"))
-    console.print(f"Input Tokens: {usage.prompt_tokens}, Output Tokens: {usage.completion_tokens}, Total Tokens: {usage.total_tokens}")
-
-    if usage.completion_tokens >= 4000:  # Threshold set to 4000 as a precaution
-        console.print("[bold yellow]Warning:[/bold yellow] Output may be truncated. Attempting to continue the response.")
-        continuation_response_text = gpt_sub_agent(prompt, search_query, previous_gpt_tasks, use_search, continuation=True)
-        response_text += continuation_response_text
+    console.print(f"Input Tokens: {gpt_response.input_tokens}, Output Tokens: {gpt_response.output_tokens}, Total Tokens: {gpt_response.input_tokens + gpt_response.output_tokens}")
 
     return response_text
 
-def anthropic_refine(objective, sub_task_results, filename, projectname, continuation=False):
+async def anthropic_refine(objective, sub_task_results, filename, projectname, on_text=None):
     console.print("\nCalling Opus to provide the refined final output for your objective:")
+    # Drop the oldest results that don't fit the refiner's context window
+    budget = token_budget(REFINER_MODEL)
+    sub_task_results = budget.fit(sub_task_results, reserved=objective)
     messages = [
         {
             "role": "user",
@@ -133,144 +153,181 @@ def anthropic_refine(objective, sub_task_results, filename, projectname, continu
         }
     ]
 
-    opus_response = anthropic_client.messages.create(
-        model=REFINER_MODEL,
-        max_tokens=4096,
-        messages=messages
-    )
+    max_tokens = budget.max_tokens(messages, cap=4096)
+    opus_response = await stream_with_continuation(anthropic_client, REFINER_MODEL, messages, console, "Refiner", "green", max_tokens=max_tokens, budget=budget, on_text=on_text)
 
-    response_text = opus_response.content[0].text.strip()
-    console.print(f"Input Tokens: {opus_response.usage.input_tokens}, Output Tokens: {opus_response.usage.output_tokens}")
-    total_cost = calculate_subagent_cost(REFINER_MODEL, opus_response.usage.input_tokens, opus_response.usage.output_tokens)
+    response_text = opus_response.text.strip()
+    console.print(f"Input Tokens: {opus_response.input_tokens}, Output Tokens: {opus_response.output_tokens}")
+    total_cost = calculate_subagent_cost(REFINER_MODEL, opus_response.input_tokens, opus_response.output_tokens)
     console.print(f"Refine Cost: ${total_cost:.4f}")
 
-    if opus_response.usage.output_tokens >= 4000 and not continuation:  # Threshold set to 4000 as a precaution
-        console.print("[bold yellow]Warning:[/bold yellow] Output may be truncated. Attempting to continue the response.")
-        continuation_response_text = anthropic_refine(objective, sub_task_results + [response_text], filename, projectname, continuation=True)
-        response_text += "\n" + continuation_response_text
-
     console.print(Panel(response_text, title="[bold green]Final Output[/bold green]", title_align="left", border_style="green"))
     return response_text
 
-def create_folder_structure(project_name, folder_structure, code_blocks):
-    try:
-        os.makedirs(project_name, exist_ok=True)
-        console.print(Panel(f"Created project folder: [bold]{project_name}[/bold]", title="[bold green]Project Folder[/bold green]", title_align="left", border_style="green"))
-    except OSError as e:
-        console.print(Panel(f"Error creating project folder: [bold]{project_name}[/bold]\nError: {e}", title="[bold red]Project Folder Creation Error[/bold red]", title_align="left", border_style="red"))
-        return
-
-    create_folders_and_files(project_name, folder_structure, code_blocks)
-
-def create_folders_and_files(current_path, structure, code_blocks):
-    for key, value in structure.items():
-        path = os.path.join(current_path, key)
-        if isinstance(value, dict):
-            try:
-                os.makedirs(path, exist_ok=True)
-                console.print(Panel(f"Created folder: [bold]{path}[/bold]", title="[bold blue]Folder Creation[/bold blue]", title_align="left", border_style="blue"))
-                create_folders_and_files(path, value, code_blocks)
-            except OSError as e:
-                console.print(Panel(f"Error creating folder: [bold]{path}[/bold]\nError: {e}", title="[bold red]Folder Creation Error[/bold red]", title_align="left", border_style="red"))
+def create_folder_structure(project_name, project_writer):
+    # Write the files that are still waiting and report the whole project in a single panel
+    result = project_writer.finish(project_name)
+    style = "red" if result.errors else "yellow" if result.missing else "green"
+    console.print(Panel(result.summary(), title=f"[bold {style}]Project Files[/bold {style}]", title_align="left", border_style=style))
+    return result
+
+async def run(objective, file_content=None, use_search=False, input_file=None, output_dir=".", resume=False):
+    """Run one objective end to end without prompting.
+
+    The generated project and the exchange log are written under `output_dir`.
+    With `resume`, a run interrupted in `output_dir` picks up after its last
+    completed step instead of starting over. `input_file` is an attached file
+    too large to pass as `file_content`; it is read in chunks and reduced to
+    notes first.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Every completed step is checkpointed, so an interrupted run can pick up where it stopped
+    checkpoint = Checkpoint(output_dir)
+    state = checkpoint.begin(objective, resume, file_content=file_content, use_search=use_search, input_file=input_file, timestamp=datetime.now().strftime("%H-%M-%S"))
+    # Name the log files up front so every event can be journaled as it happens
+    sanitized_objective = re.sub(r'\W+', '_', objective)
+    timestamp = state["settings"]["timestamp"]
+    max_length = 25
+    truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+    filename = os.path.join(output_dir, f"{timestamp}_{truncated_objective}.md")
+    journal = RunJournal(os.path.splitext(filename)[0] + JOURNAL_SUFFIX)
+    if checkpoint.resumed:
+        console.print(Panel(f"Resuming after {len(state['exchanges'])} completed sub-tasks", title="[bold blue]Resuming from checkpoint[/bold blue]", title_align="left", border_style="blue"))
+    else:
+        journal.write("objective", objective=objective)
+    # Restore the history exactly as the orchestrator and the sub-agents saw it
+    task_exchanges = [(exchange["task"], exchange["result"]) for exchange in state["exchanges"]]
+    gpt_tasks = [dict(exchange) for exchange in state["exchanges"]]
+    compactor.import_summaries(state["summaries"])
+    # Index the attached file so every sub-agent gets the passages relevant to its own task
+    file_index = index_attachment(file_content, input_file)
+    if input_file is not None:
+        # The attached file is too big for one prompt: take notes on its chunks in parallel and merge them
+        file_content = state.get("input_digest")
+        if file_content is None:
+            file_content = await digest_large_input(input_file, openai_client, SUB_AGENT_MODEL, objective, console, done=state.get("chunks"), on_mapped=lambda chunk, notes: checkpoint.record("chunk", index=chunk.index, result=notes))
+            checkpoint.record("input_digest", digest=file_content)
+            journal.write("input_digest", path=input_file, digest=file_content)
+    elif file_content:
+        # The orchestrator gets the passages relevant to the objective rather than the whole file
+        file_content = file_index.context(objective, ORCHESTRATOR_CONTEXT_TOKENS)
+
+    while True:
+        pending = state["pending"]
+        if pending is not None:
+            # Resume with the step the orchestrator had already handed out
+            gpt_result, search_query = pending["output"], pending["search_query"]
         else:
-            code_content = next((code for file, code in code_blocks if file == key), None)
-            if code_content:
-                try:
-                    with open(path, 'w') as file:
-                        file.write(code_content)
-                    console.print(Panel(f"Created file: [bold]{path}[/bold]", title="[bold green]File Creation[/bold green]", title_align="left", border_style="green"))
-                except IOError as e:
-                    console.print(Panel(f"Error creating file: [bold]{path}[/bold]\nError: {e}", title="[bold red]File Creation Error[/bold red]", title_align="left", border_style="red"))
+            previous_results = [exchange["result"] for exchange in await compactor.compact(gpt_tasks, "orchestrator")]
+            if not task_exchanges:
+                gpt_result, _, search_query = await gpt_orchestrator(objective, file_content, previous_results, use_search)
             else:
-                console.print(Panel(f"Code content not found for file: [bold]{key}[/bold]", title="[bold yellow]Missing Code Content[/bold yellow]", title_align="left", border_style="yellow"))
+                gpt_result, _, search_query = await gpt_orchestrator(objective, previous_results=previous_results, use_search=use_search)
+
 
-def read_file(file_path):
-    with open(file_path, 'r') as file:
-        content = file.read()
-    return content
+            checkpoint.record("orchestrator", output=gpt_result, search_query=search_query)
+            journal.write("orchestrator", output=gpt_result, search_query=search_query)
 
-# Get the objective from user input
-objective = input("Please enter your objective: ")
 
-# Ask the user if they want to provide a file path
-provide_file = input("Do you want to provide a file path? (y/n): ").lower() == 'y'
 
-if provide_file:
-    file_path = input("Please enter the file path: ")
-    if os.path.exists(file_path):
-        file_content = read_file(file_path)
+        if "The task is complete:" in gpt_result:
+            final_output = gpt_result.replace("The task is complete:", "").strip()
+            break
+        else:
+            sub_task_prompt = gpt_result
+            # Every sub-agent gets the passages of the attached file most relevant to its own task
+            agent_prompt = with_file_context(sub_task_prompt, file_index)
+            sub_task_result = await gpt_sub_agent(agent_prompt, search_query, await compactor.compact(gpt_tasks, "sub_agent"), use_search)
+            gpt_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
+            task_exchanges.append((sub_task_prompt, sub_task_result))
+            checkpoint.record("exchange", task=sub_task_prompt, result=sub_task_result)
+            checkpoint.save_summaries(compactor)
+            journal.write("sub_agent", task=sub_task_prompt, result=sub_task_result)
+
+    # Parse the refiner output while it streams, writing each code file as soon as its block closes
+    project_writer = ProjectWriter()
+    parser = RefinedOutputParser(
+        on_project_name=lambda name: project_writer.set_project_dir(project_path(output_dir, name)),
+        on_folder_structure=project_writer.set_structure,
+        on_file=project_writer.add_file,
+    )
+    refined_output = state["refined_output"]
+    if refined_output is None:
+        refined_output = await anthropic_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective, on_text=parser.feed)
+        checkpoint.record("refined", output=refined_output)
+        journal.write("refiner", output=refined_output)
     else:
-        print(f"File not found: {file_path}")
-        file_content = None
-else:
-    file_content = None
+        # Resumed after the refiner had already finished
+        parser.feed(refined_output)
+    parser.close()
 
-# Ask the user if they want to use search
-use_search = input("Do you want to use search? (y/n): ").lower() == 'y'
+    project_name = parser.project_name or sanitized_objective
+    if parser.folder_structure_error:
+        e, json_string = parser.folder_structure_error
+        console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
+        console.print(Panel(f"Invalid JSON string: [bold]{json_string}[/bold]", title="[bold red]Invalid JSON String[/bold red]", title_align="left", border_style="red"))
 
-task_exchanges = []
-gpt_tasks = []
+    # Write the files that were still waiting and report on the whole project
+    project_dir = project_path(output_dir, project_name)
+    create_folder_structure(project_dir, project_writer)
 
-while True:
-    previous_results = [result for _, result in task_exchanges]
-    if not task_exchanges:
-        gpt_result, file_content_for_gpt, search_query = gpt_orchestrator(objective, file_content, previous_results, use_search)
-    else:
-        gpt_result, _, search_query = gpt_orchestrator(objective, previous_results=previous_results, use_search=use_search)
+    console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
 
-    
+    render_report(journal.path, filename)
+    print(f"\nFull exchange log saved to {filename}")
+    # The run is complete, nothing is left to resume
+    checkpoint.clear()
 
-    if "The task is complete:" in gpt_result:
-        final_output = gpt_result.replace("The task is complete:", "").strip()
-        break
-    else:
-        sub_task_prompt = gpt_result
-        if file_content_for_gpt and not gpt_tasks:
-            sub_task_prompt = f"{sub_task_prompt}\n\nFile content:\n{file_content_for_gpt}"
-        sub_task_result = gpt_sub_agent(sub_task_prompt, search_query, gpt_tasks, use_search)
-        gpt_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
-        task_exchanges.append((sub_task_prompt, sub_task_result))
-        file_content_for_gpt = None
-
-sanitized_objective = re.sub(r'\W+', '_', objective)
-timestamp = datetime.now().strftime("%H-%M-%S")
-refined_output = anthropic_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective)
-
-project_name_match = re.search(r'Project Name: (.*)', refined_output)
-project_name = project_name_match.group(1).strip() if project_name_match else sanitized_objective
-
-folder_structure_match = re.search(r'<folder_structure>(.*?)</folder_structure>', refined_output, re.DOTALL)
-folder_structure = {}
-if folder_structure_match:
-    json_string = folder_structure_match.group(1).strip()
-    try:
-        folder_structure = json.loads(json_string)
-    except json.JSONDecodeError as e:
-        console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
-        console.print(Panel(f"Invalid JSON string: [bold]{json_string}[/bold]", title="[bold red]Invalid JSON String[/bold red]", title_align="left", border_style="red"))
+    return {
+        "objective": objective,
+        "refined_output": refined_output,
+        "project_dir": project_dir,
+        "log_file": filename,
+        "journal": journal.path,
+        "task_exchanges": task_exchanges,
+    }
 
-# Ensure proper extraction of filenames and code contents
-code_blocks = re.findall(r'Filename: (\S+)\s*```[\w]*\n(.*?)\n```', refined_output, re.DOTALL)
-create_folder_structure(project_name, folder_structure, code_blocks)
 
-max_length = 25
-truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+async def main():
+    # Offer to pick up a run that was interrupted in this directory
+    saved_run = Checkpoint().load()
+    resume = saved_run is not None and input("Do you want to continue from the last task? (y/n): ").lower() == 'y'
+    if resume:
+        objective = saved_run["objective"]
+        file_content = saved_run["settings"]["file_content"]
+        input_file = saved_run["settings"].get("input_file")
+        use_search = saved_run["settings"]["use_search"]
+        console.print(Panel(f"Resuming from last task: {objective}", title="[bold blue]Resuming from last task[/bold blue]", title_align="left", border_style="blue"))
+    else:
+        # Get the objective from user input
+        objective = input("Please enter your objective: ")
 
-filename = f"{timestamp}_{truncated_objective}.md"
+        # Ask the user if they want to provide a file path
+        provide_file = input("Do you want to provide a file path? (y/n): ").lower() == 'y'
 
-exchange_log = f"Objective: {objective}\n\n"
-exchange_log += "=" * 40 + " Task Breakdown " + "=" * 40 + "\n\n"
-for i, (prompt, result) in enumerate(task_exchanges, start=1):
-    exchange_log += f"Task {i}:\n"
-    exchange_log += f"Prompt: {prompt}\n"
-    exchange_log += f"Result: {result}\n\n"
+        file_content = None
+        input_file = None
+        if provide_file:
+            file_path = input("Please enter files, directories or globs to attach: ")
+            try:
+                # A single file too big for a prompt is read in chunks by run(); anything else is read here
+                attachment = attach(split_path_specs(file_path), SUB_AGENT_MODEL)
+                file_content, input_file = attachment.file_content, attachment.input_file
+                console.print(Panel(attachment.summary(), title="[bold blue]Attached Files[/bold blue]", title_align="left", border_style="blue"))
+            except FileNotFoundError as e:
+                print(e)
+
+        # Ask the user if they want to use search
+        use_search = input("Do you want to use search? (y/n): ").lower() == 'y'
 
-exchange_log += "=" * 40 + " Refined Final Output " + "=" * 40 + "\n\n"
-exchange_log += refined_output
+    await run(objective, file_content, use_search, input_file=input_file, resume=resume)
 
-console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
+    if use_search:
+        console.print(search.report())
+    if response_cache:
+        console.print(response_cache.report())
+    await aclose_providers()
 
-with open(filename, 'w') as file:
-    file.write(exchange_log)
-print(f"\nFull exchange log saved to {filename}")
 
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,29 +1,50 @@
 import os
+import asyncio
 import re
 from rich.console import Console
 from rich.panel import Panel
 from datetime import datetime
-import json
 
-# Set up the Groq API client
-from groq import Groq
-import os
-
-client = Groq(api_key="YOUR API KEY")
+# Set up the Groq API provider (pooled keep-alive connection shared by all stages)
+from maestro_core import GroqProvider, aclose_providers
+from maestro_core.compaction import ContextCompactor, provider_summarizer
+from maestro_core.budget import token_budget
+from maestro_core.streaming import stream_to_console, task_complete_detector
+from maestro_core.continuation import stream_with_continuation
+from maestro_core.cache import ResponseCache
+from maestro_core.journal import JOURNAL_SUFFIX, RunJournal, render_report
+from maestro_core.checkpoint import Checkpoint
+from maestro_core.materialize import ProjectWriter, project_path
+from maestro_core.refined_output import RefinedOutputParser
+from maestro_core.large_input import digest_large_input, preview
+from maestro_core.ingest import attach, extract_paths
+from maestro_core.retrieval import ORCHESTRATOR_CONTEXT_TOKENS, index_attachment, with_file_context
+
+# Opt-in on-disk response cache: set MAESTRO_CACHE_DIR to replay identical calls between runs
+response_cache = ResponseCache.from_env()
+
+client = GroqProvider(api_key="YOUR API KEY", cache=response_cache)
 
 # Define the models to use for each agent
 ORCHESTRATOR_MODEL = "mixtral-8x7b-32768"
 SUB_AGENT_MODEL = "mixtral-8x7b-32768"
 REFINER_MODEL = "llama3-70b-8192"
 
+# Token budget for the task history each role sees; older exchanges are replaced by cached summaries
+CONTEXT_BUDGETS = {"orchestrator": 8000, "sub_agent": 6000}
+compactor = ContextCompactor(provider_summarizer(client, SUB_AGENT_MODEL), CONTEXT_BUDGETS)
+
 # Initialize the Rich Console
 console = Console()
 
-def opus_orchestrator(objective, file_content=None, previous_results=None):
+async def opus_orchestrator(objective, file_content=None, previous_results=None):
     console.print(f"\n[bold]Calling Orchestrator for your objective[/bold]")
+    # Drop the oldest results that don't fit the orchestrator's context window
+    budget = token_budget(ORCHESTRATOR_MODEL)
+    previous_results = budget.fit(previous_results, reserved=objective + (file_content or ""))
     previous_results_text = "\n".join(previous_results) if previous_results else "None"
     if file_content:
-        console.print(Panel(f"File content:\n{file_content}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
+        console.print(Panel(f"File content:\n{preview(file_content)}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
     messages = [
         {
             "role": "system",
@@ -35,24 +56,26 @@ def opus_orchestrator(objective, file_content=None, previous_results=None):
         }
     ]
 
-    opus_response = client.chat.completions.create(
-        model=ORCHESTRATOR_MODEL,
-        messages=messages,
-        max_tokens=8000
-    )
+    max_tokens = budget.max_tokens(messages, cap=8000)
+    opus_response = await stream_to_console(client.stream(
+        ORCHESTRATOR_MODEL,
+        messages,
+        max_tokens=max_tokens
+    ), console, "Orchestrator", "green", stop_when=task_complete_detector())
 
-    response_text = opus_response.choices[0].message.content
+    response_text = opus_response.text
     console.print(Panel(response_text, title=f"[bold green]Groq Orchestrator[/bold green]", title_align="left", border_style="green", subtitle="Sending task to Subagent 👇"))
     return response_text, file_content
 
-def haiku_sub_agent(prompt, previous_haiku_tasks=None, continuation=False):
+async def haiku_sub_agent(prompt, previous_haiku_tasks=None):
     if previous_haiku_tasks is None:
         previous_haiku_tasks = []
 
-    continuation_prompt = "Continuing from the previous answer, please complete the response."
+    # Drop the oldest tasks that don't fit the sub-agent's context window
+    budget = token_budget(SUB_AGENT_MODEL)
+    previous_haiku_tasks = budget.fit(previous_haiku_tasks, reserved=prompt)
+
     system_message = "Previous Haiku tasks:\n" + "\n".join(f"Task: {task['task']}\nResult: {task['result']}" for task in previous_haiku_tasks)
-    if continuation:
-        prompt = continuation_prompt
 
     messages = [
         {
@@ -65,18 +88,18 @@ def haiku_sub_agent(prompt, previous_haiku_tasks=None, continuation=False):
         }
     ]
 
-    haiku_response = client.chat.completions.create(
-        model=SUB_AGENT_MODEL,
-        messages=messages,
-        max_tokens=8000
-    )
+    max_tokens = budget.max_tokens(messages, cap=8000)
+    haiku_response = await stream_with_continuation(client, SUB_AGENT_MODEL, messages, console, "Sub-agent", "blue", max_tokens=max_tokens, budget=budget)
 
-    response_text = haiku_response.choices[0].message.content
+    response_text = haiku_response.text
     console.print(Panel(response_text, title="[bold blue]Groq Sub-agent Result[/bold blue]", title_align="left", border_style="blue", subtitle="Task completed, sending result to Orchestrator 👇"))
     return response_text
 
-def opus_refine(objective, sub_task_results, filename, projectname, continuation=False):
+async def opus_refine(objective, sub_task_results, filename, projectname, on_text=None):
     console.print("\nCalling Opus to provide the refined final output for your objective:")
+    # Drop the oldest results that don't fit the refiner's context window
+    budget = token_budget(REFINER_MODEL)
+    sub_task_results = budget.fit(sub_task_results, reserved=objective)
     messages = [
         {
             "role": "system",
@@ -88,148 +111,169 @@ def opus_refine(objective, sub_task_results, filename, projectname, continuation
         }
     ]
 
-    opus_response = client.chat.completions.create(
-        model=REFINER_MODEL,
-        messages=messages,
-        max_tokens=8000
-    )
+    max_tokens = budget.max_tokens(messages, cap=8000)
+    opus_response = await stream_with_continuation(client, REFINER_MODEL, messages, console, "Refiner", "green", max_tokens=max_tokens, budget=budget, on_text=on_text)
 
-    response_text = opus_response.choices[0].message.content
+    response_text = opus_response.text
     console.print(Panel(response_text, title="[bold green]Final Output[/bold green]", title_align="left", border_style="green"))
     return response_text
 
-def create_folder_structure(project_name, folder_structure, code_blocks):
-    # Create the project folder
-    try:
-        os.makedirs(project_name, exist_ok=True)
-        console.print(Panel(f"Created project folder: [bold]{project_name}[/bold]", title="[bold green]Project Folder[/bold green]", title_align="left", border_style="green"))
-    except OSError as e:
-        console.print(Panel(f"Error creating project folder: [bold]{project_name}[/bold]\nError: {e}", title="[bold red]Project Folder Creation Error[/bold red]", title_align="left", border_style="red"))
-        return
-
-    # Recursively create the folder structure and files
-    create_folders_and_files(project_name, folder_structure, code_blocks)
-
-def create_folders_and_files(current_path, structure, code_blocks):
-    for key, value in structure.items():
-        path = os.path.join(current_path, key)
-        if isinstance(value, dict):
-            try:
-                os.makedirs(path, exist_ok=True)
-                console.print(Panel(f"Created folder: [bold]{path}[/bold]", title="[bold blue]Folder Creation[/bold blue]", title_align="left", border_style="blue"))
-                create_folders_and_files(path, value, code_blocks)
-            except OSError as e:
-                console.print(Panel(f"Error creating folder: [bold]{path}[/bold]\nError: {e}", title="[bold red]Folder Creation Error[/bold red]", title_align="left", border_style="red"))
+def create_folder_structure(project_name, project_writer):
+    # Write the files that are still waiting and report the whole project in a single panel
+    result = project_writer.finish(project_name)
+    style = "red" if result.errors else "yellow" if result.missing else "green"
+    console.print(Panel(result.summary(), title=f"[bold {style}]Project Files[/bold {style}]", title_align="left", border_style=style))
+    return result
+
+async def run(objective, file_content=None, input_file=None, output_dir=".", resume=False):
+    """Run one objective end to end without prompting.
+
+    The generated project and the exchange log are written under `output_dir`.
+    With `resume`, a run interrupted in `output_dir` picks up after its last
+    completed step instead of starting over. `input_file` is an attached file
+    too large to pass as `file_content`; it is read in chunks and reduced to
+    notes first.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Every completed step is checkpointed, so an interrupted run can pick up where it stopped
+    checkpoint = Checkpoint(output_dir)
+    state = checkpoint.begin(objective, resume, file_content=file_content, input_file=input_file, timestamp=datetime.now().strftime("%H-%M-%S"))
+    # Name the log files up front so every event can be journaled as it happens
+    sanitized_objective = re.sub(r'\W+', '_', objective)
+    timestamp = state["settings"]["timestamp"]
+    max_length = 25
+    truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+    filename = os.path.join(output_dir, f"{timestamp}_{truncated_objective}.md")
+    journal = RunJournal(os.path.splitext(filename)[0] + JOURNAL_SUFFIX)
+    if checkpoint.resumed:
+        console.print(Panel(f"Resuming after {len(state['exchanges'])} completed sub-tasks", title="[bold blue]Resuming from checkpoint[/bold blue]", title_align="left", border_style="blue"))
+    else:
+        journal.write("objective", objective=objective)
+    # Restore the history exactly as the orchestrator and the sub-agents saw it
+    task_exchanges = [(exchange["task"], exchange["result"]) for exchange in state["exchanges"]]
+    haiku_tasks = [dict(exchange) for exchange in state["exchanges"]]
+    compactor.import_summaries(state["summaries"])
+    # Index the attached file so every sub-agent gets the passages relevant to its own task
+    file_index = index_attachment(file_content, input_file)
+    if input_file is not None:
+        # The attached file is too big for one prompt: take notes on its chunks in parallel and merge them
+        file_content = state.get("input_digest")
+        if file_content is None:
+            file_content = await digest_large_input(input_file, client, SUB_AGENT_MODEL, objective, console, done=state.get("chunks"), on_mapped=lambda chunk, notes: checkpoint.record("chunk", index=chunk.index, result=notes))
+            checkpoint.record("input_digest", digest=file_content)
+            journal.write("input_digest", path=input_file, digest=file_content)
+    elif file_content:
+        # The orchestrator gets the passages relevant to the objective rather than the whole file
+        file_content = file_index.context(objective, ORCHESTRATOR_CONTEXT_TOKENS)
+
+    while True:
+        pending = state["pending"]
+        if pending is not None:
+            # Resume with the step the orchestrator had already handed out
+            opus_result = pending["output"]
         else:
-            code_content = next((code for file, code in code_blocks if file == key), None)
-            if code_content:
-                try:
-                    with open(path, 'w') as file:
-                        file.write(code_content)
-                    console.print(Panel(f"Created file: [bold]{path}[/bold]", title="[bold green]File Creation[/bold green]", title_align="left", border_style="green"))
-                except IOError as e:
-                    console.print(Panel(f"Error creating file: [bold]{path}[/bold]\nError: {e}", title="[bold red]File Creation Error[/bold red]", title_align="left", border_style="red"))
+            # Call Orchestrator to break down the objective into the next sub-task or provide the final output
+            previous_results = [exchange["result"] for exchange in await compactor.compact(haiku_tasks, "orchestrator")]
+            if not task_exchanges:
+                # Pass the file content only in the first iteration if available
+                opus_result, _ = await opus_orchestrator(objective, file_content, previous_results)
             else:
-                console.print(Panel(f"Code content not found for file: [bold]{key}[/bold]", title="[bold yellow]Missing Code Content[/bold yellow]", title_align="left", border_style="yellow"))
-
-def read_file(file_path):
-    with open(file_path, 'r') as file:
-        content = file.read()
-    return content
-
-# Get the objective from user input
-objective = input("Please enter your objective with or without a text file path: ")
-
-# Check if the input contains a file path
-if "./" in objective or "/" in objective:
-    # Extract the file path from the objective
-    file_path = re.findall(r'[./\w]+\.[\w]+', objective)[0]
-    # Read the file content
-    with open(file_path, 'r') as file:
-        file_content = file.read()
-    # Update the objective string to remove the file path
-    objective = objective.split(file_path)[0].strip()
-else:
-    file_content = None
-
-task_exchanges = []
-haiku_tasks = []
-
-while True:
-    # Call Orchestrator to break down the objective into the next sub-task or provide the final output
-    previous_results = [result for _, result in task_exchanges]
-    if not task_exchanges:
-        # Pass the file content only in the first iteration if available
-        opus_result, file_content_for_haiku = opus_orchestrator(objective, file_content, previous_results)
+                opus_result, _ = await opus_orchestrator(objective, previous_results=previous_results)
+            checkpoint.record("orchestrator", output=opus_result)
+            journal.write("orchestrator", output=opus_result)
+
+        if "The task is complete:" in opus_result:
+            # If Opus indicates the task is complete, exit the loop
+            final_output = opus_result.replace("The task is complete:", "").strip()
+            break
+        else:
+            sub_task_prompt = opus_result
+            # Every sub-agent gets the passages of the attached file most relevant to its own task
+            agent_prompt = with_file_context(sub_task_prompt, file_index)
+            # Call haiku_sub_agent with the prepared prompt and record the result
+            sub_task_result = await haiku_sub_agent(agent_prompt, await compactor.compact(haiku_tasks, "sub_agent"))
+            # Log the task and its result for future reference
+            haiku_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
+            # Record the exchange for processing and output generation
+            task_exchanges.append((sub_task_prompt, sub_task_result))
+            checkpoint.record("exchange", task=sub_task_prompt, result=sub_task_result)
+            checkpoint.save_summaries(compactor)
+            journal.write("sub_agent", task=sub_task_prompt, result=sub_task_result)
+
+    # Parse the refiner output while it streams, writing each code file as soon as its block closes
+    project_writer = ProjectWriter()
+    parser = RefinedOutputParser(
+        on_project_name=lambda name: project_writer.set_project_dir(project_path(output_dir, name)),
+        on_folder_structure=project_writer.set_structure,
+        on_file=project_writer.add_file,
+    )
+    # Call Opus to review and refine the sub-task results
+    refined_output = state["refined_output"]
+    if refined_output is None:
+        refined_output = await opus_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective, on_text=parser.feed)
+        checkpoint.record("refined", output=refined_output)
+        journal.write("refiner", output=refined_output)
     else:
-        opus_result, _ = opus_orchestrator(objective, previous_results=previous_results)
+        # Resumed after the refiner had already finished
+        parser.feed(refined_output)
+    parser.close()
 
-    if "The task is complete:" in opus_result:
-        # If Opus indicates the task is complete, exit the loop
-        final_output = opus_result.replace("The task is complete:", "").strip()
-        break
-    else:
-        sub_task_prompt = opus_result
-        # Append file content to the prompt for the initial call to haiku_sub_agent, if applicable
-        if file_content_for_haiku and not haiku_tasks:
-            sub_task_prompt = f"{sub_task_prompt}\n\nFile content:\n{file_content_for_haiku}"
-        # Call haiku_sub_agent with the prepared prompt and record the result
-        sub_task_result = haiku_sub_agent(sub_task_prompt, haiku_tasks)
-        # Log the task and its result for future reference
-        haiku_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
-        # Record the exchange for processing and output generation
-        task_exchanges.append((sub_task_prompt, sub_task_result))
-        # Prevent file content from being included in future haiku_sub_agent calls
-        file_content_for_haiku = None
-
-# Create the .md filename
-sanitized_objective = re.sub(r'\W+', '_', objective)
-timestamp = datetime.now().strftime("%H-%M-%S")
-
-# Call Opus to review and refine the sub-task results
-refined_output = opus_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective)
-
-# Extract the project name from the refined output
-project_name_match = re.search(r'Project Name: (.*)', refined_output)
-project_name = project_name_match.group(1).strip() if project_name_match else sanitized_objective
-
-# Extract the folder structure from the refined output
-folder_structure_match = re.search(r'<folder_structure>(.*?)</folder_structure>', refined_output, re.DOTALL)
-folder_structure = {}
-if folder_structure_match:
-    json_string = folder_structure_match.group(1).strip()
-    try:
-        folder_structure = json.loads(json_string)
-    except json.JSONDecodeError as e:
+    project_name = parser.project_name or sanitized_objective
+    if parser.folder_structure_error:
+        e, json_string = parser.folder_structure_error
         console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
         console.print(Panel(f"Invalid JSON string: [bold]{json_string}[/bold]", title="[bold red]Invalid JSON String[/bold red]", title_align="left", border_style="red"))
 
-# Extract code files from the refined output
-code_blocks = re.findall(r'Filename: (\S+)\s*```[\w]*\n(.*?)\n```', refined_output, re.DOTALL)
-
-# Create the folder structure and code files
-create_folder_structure(project_name, folder_structure, code_blocks)
-
-# Truncate the sanitized_objective to a maximum of 50 characters
-max_length = 25
-truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+    # Write the files that were still waiting and report on the whole project
+    project_dir = project_path(output_dir, project_name)
+    create_folder_structure(project_dir, project_writer)
+
+    console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
+
+    render_report(journal.path, filename)
+    print(f"\nFull exchange log saved to {filename}")
+    # The run is complete, nothing is left to resume
+    checkpoint.clear()
+
+    return {
+        "objective": objective,
+        "refined_output": refined_output,
+        "project_dir": project_dir,
+        "log_file": filename,
+        "journal": journal.path,
+        "task_exchanges": task_exchanges,
+    }
+
+
+async def main():
+    # Offer to pick up a run that was interrupted in this directory
+    saved_run = Checkpoint().load()
+    resume = saved_run is not None and input("Do you want to continue from the last task? (y/n): ").lower() == 'y'
+    if resume:
+        objective = saved_run["objective"]
+        file_content = saved_run["settings"]["file_content"]
+        input_file = saved_run["settings"].get("input_file")
+        console.print(Panel(f"Resuming from last task: {objective}", title="[bold blue]Resuming from last task[/bold blue]", title_align="left", border_style="blue"))
+    else:
+        # Get the objective from user input
+        objective = input("Please enter your objective, with @ before any file, directory or glob to attach: ")
 
-# Update the filename to include the project name
-filename = f"{timestamp}_{truncated_objective}.md"
+        # Attach the files, directories and globs marked with @ in the objective
+        objective, specs = extract_paths(objective)
+        file_content = None
+        input_file = None
+        if specs:
+            # A single file too big for a prompt is read in chunks by run(); anything else is read here
+            attachment = attach(specs, SUB_AGENT_MODEL)
+            file_content, input_file = attachment.file_content, attachment.input_file
+            console.print(Panel(attachment.summary(), title="[bold blue]Attached Files[/bold blue]", title_align="left", border_style="blue"))
 
-# Prepare the full exchange log
-exchange_log = f"Objective: {objective}\n\n"
-exchange_log += "=" * 40 + " Task Breakdown " + "=" * 40 + "\n\n"
-for i, (prompt, result) in enumerate(task_exchanges, start=1):
-    exchange_log += f"Task {i}:\n"
-    exchange_log += f"Prompt: {prompt}\n"
-    exchange_log += f"Result: {result}\n\n"
+    await run(objective, file_content, input_file=input_file, resume=resume)
 
-exchange_log += "=" * 40 + " Refined Final Output " + "=" * 40 + "\n\n"
-exchange_log += refined_output
+    if response_cache:
+        console.print(response_cache.report())
+    await aclose_providers()
 
-console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
 
-with open(filename, 'w') as file:
-    file.write(exchange_log)
-print(f"\nFull exchange log saved to {filename}")
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
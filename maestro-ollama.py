@@ -1,66 +1,83 @@
 import os
+import asyncio
 import re
 from datetime import datetime
-import json
 from rich.console import Console
 from rich.panel import Panel
-import ollama
-from ollama import Client  # Import the Ollama client
 import argparse
-
-# Only for the first time run based on the model you want to use
-# ollama.pull('llama3:70b')
-# ollama.pull('llama3:8b')
-# ollama.pull('llama3:8b')
-# ollama.pull('llama3:70b-instruct')
-# ollama.pull('llama3:instruct')
+from maestro_core import OllamaProvider, aclose_providers
+from maestro_core.affinity import ModelAffinityScheduler
+from maestro_core.availability import ModelCheckCache, ModelChecker
+from maestro_core.residency import ModelResidency
+from maestro_core.compaction import ContextCompactor, provider_summarizer
+from maestro_core.budget import token_budget
+from maestro_core.streaming import stream_to_console, task_complete_detector
+from maestro_core.continuation import stream_with_continuation
+from maestro_core.cache import ResponseCache
+from maestro_core.journal import JOURNAL_SUFFIX, RunJournal, render_report
+from maestro_core.checkpoint import Checkpoint
+from maestro_core.materialize import ProjectWriter, project_path
+from maestro_core.refined_output import RefinedOutputParser
+from maestro_core.large_input import digest_large_input, preview
+from maestro_core.ingest import attach, extract_paths
+from maestro_core.retrieval import ORCHESTRATOR_CONTEXT_TOKENS, index_attachment, with_file_context
 
 # Define model identifiers as variables at the top of the script
 ORCHESTRATOR_MODEL = 'llama3:70b-instruct'
 SUBAGENT_MODEL = 'llama3:instruct'
 REFINER_MODEL = 'llama3:70b-instruct'
 
-# check and pull models if they don't exist yet
-for model in [ORCHESTRATOR_MODEL, SUBAGENT_MODEL, REFINER_MODEL]:
-    try:
-        print(f"Checking for model: {model}")
-        m = ollama.show(model)
-    except ollama._types.ResponseError as e:
-        print(f"Pulling model from ollama: {model}")
-        ollama.pull(model)
+# Opt-in on-disk response cache: set MAESTRO_CACHE_DIR to replay identical calls between runs
+response_cache = ResponseCache.from_env()
+
+# Initialize the Ollama provider (async client with a keep-alive connection pool).
+# Concurrent objectives (batch mode, web jobs) have their calls grouped by model, so the server swaps models less often
+client = OllamaProvider(host='http://localhost:11434', cache=response_cache, scheduler=ModelAffinityScheduler())
+
+# Token budget for the task history each role sees; older exchanges are replaced by cached summaries
+CONTEXT_BUDGETS = {"orchestrator": 3000, "sub_agent": 2500}
+compactor = ContextCompactor(provider_summarizer(client, SUBAGENT_MODEL), CONTEXT_BUDGETS)
 
-# Initialize the Ollama client
-client = Client(host='http://localhost:11434')
+# Models missing from the server are pulled before the first call. The three models are checked
+# concurrently when a run starts, and models found are remembered on disk for a day
+model_checker = ModelChecker(client, ModelCheckCache())
+
+# Keep the orchestrator and sub-agent models loaded side by side and load the next one while the
+# current one generates. Set MAESTRO_OLLAMA_MEMORY_GB on a small host so this only happens when both fit
+residency = ModelResidency.from_env(client)
 
 console = Console()
 
-def opus_orchestrator(objective, file_content=None, previous_results=None):
+async def opus_orchestrator(objective, file_content=None, previous_results=None):
     console.print(f"\n[bold]Calling Ollama Orchestrator for your objective[/bold]")
+    # Drop the oldest results that don't fit the orchestrator's context window
+    budget = token_budget(ORCHESTRATOR_MODEL)
+    previous_results = budget.fit(previous_results, reserved=objective + (file_content or ""))
     previous_results_text = "\n".join(previous_results) if previous_results else "None"
     if file_content:
-        console.print(Panel(f"File content:\n{file_content}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
-    
-    response = client.chat(
-        model=ORCHESTRATOR_MODEL,
-        messages=[
-            {
-                "role": "user",
-                "content": f"Based on the following objective{' and file content' if file_content else ''}, and the previous sub-task results (if any), please break down the objective into the next sub-task, and create a concise and detailed prompt for a subagent so it can execute that task. Focus solely on the objective and avoid engaging in casual conversation with the subagent.\n\nWhen dealing with code tasks, make sure to check the code for errors and provide fixes and support as part of the next sub-task. If you find any bugs or have suggestions for better code, please include them in the next sub-task prompt.\n\nPlease assess if the objective has been fully achieved. If the previous sub-task results comprehensively address all aspects of the objective, include the phrase 'The task is complete:' at the beginning of your response. If the objective is not yet fully achieved, break it down into the next sub-task and create a concise and detailed prompt for a subagent to execute that task.\n\nObjective: {objective}" + (f'\nFile content:\n{file_content}' if file_content else '') + f"\n\nPrevious sub-task results:\n{previous_results_text}"
-            }
-        ]
-    )
+        console.print(Panel(f"File content:\n{preview(file_content)}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
     
-    response_text = response['message']['content']
+    messages = [
+        {
+            "role": "user",
+            "content": f"Based on the following objective{' and file content' if file_content else ''}, and the previous sub-task results (if any), please break down the objective into the next sub-task, and create a concise and detailed prompt for a subagent so it can execute that task. Focus solely on the objective and avoid engaging in casual conversation with the subagent.\n\nWhen dealing with code tasks, make sure to check the code for errors and provide fixes and support as part of the next sub-task. If you find any bugs or have suggestions for better code, please include them in the next sub-task prompt.\n\nPlease assess if the objective has been fully achieved. If the previous sub-task results comprehensively address all aspects of the objective, include the phrase 'The task is complete:' at the beginning of your response. If the objective is not yet fully achieved, break it down into the next sub-task and create a concise and detailed prompt for a subagent to execute that task.\n\nObjective: {objective}" + (f'\nFile content:\n{file_content}' if file_content else '') + f"\n\nPrevious sub-task results:\n{previous_results_text}"
+        }
+    ]
+
+    max_tokens = budget.max_tokens(messages)
+    response = await stream_to_console(client.stream(ORCHESTRATOR_MODEL, messages, max_tokens=max_tokens), console, "Orchestrator", "green", stop_when=task_complete_detector())
+
+    response_text = response.text
     console.print(Panel(response_text, title="[bold green]Ollama Orchestrator[/bold green]", title_align="left", border_style="green", subtitle="Sending task to Ollama sub-agent 👇"))
     return response_text, file_content
 
-def haiku_sub_agent(prompt, previous_haiku_tasks=None, continuation=False):
+async def haiku_sub_agent(prompt, previous_haiku_tasks=None):
     if previous_haiku_tasks is None:
         previous_haiku_tasks = []
 
-    continuation_prompt = "Continuing from the previous answer, please complete the response."
-    if continuation:
-        prompt = continuation_prompt
+    # Drop the oldest tasks that don't fit the sub-agent's context window
+    budget = token_budget(SUBAGENT_MODEL)
+    previous_haiku_tasks = budget.fit(previous_haiku_tasks, reserved=prompt)
 
     # Compile previous tasks into a readable format
     previous_tasks_summary = "Previous Sub-agent tasks:\n" + "\n".join(f"Task: {task['task']}\nResult: {task['result']}" for task in previous_haiku_tasks)
@@ -72,214 +89,211 @@ def haiku_sub_agent(prompt, previous_haiku_tasks=None, continuation=False):
     if not full_prompt.strip():
         raise ValueError("Prompt cannot be empty")
 
-    response = client.chat(
-        model=SUBAGENT_MODEL, 
-        messages=[{"role": "user", "content": full_prompt}]
-    )
+    messages = [{"role": "user", "content": full_prompt}]
+    max_tokens = budget.max_tokens(messages)
+    response = await stream_with_continuation(client, SUBAGENT_MODEL, messages, console, "Sub-agent", "blue", max_tokens=max_tokens, budget=budget)
     
-    response_text = response['message']['content']
-    
-    if len(response_text) >= 4000:  # Threshold set to 4000 as a precaution
-        console.print("[bold yellow]Warning:[/bold yellow] Output may be truncated. Attempting to continue the response.")
-        continuation_response_text = haiku_sub_agent(continuation_prompt, previous_haiku_tasks, continuation=True)
-        response_text += continuation_response_text
+    response_text = response.text
 
     console.print(Panel(response_text, title="[bold blue]Ollama Sub-agent Result[/bold blue]", title_align="left", border_style="blue", subtitle="Task completed, sending result to Ollama Orchestrator 👇"))
     return response_text
 
-def opus_refine(objective, sub_task_results, filename, projectname, continuation=False):
+async def opus_refine(objective, sub_task_results, filename, projectname, on_text=None):
     console.print("\nCalling Ollama to provide the refined final output for your objective:")
+    # Drop the oldest results that don't fit the refiner's context window
+    budget = token_budget(REFINER_MODEL)
+    sub_task_results = budget.fit(sub_task_results, reserved=objective)
+
+    messages = [
+        {
+            "role": "user",
+            "content": "Objective: " + objective + "\n\nSub-task results:\n" + "\n".join(sub_task_results) + "\n\nPlease review and refine the sub-task results into a cohesive final output. Add any missing information or details as needed.\n\nWhen working on code projects, ONLY AND ONLY IF THE PROJECT IS CLEARLY A CODING ONE, please provide the following:\n\n1. Project Name: Create a concise and appropriate project name that fits the project based on what it's creating. The project name should be no more than 20 characters long.\n\n2. Folder Structure: Provide the folder structure as a valid JSON object, where each key represents a folder or file, and nested keys represent subfolders. Use null values for files. Ensure the JSON is properly formatted without any syntax errors. Please make sure all keys are enclosed in double quotes, and ensure objects are correctly encapsulated with braces, separating items with commas as necessary. Wrap the JSON object in <folder_structure> tags.\n\n3. Code Files: For each code file, include ONLY the file name, NEVER EVER USE THE FILE PATH OR ANY OTHER FORMATTING. YOU ONLY USE THE FOLLOWING format 'Filename: <filename>' followed by the code block enclosed in triple backticks, with the language identifier after the opening backticks, like this:\n\npython\n<code>\n\n\nFocus solely on the objective and avoid engaging in casual conversation. Ensure the final output is clear, concise, and addresses all aspects of the objective.​"
+        }
+    ]
+
+    max_tokens = budget.max_tokens(messages)
+    response = await stream_with_continuation(client, REFINER_MODEL, messages, console, "Refiner", "green", max_tokens=max_tokens, budget=budget, on_text=on_text)
     
-    response = client.chat(
-        model=REFINER_MODEL,
-        messages=[
-            {
-                "role": "user",
-                "content": "Objective: " + objective + "\n\nSub-task results:\n" + "\n".join(sub_task_results) + "\n\nPlease review and refine the sub-task results into a cohesive final output. Add any missing information or details as needed.\n\nWhen working on code projects, ONLY AND ONLY IF THE PROJECT IS CLEARLY A CODING ONE, please provide the following:\n\n1. Project Name: Create a concise and appropriate project name that fits the project based on what it's creating. The project name should be no more than 20 characters long.\n\n2. Folder Structure: Provide the folder structure as a valid JSON object, where each key represents a folder or file, and nested keys represent subfolders. Use null values for files. Ensure the JSON is properly formatted without any syntax errors. Please make sure all keys are enclosed in double quotes, and ensure objects are correctly encapsulated with braces, separating items with commas as necessary. Wrap the JSON object in <folder_structure> tags.\n\n3. Code Files: For each code file, include ONLY the file name, NEVER EVER USE THE FILE PATH OR ANY OTHER FORMATTING. YOU ONLY USE THE FOLLOWING format 'Filename: <filename>' followed by the code block enclosed in triple backticks, with the language identifier after the opening backticks, like this:\n\npython\n<code>\n\n\nFocus solely on the objective and avoid engaging in casual conversation. Ensure the final output is clear, concise, and addresses all aspects of the objective.​"
-            }
-        ]
-    )
-    
-    response_text = response['message']['content']
-    
-    if len(response_text) >= 4000:  # Threshold set to 4000 as a precaution
-        console.print("[bold yellow]Warning:[/bold yellow] Output may be truncated. Attempting to continue the response.")
-        continuation_response_text = opus_refine(objective, sub_task_results, filename, projectname, continuation=True)
-        response_text += continuation_response_text
+    response_text = response.text
 
     console.print(Panel(response_text, title="[bold green]Final Output[/bold green]", title_align="left", border_style="green"))
     return response_text
 
-def create_folder_structure(project_name, folder_structure, code_blocks):
-    try:
-        os.makedirs(project_name, exist_ok=True)
-        console.print(Panel(f"Created project folder: [bold]{project_name}[/bold]", title="[bold blue]Project Folder Creation[/bold blue]", title_align="left", border_style="blue"))
-    except OSError as e:
-        console.print(Panel(f"Error creating project folder: [bold]{project_name}[/bold]\nError: {e}", title="[bold red]Project Folder Creation Error[/bold red]", title_align="left", border_style="red"))
-
-    create_folders_and_files(project_name, folder_structure, code_blocks)
-
-def create_folders_and_files(current_path, structure, code_blocks):
-    for key, value in structure.items():
-        path = os.path.join(current_path, key)
-        if isinstance(value, dict):
-            try:
-                os.makedirs(path, exist_ok=True)
-                console.print(Panel(f"Created folder: [bold]{path}[/bold]", title="[bold blue]Folder Creation[/bold blue]", title_align="left", border_style="blue"))
-                create_folders_and_files(path, value, code_blocks)
-            except OSError as e:
-                console.print(Panel(f"Error creating folder: [bold]{path}[/bold]\nError: {e}", title="[bold red]Folder Creation Error[/bold red]", title_align="left", border_style="red"))
+def create_folder_structure(project_name, project_writer):
+    # Write the files that are still waiting and report the whole project in a single panel
+    result = project_writer.finish(project_name)
+    style = "red" if result.errors else "yellow" if result.missing else "green"
+    console.print(Panel(result.summary(), title=f"[bold {style}]Project Files[/bold {style}]", title_align="left", border_style=style))
+    return result
+
+async def run(objective, file_content=None, input_file=None, output_dir=".", resume=False):
+    """Run one objective end to end without prompting.
+
+    The generated project and the exchange log are written under `output_dir`.
+    With `resume`, a run interrupted in `output_dir` picks up after its last
+    completed step instead of starting over. `input_file` is an attached file
+    too large to pass as `file_content`; it is read in chunks and reduced to
+    notes first.
+    """
+    # Pull any model the server doesn't have yet (checked concurrently, skipped while remembered)
+    await model_checker.ensure([ORCHESTRATOR_MODEL, SUBAGENT_MODEL, REFINER_MODEL], console)
+    await residency.prepare([ORCHESTRATOR_MODEL, SUBAGENT_MODEL, REFINER_MODEL])
+    os.makedirs(output_dir, exist_ok=True)
+    # Every completed step is checkpointed, so an interrupted run can pick up where it stopped
+    checkpoint = Checkpoint(output_dir)
+    state = checkpoint.begin(objective, resume, file_content=file_content, input_file=input_file, timestamp=datetime.now().strftime("%H-%M-%S"))
+    # Name the log files up front so every event can be journaled as it happens
+    sanitized_objective = re.sub(r'\W+', '_', objective)
+    timestamp = state["settings"]["timestamp"]
+    max_length = 25
+    truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+    filename = os.path.join(output_dir, f"{timestamp}_{truncated_objective}.md")
+    journal = RunJournal(os.path.splitext(filename)[0] + JOURNAL_SUFFIX)
+    if checkpoint.resumed:
+        console.print(Panel(f"Resuming after {len(state['exchanges'])} completed sub-tasks", title="[bold blue]Resuming from checkpoint[/bold blue]", title_align="left", border_style="blue"))
+    else:
+        journal.write("objective", objective=objective)
+    # Restore the history exactly as the orchestrator and the sub-agents saw it
+    task_exchanges = [(exchange["task"], exchange["result"]) for exchange in state["exchanges"]]
+    haiku_tasks = [dict(exchange) for exchange in state["exchanges"]]
+    compactor.import_summaries(state["summaries"])
+    # Index the attached file so every sub-agent gets the passages relevant to its own task
+    file_index = index_attachment(file_content, input_file)
+    if input_file is not None:
+        # The attached file is too big for one prompt: take notes on its chunks in parallel and merge them
+        file_content = state.get("input_digest")
+        if file_content is None:
+            file_content = await digest_large_input(input_file, client, SUBAGENT_MODEL, objective, console, done=state.get("chunks"), on_mapped=lambda chunk, notes: checkpoint.record("chunk", index=chunk.index, result=notes))
+            checkpoint.record("input_digest", digest=file_content)
+            journal.write("input_digest", path=input_file, digest=file_content)
+    elif file_content:
+        # The orchestrator gets the passages relevant to the objective rather than the whole file
+        file_content = file_index.context(objective, ORCHESTRATOR_CONTEXT_TOKENS)
+
+    while True:
+        pending = state["pending"]
+        if pending is not None:
+            # Resume with the step the orchestrator had already handed out
+            opus_result = pending["output"]
         else:
-            code_content = next((code for file, code in code_blocks if file == key), None)
-            if code_content:
-                try:
-                    with open(path, 'w') as file:
-                        file.write(code_content)
-                    console.print(Panel(f"Created file: [bold]{path}[/bold]", title="[bold green]File Creation[/bold green]", title_align="left", border_style="green"))
-                except IOError as e:
-                    console.print(Panel(f"Error creating file: [bold]{path}[/bold]\nError: {e}", title="[bold red]File Creation Error[/bold red]", title_align="left", border_style="red"))
+            # Call Orchestrator to break down the objective into the next sub-task or provide the final output
+            previous_results = [exchange["result"] for exchange in await compactor.compact(haiku_tasks, "orchestrator")]
+            # The sub-agent model loads while the orchestrator generates
+            residency.expect(SUBAGENT_MODEL)
+            if not task_exchanges:
+                # Pass the file content only in the first iteration if available
+                opus_result, _ = await opus_orchestrator(objective, file_content, previous_results)
             else:
-                console.print(Panel(f"Code content not found for file: [bold]{key}[/bold]", title="[bold yellow]Missing Code Content[/bold yellow]", title_align="left", border_style="yellow"))
-
-def read_file(file_path):
-    with open(file_path, 'r') as file:
-        content = file.read()
-    return content
-   
-def has_task_data():
-    return os.path.exists('task_data.json')
-
-def read_task_data():
-    with open('task_data.json', 'r') as file:
-        task_data = json.load(file)
-    return task_data
-
-
-def write_task_data(task_data):
-    with open('task_data.json', 'w') as file:
-        json.dump(task_data, file)
-
-
-continue_from_last_task = False
-tmp_task_data = {}
-
-# parse args
-parser = argparse.ArgumentParser()
-parser.add_argument('-p', '--prompt', type=str, help='Please enter your objective with or without a text file path')
-args = parser.parse_args()
-
-if args.prompt is not None:
-    objective = args.prompt
-else:
-    # Check if there is a task data file
-    if has_task_data():
-        continue_from_last_task = input("Do you want to continue from the last task? (y/n): ").lower() == 'y'
-
-    if continue_from_last_task:
-        tmp_task_data = read_task_data()
-        objective = tmp_task_data['objective']
-        task_exchanges = tmp_task_data['task_exchanges']
-        console.print(Panel(f"Resuming from last task: {objective}", title="[bold blue]Resuming from last task[/bold blue]", title_align="left", border_style="blue"))
-    else:
-        # Get the objective from user input
-        objective = input("Please enter your objective with or without a text file path: ")
-        tmp_task_data['objective'] = objective
-        tmp_task_data['task_exchanges'] = []
-
-# Check if the input contains a file path
-if "./" in objective or "/" in objective:
-    # Extract the file path from the objective
-    file_path = re.findall(r'[./\w]+\.[\w]+', objective)[0]
-    # Read the file content
-    with open(file_path, 'r') as file:
-        file_content = file.read()
-    # Update the objective string to remove the file path
-    objective = objective.split(file_path)[0].strip()
-else:
-    file_content = None
-
-task_exchanges = []
-haiku_tasks = []
-
-while True:
-    # Call Orchestrator to break down the objective into the next sub-task or provide the final output
-    previous_results = [result for _, result in task_exchanges]
-    if not task_exchanges:
-        # Pass the file content only in the first iteration if available
-        opus_result, file_content_for_haiku = opus_orchestrator(objective, file_content, previous_results)
+                opus_result, _ = await opus_orchestrator(objective, previous_results=previous_results)
+            checkpoint.record("orchestrator", output=opus_result)
+            journal.write("orchestrator", output=opus_result)
+
+        if "The task is complete:" in opus_result:
+            # If Opus indicates the task is complete, exit the loop
+            final_output = opus_result.replace("The task is complete:", "").strip()
+            break
+        else:
+            sub_task_prompt = opus_result
+            # Every sub-agent gets the passages of the attached file most relevant to its own task
+            agent_prompt = with_file_context(sub_task_prompt, file_index)
+            residency.expect(ORCHESTRATOR_MODEL)
+            # Call haiku_sub_agent with the prepared prompt and record the result
+            sub_task_result = await haiku_sub_agent(agent_prompt, await compactor.compact(haiku_tasks, "sub_agent"))
+            # Log the task and its result for future reference
+            haiku_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
+            # Record the exchange for processing and output generation
+            task_exchanges.append((sub_task_prompt, sub_task_result))
+            checkpoint.record("exchange", task=sub_task_prompt, result=sub_task_result)
+            checkpoint.save_summaries(compactor)
+            journal.write("sub_agent", task=sub_task_prompt, result=sub_task_result)
+
+    # Parse the refiner output while it streams, writing each code file as soon as its block closes
+    project_writer = ProjectWriter()
+    parser = RefinedOutputParser(
+        on_project_name=lambda name: project_writer.set_project_dir(project_path(output_dir, name)),
+        on_folder_structure=project_writer.set_structure,
+        on_file=project_writer.add_file,
+    )
+    # Call Opus to review and refine the sub-task results
+    refined_output = state["refined_output"]
+    if refined_output is None:
+        residency.expect(REFINER_MODEL)
+        refined_output = await opus_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective, on_text=parser.feed)
+        checkpoint.record("refined", output=refined_output)
+        journal.write("refiner", output=refined_output)
     else:
-        opus_result, _ = opus_orchestrator(objective, previous_results=previous_results)
+        # Resumed after the refiner had already finished
+        parser.feed(refined_output)
+    parser.close()
 
-    if "The task is complete:" in opus_result:
-        # If Opus indicates the task is complete, exit the loop
-        final_output = opus_result.replace("The task is complete:", "").strip()
-        break
-    else:
-        sub_task_prompt = opus_result
-        # Append file content to the prompt for the initial call to haiku_sub_agent, if applicable
-        if file_content_for_haiku and not haiku_tasks:
-            sub_task_prompt = f"{sub_task_prompt}\n\nFile content:\n{file_content_for_haiku}"
-        # Call haiku_sub_agent with the prepared prompt and record the result
-        sub_task_result = haiku_sub_agent(sub_task_prompt, haiku_tasks)
-        # Log the task and its result for future reference
-        haiku_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
-        # Record the exchange for processing and output generation
-        task_exchanges.append((sub_task_prompt, sub_task_result))
-        # Update the task data with the new task exchanges
-        tmp_task_data['task_exchanges'] = task_exchanges
-        # Save the task data to a JSON file for resuming later
-        write_task_data(tmp_task_data)
-        # Prevent file content from being included in future haiku_sub_agent calls
-        file_content_for_haiku = None
-
-# Create the .md filename
-sanitized_objective = re.sub(r'\W+', '_', objective)
-timestamp = datetime.now().strftime("%H-%M-%S")
-
-# Call Opus to review and refine the sub-task results
-refined_output = opus_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective)
-
-# Extract the project name from the refined output
-project_name_match = re.search(r'Project Name: (.*)', refined_output)
-project_name = project_name_match.group(1).strip() if project_name_match else sanitized_objective
-
-# Extract the folder structure from the refined output
-folder_structure_match = re.search(r'<folder_structure>(.*?)</folder_structure>', refined_output, re.DOTALL)
-folder_structure = {}
-if folder_structure_match:
-    json_string = folder_structure_match.group(1).strip()
-    try:
-        folder_structure = json.loads(json_string)
-    except json.JSONDecodeError as e:
+    project_name = parser.project_name or sanitized_objective
+    if parser.folder_structure_error:
+        e, json_string = parser.folder_structure_error
         console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
         console.print(Panel(f"Invalid JSON string: [bold]{json_string}[/bold]", title="[bold red]Invalid JSON String[/bold red]", title_align="left", border_style="red"))
 
-# Extract code files from the refined output
-code_blocks = re.findall(r'Filename: (\S+)\s*```[\w]*\n(.*?)\n```', refined_output, re.DOTALL)
-
-# Create the folder structure and code files
-create_folder_structure(project_name, folder_structure, code_blocks)
+    # Write the files that were still waiting and report on the whole project
+    project_dir = project_path(output_dir, project_name)
+    create_folder_structure(project_dir, project_writer)
 
-# Truncate the sanitized_objective to a maximum of 50 characters
-max_length = 25
-truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+    console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
 
-# Update the filename to include the project name
-filename = f"{timestamp}_{truncated_objective}.md"
+    render_report(journal.path, filename)
+    print(f"\nFull exchange log saved to {filename}")
+    # The run is complete, nothing is left to resume
+    checkpoint.clear()
 
-# Prepare the full exchange log
-exchange_log = f"Objective: {objective}\n\n"
-exchange_log += "=" * 40 + " Task Breakdown " + "=" * 40 + "\n\n"
-for i, (prompt, result) in enumerate(task_exchanges, start=1):
-    exchange_log += f"Task {i}:\n"
-    exchange_log += f"Prompt: {prompt}\n"
-    exchange_log += f"Result: {result}\n\n"
+    return {
+        "objective": objective,
+        "refined_output": refined_output,
+        "project_dir": project_dir,
+        "log_file": filename,
+        "journal": journal.path,
+        "task_exchanges": task_exchanges,
+    }
 
-exchange_log += "=" * 40 + " Refined Final Output " + "=" * 40 + "\n\n"
-exchange_log += refined_output
 
-console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
+async def main():
+    # parse args
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--prompt', type=str, help='Your objective, with @ before any file, directory or glob to attach')
+    args = parser.parse_args()
 
-with open(filename, 'w') as file:
-    file.write(exchange_log)
-print(f"\nFull exchange log saved to {filename}")
+    resume = False
+    if args.prompt is not None:
+        objective = args.prompt
+    else:
+        # Offer to pick up a run that was interrupted in this directory
+        saved_run = Checkpoint().load()
+        resume = saved_run is not None and input("Do you want to continue from the last task? (y/n): ").lower() == 'y'
+        if resume:
+            objective = saved_run["objective"]
+            file_content = saved_run["settings"]["file_content"]
+            input_file = saved_run["settings"].get("input_file")
+            console.print(Panel(f"Resuming from last task: {objective}", title="[bold blue]Resuming from last task[/bold blue]", title_align="left", border_style="blue"))
+        else:
+            # Get the objective from user input
+            objective = input("Please enter your objective, with @ before any file, directory or glob to attach: ")
+
+    if not resume:
+        # Attach the files, directories and globs marked with @ in the objective
+        objective, specs = extract_paths(objective)
+        file_content = None
+        input_file = None
+        if specs:
+            # A single file too big for a prompt is read in chunks by run(); anything else is read here
+            attachment = attach(specs, SUBAGENT_MODEL)
+            file_content, input_file = attachment.file_content, attachment.input_file
+            console.print(Panel(attachment.summary(), title="[bold blue]Attached Files[/bold blue]", title_align="left", border_style="blue"))
+
+    await run(objective, file_content, input_file=input_file, resume=resume)
+
+    console.print(residency.report())
+    if response_cache:
+        console.print(response_cache.report())
+    await residency.aclose()
+    await aclose_providers()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
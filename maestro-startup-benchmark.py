@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+VARIANTS = ["maestro.py", "maestro-anyapi.py", "maestro-gpt4o.py", "maestro-groq.py", "maestro-lmstudio.py", "maestro-ollama.py"]
+# SDKs that must only be imported by the first call that needs them
+HEAVY_MODULES = ["anthropic", "openai", "groq", "ollama", "litellm", "tavily", "httpx", "tiktoken", "rich.live"]
+
+# Runs in a fresh interpreter: load the script without running it and report what that pulled in
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+from maestro_core.batch import load_variant
+load_variant({path!r})
+print(json.dumps({{"seconds": time.perf_counter() - start, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def probe(path, python=sys.executable, importtime=False):
+    command = [python, "-X", "importtime"] if importtime else [python]
+    code = _PROBE.format(root=ROOT, path=path, heavy=HEAVY_MODULES)
+    result = subprocess.run(command + ["-c", code], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_output, count):
+    """The modules with the highest self time from `python -X importtime` output."""
+    rows = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(self_us), int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long each maestro script takes to load, and fail on regressions")
+    parser.add_argument('variants', nargs='*', default=VARIANTS, help='maestro scripts to measure (default: all of them)')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per script; the median is reported')
+    parser.add_argument('--baseline', default=os.path.join(ROOT, 'startup_baseline.json'), help='JSON file of median load times to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='write the measured medians to --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline (0.25 = 25%%)')
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help='also show the N slowest imports of each script')
+    args = parser.parse_args()
+
+    try:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+
+    medians = {}
+    failures = []
+    for variant in args.variants:
+        path = variant if os.path.isabs(variant) else os.path.join(ROOT, variant)
+        name = os.path.basename(path)
+        try:
+            runs = [probe(path)[0] for _ in range(max(1, args.runs))]
+        except subprocess.CalledProcessError as e:
+            failures.append(f"{name}: failed to load\n{e.stderr.strip()}")
+            continue
+        median = medians[name] = statistics.median(run["seconds"] for run in runs)
+        heavy = sorted({module for run in runs for module in run["heavy"]})
+        line = f"{name:<22} {median * 1000:8.1f} ms"
+        if name in baseline:
+            line += f"  (baseline {baseline[name] * 1000:.1f} ms)"
+            if median > baseline[name] * (1 + args.tolerance):
+                failures.append(f"{name}: {median * 1000:.1f} ms is more than {args.tolerance:.0%} slower than the baseline")
+        if heavy:
+            line += f"  imports at load: {', '.join(heavy)}"
+            failures.append(f"{name}: imports {', '.join(heavy)} before it is used")
+        print(line)
+        if args.importtime:
+            for self_us, cumulative_us, module in slowest_imports(probe(path, importtime=True)[1], args.importtime):
+                print(f"    {self_us / 1000:8.1f} ms self {cumulative_us / 1000:8.1f} ms total  {module}")
+
+    if args.save_baseline:
+        baseline.update(medians)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,33 @@
 import os
-from anthropic import Anthropic
+import asyncio
 import re
 from rich.console import Console
 from rich.panel import Panel
 from datetime import datetime
 import json
-from tavily import TavilyClient
-
-# Set up the Anthropic API client
-client = Anthropic(api_key="YOUR KEY")
+from dataclasses import asdict
+from maestro_core import AnthropicProvider, aclose_providers
+from maestro_core.compaction import ContextCompactor, provider_summarizer
+from maestro_core.budget import token_budget
+from maestro_core.streaming import stream_to_console, task_complete_detector
+from maestro_core.continuation import stream_with_continuation
+from maestro_core.cache import ResponseCache
+from maestro_core.journal import JOURNAL_SUFFIX, RunJournal, render_report
+from maestro_core.checkpoint import Checkpoint
+from maestro_core.materialize import ProjectWriter, project_path
+from maestro_core.refined_output import RefinedOutputParser
+from maestro_core.large_input import digest_large_input, preview
+from maestro_core.ingest import attach, split_path_specs
+from maestro_core.retrieval import ORCHESTRATOR_CONTEXT_TOKENS, index_attachment, with_file_context
+from maestro_core.prompt_cache import history_blocks, text_block
+from maestro_core.search import MAX_SEARCH_QUERIES, SEARCH_QUERIES_INSTRUCTIONS, SearchCache, TavilySearch, parse_search_queries
+from maestro_core.dag import PLAN_INSTRUCTIONS, SubTask, parse_task_plan, run_dag
+
+# Opt-in on-disk response cache: set MAESTRO_CACHE_DIR to replay identical calls between runs
+response_cache = ResponseCache.from_env()
+
+# Set up the Anthropic API provider (the HTTP connection pool is shared across calls)
+client = AnthropicProvider(api_key="YOUR KEY", cache=response_cache)
 
 # Available Claude models:
 # Claude 3 Opus     claude-3-opus-20240229
@@ -20,7 +39,10 @@ ORCHESTRATOR_MODEL = "claude-3-5-sonnet-20240620"
 SUB_AGENT_MODEL = "claude-3-5-sonnet-20240620"
 REFINER_MODEL = "claude-3-5-sonnet-20240620"
 
-def calculate_subagent_cost(model, input_tokens, output_tokens):
+# Maximum number of sub-agents running at once in parallel (DAG) mode
+MAX_PARALLEL_SUBAGENTS = 4
+
+def calculate_subagent_cost(model, input_tokens, output_tokens, cache_read_tokens=0, cache_write_tokens=0):
     # Pricing information per model
     pricing = {
         "claude-3-opus-20240229": {"input_cost_per_mtok": 15.00, "output_cost_per_mtok": 75.00},
@@ -28,43 +50,54 @@ def calculate_subagent_cost(model, input_tokens, output_tokens):
         "claude-3-sonnet-20240229": {"input_cost_per_mtok": 3.00, "output_cost_per_mtok": 15.00},
         "claude-3-5-sonnet-20240620": {"input_cost_per_mtok": 3.00, "output_cost_per_mtok": 15.00},
     }
+    # Prompt cache writes cost 25% more than base input tokens, cache reads 90% less
+    cache_write_multiplier = 1.25
+    cache_read_multiplier = 0.10
 
     # Calculate cost
     input_cost = (input_tokens / 1_000_000) * pricing[model]["input_cost_per_mtok"]
+    cache_cost = ((cache_write_tokens * cache_write_multiplier + cache_read_tokens * cache_read_multiplier) / 1_000_000) * pricing[model]["input_cost_per_mtok"]
     output_cost = (output_tokens / 1_000_000) * pricing[model]["output_cost_per_mtok"]
-    total_cost = input_cost + output_cost
+    total_cost = input_cost + cache_cost + output_cost
 
     return total_cost
 
+# Token budget for the task history each role sees; older exchanges are replaced by cached summaries
+CONTEXT_BUDGETS = {"orchestrator": 8000, "sub_agent": 6000}
+compactor = ContextCompactor(provider_summarizer(client, SUB_AGENT_MODEL), CONTEXT_BUDGETS)
+
+# One Tavily client per process; answers are cached on disk for a day
+search = TavilySearch(api_key="YOUR API KEY HERE", cache=SearchCache())
+
 # Initialize the Rich Console
 console = Console()
 
-def opus_orchestrator(objective, file_content=None, previous_results=None, use_search=False):
+async def opus_orchestrator(objective, file_content=None, previous_results=None, use_search=False):
     console.print(f"\n[bold]Calling Orchestrator for your objective[/bold]")
-    previous_results_text = "\n".join(previous_results) if previous_results else "None"
+    # Drop the oldest results that don't fit the orchestrator's context window
+    budget = token_budget(ORCHESTRATOR_MODEL)
+    previous_results = budget.fit(previous_results, reserved=objective + (file_content or ""))
     if file_content:
-        console.print(Panel(f"File content:\n{file_content}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
+        console.print(Panel(f"File content:\n{preview(file_content)}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
     
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": f"Based on the following objective{' and file content' if file_content else ''}, and the previous sub-task results (if any), please break down the objective into the next sub-task, and create a concise and detailed prompt for a subagent so it can execute that task. IMPORTANT!!! when dealing with code tasks make sure you check the code for errors and provide fixes and support as part of the next sub-task. If you find any bugs or have suggestions for better code, please include them in the next sub-task prompt. Please assess if the objective has been fully achieved. If the previous sub-task results comprehensively address all aspects of the objective, include the phrase 'The task is complete:' at the beginning of your response. If the objective is not yet fully achieved, break it down into the next sub-task and create a concise and detailed prompt for a subagent to execute that task.:\n\nObjective: {objective}" + ('\\nFile content:\\n' + file_content if file_content else '') + f"\n\nPrevious sub-task results:\n{previous_results_text}"}
-            ]
-        }
-    ]
+    # Stable prefix first (instructions, objective, file content), then one block per previous result,
+    # so each call can reuse the prompt cache written by the one before it
+    content = [text_block(f"Based on the following objective{' and file content' if file_content else ''}, and the previous sub-task results (if any), please break down the objective into the next sub-task, and create a concise and detailed prompt for a subagent so it can execute that task. IMPORTANT!!! when dealing with code tasks make sure you check the code for errors and provide fixes and support as part of the next sub-task. If you find any bugs or have suggestions for better code, please include them in the next sub-task prompt. Please assess if the objective has been fully achieved. If the previous sub-task results comprehensively address all aspects of the objective, include the phrase 'The task is complete:' at the beginning of your response. If the objective is not yet fully achieved, break it down into the next sub-task and create a concise and detailed prompt for a subagent to execute that task.:\n\nObjective: {objective}" + ('\\nFile content:\\n' + file_content if file_content else ''), cache=not use_search)]
     if use_search:
-        messages[0]["content"].append({"type": "text", "text": "Please also generate a JSON object containing a single 'search_query' key, which represents a question that, when asked online, would yield important information for solving the subtask. The question should be specific and targeted to elicit the most relevant and helpful resources. Format your JSON like this, with no additional text before or after:\n{\"search_query\": \"<question>\"}\n"})
-
-    opus_response = client.messages.create(
-        model=ORCHESTRATOR_MODEL,
-        max_tokens=4096,
-        messages=messages
-    )
-
-    response_text = opus_response.content[0].text
-    console.print(f"Input Tokens: {opus_response.usage.input_tokens}, Output Tokens: {opus_response.usage.output_tokens}")
-    total_cost = calculate_subagent_cost(ORCHESTRATOR_MODEL, opus_response.usage.input_tokens, opus_response.usage.output_tokens)
+        content.append(text_block("\n\n" + SEARCH_QUERIES_INSTRUCTIONS, cache=True))
+    content += history_blocks("\n\nPrevious sub-task results:", previous_results)
+    messages = [{"role": "user", "content": content}]
+
+    max_tokens = budget.max_tokens(messages, cap=4096)
+    opus_response = await stream_to_console(client.stream(
+        ORCHESTRATOR_MODEL,
+        messages,
+        max_tokens=max_tokens
+    ), console, "Orchestrator", "green", stop_when=task_complete_detector())
+
+    response_text = opus_response.text
+    console.print(f"Input Tokens: {opus_response.input_tokens}, Output Tokens: {opus_response.output_tokens}, Cache Read Tokens: {opus_response.cache_read_tokens}, Cache Write Tokens: {opus_response.cache_write_tokens}")
+    total_cost = calculate_subagent_cost(ORCHESTRATOR_MODEL, opus_response.input_tokens, opus_response.output_tokens, opus_response.cache_read_tokens, opus_response.cache_write_tokens)
     console.print(f"Orchestrator Cost: ${total_cost:.4f}")
 
     search_query = None
@@ -74,10 +107,10 @@ def opus_orchestrator(objective, file_content=None, previous_results=None, use_s
         if json_match:
             json_string = json_match.group()
             try:
-                search_query = json.loads(json_string)["search_query"]
-                console.print(Panel(f"Search Query: {search_query}", title="[bold blue]Search Query[/bold blue]", title_align="left", border_style="blue"))
+                search_query = parse_search_queries(json.loads(json_string))
+                console.print(Panel("Search Queries:\n" + "\n".join(search_query), title="[bold blue]Search Queries[/bold blue]", title_align="left", border_style="blue"))
                 response_text = response_text.replace(json_string, "").strip()
-            except json.JSONDecodeError as e:
+            except (json.JSONDecodeError, TypeError) as e:
                 console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
                 console.print(Panel(f"Skipping search query extraction.", title="[bold yellow]Search Query Extraction Skipped[/bold yellow]", title_align="left", border_style="yellow"))
         else:
@@ -86,21 +119,61 @@ def opus_orchestrator(objective, file_content=None, previous_results=None, use_s
     console.print(Panel(response_text, title=f"[bold green]Opus Orchestrator[/bold green]", title_align="left", border_style="green", subtitle="Sending task to Haiku 👇"))
     return response_text, file_content, search_query
 
-def haiku_sub_agent(prompt, search_query=None, previous_haiku_tasks=None, use_search=False, continuation=False):
+async def opus_plan_orchestrator(objective, file_content=None, previous_results=None, use_search=False):
+    console.print(f"\n[bold]Calling Orchestrator to plan parallel sub-tasks for your objective[/bold]")
+    # Drop the oldest results that don't fit the orchestrator's context window
+    budget = token_budget(ORCHESTRATOR_MODEL)
+    previous_results = budget.fit(previous_results, reserved=objective + (file_content or ""))
+
+    # Same layout as opus_orchestrator: cached stable prefix, then one block per previous result
+    content = [text_block(f"Based on the following objective{' and file content' if file_content else ''}, and the previous sub-task results (if any), please assess if the objective has been fully achieved. IMPORTANT!!! when dealing with code tasks make sure you check the code for errors and provide fixes and support as part of the next sub-tasks. If the previous sub-task results comprehensively address all aspects of the objective, include the phrase 'The task is complete:' at the beginning of your response. Otherwise:\n{PLAN_INSTRUCTIONS}\n\nObjective: {objective}" + ('\nFile content:\n' + file_content if file_content else ''), cache=not use_search)]
+    if use_search:
+        content.append(text_block(f"\n\nPlease also give each task a 'search_queries' key with a list of 1 to {MAX_SEARCH_QUERIES} questions which, when asked online, would yield important information for solving that sub-task.", cache=True))
+    content += history_blocks("\n\nPrevious sub-task results:", previous_results)
+    messages = [{"role": "user", "content": content}]
+
+    max_tokens = budget.max_tokens(messages, cap=4096)
+    opus_response = await stream_to_console(client.stream(
+        ORCHESTRATOR_MODEL,
+        messages,
+        max_tokens=max_tokens
+    ), console, "Orchestrator", "green", stop_when=task_complete_detector())
+
+    response_text = opus_response.text
+    console.print(f"Input Tokens: {opus_response.input_tokens}, Output Tokens: {opus_response.output_tokens}, Cache Read Tokens: {opus_response.cache_read_tokens}, Cache Write Tokens: {opus_response.cache_write_tokens}")
+    total_cost = calculate_subagent_cost(ORCHESTRATOR_MODEL, opus_response.input_tokens, opus_response.output_tokens, opus_response.cache_read_tokens, opus_response.cache_write_tokens)
+    console.print(f"Orchestrator Cost: ${total_cost:.4f}")
+
+    if "The task is complete:" in response_text:
+        console.print(Panel(response_text, title=f"[bold green]Opus Orchestrator[/bold green]", title_align="left", border_style="green"))
+        return response_text, None
+
+    try:
+        tasks = parse_task_plan(response_text)
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        # Fall back to treating the whole reply as a single sub-task
+        console.print(Panel(f"Error parsing task plan: {e}", title="[bold yellow]Task Plan Fallback[/bold yellow]", title_align="left", border_style="yellow"))
+        tasks = [SubTask(id="t1", prompt=response_text)]
+
+    plan_summary = "\n".join(f"{task.id} (after {', '.join(task.depends_on) or 'nothing'}): {task.prompt}" for task in tasks)
+    console.print(Panel(plan_summary, title=f"[bold green]Opus Orchestrator Plan[/bold green]", title_align="left", border_style="green", subtitle=f"Sending {len(tasks)} tasks to Haiku 👇"))
+    return response_text, tasks
+
+async def haiku_sub_agent(prompt, search_query=None, previous_haiku_tasks=None, use_search=False):
     if previous_haiku_tasks is None:
         previous_haiku_tasks = []
 
-    continuation_prompt = "Continuing from the previous answer, please complete the response."
-    system_message = "Previous Haiku tasks:\n" + "\n".join(f"Task: {task['task']}\nResult: {task['result']}" for task in previous_haiku_tasks)
-    if continuation:
-        prompt = continuation_prompt
+    # Drop the oldest tasks that don't fit the sub-agent's context window
+    budget = token_budget(SUB_AGENT_MODEL)
+    previous_haiku_tasks = budget.fit(previous_haiku_tasks, reserved=prompt)
+
+    # One system block per previous task with a cache breakpoint on the last, so the growing history is cached
+    system_message = history_blocks("Previous Haiku tasks:", [f"Task: {task['task']}\nResult: {task['result']}" for task in previous_haiku_tasks], empty="")
 
     qna_response = None
     if search_query and use_search:
-        # Initialize the Tavily client
-        tavily = TavilyClient(api_key="YOUR API KEY HERE")
-        # Perform a QnA search based on the search query
-        qna_response = tavily.qna_search(query=search_query)
+        # Run every query concurrently and keep the most relevant passages that fit the budget
+        qna_response = await search.search_context(search_query, prompt, count_tokens=budget.count)
         console.print(f"QnA response: {qna_response}", style="yellow")
 
     # Prepare the messages array with only the prompt initially
@@ -115,28 +188,22 @@ def haiku_sub_agent(prompt, search_query=None, previous_haiku_tasks=None, use_se
     if qna_response:
         messages[0]["content"].append({"type": "text", "text": f"\nSearch Results:\n{qna_response}"})
 
-    haiku_response = client.messages.create(
-        model=SUB_AGENT_MODEL,
-        max_tokens=4096,
-        messages=messages,
-        system=system_message
-    )
+    max_tokens = budget.max_tokens(messages, system=system_message, cap=4096)
+    haiku_response = await stream_with_continuation(client, SUB_AGENT_MODEL, messages, console, "Sub-agent", "blue", system=system_message, max_tokens=max_tokens, budget=budget)
 
-    response_text = haiku_response.content[0].text
-    console.print(f"Input Tokens: {haiku_response.usage.input_tokens}, Output Tokens: {haiku_response.usage.output_tokens}")
-    total_cost = calculate_subagent_cost(SUB_AGENT_MODEL, haiku_response.usage.input_tokens, haiku_response.usage.output_tokens)
+    response_text = haiku_response.text
+    console.print(f"Input Tokens: {haiku_response.input_tokens}, Output Tokens: {haiku_response.output_tokens}, Cache Read Tokens: {haiku_response.cache_read_tokens}, Cache Write Tokens: {haiku_response.cache_write_tokens}")
+    total_cost = calculate_subagent_cost(SUB_AGENT_MODEL, haiku_response.input_tokens, haiku_response.output_tokens, haiku_response.cache_read_tokens, haiku_response.cache_write_tokens)
     console.print(f"Sub-agent Cost: ${total_cost:.4f}")
 
-    if haiku_response.usage.output_tokens >= 4000:  # Threshold set to 4000 as a precaution
-        console.print("[bold yellow]Warning:[/bold yellow] Output may be truncated. Attempting to continue the response.")
-        continuation_response_text = haiku_sub_agent(prompt, search_query, previous_haiku_tasks, use_search, continuation=True)
-        response_text += continuation_response_text
-
     console.print(Panel(response_text, title="[bold blue]Haiku Sub-agent Result[/bold blue]", title_align="left", border_style="blue", subtitle="Task completed, sending result to Opus 👇"))
     return response_text
 
-def opus_refine(objective, sub_task_results, filename, projectname, continuation=False):
+async def opus_refine(objective, sub_task_results, filename, projectname, on_text=None):
     print("\nCalling Opus to provide the refined final output for your objective:")
+    # Drop the oldest results that don't fit the refiner's context window
+    budget = token_budget(REFINER_MODEL)
+    sub_task_results = budget.fit(sub_task_results, reserved=objective)
     messages = [
         {
             "role": "user",
@@ -146,158 +213,227 @@ def opus_refine(objective, sub_task_results, filename, projectname, continuation
         }
     ]
 
-    opus_response = client.messages.create(
-        model=REFINER_MODEL,
-        max_tokens=4096,
-        messages=messages
-    )
+    max_tokens = budget.max_tokens(messages, cap=4096)
+    opus_response = await stream_with_continuation(client, REFINER_MODEL, messages, console, "Refiner", "green", max_tokens=max_tokens, budget=budget, on_text=on_text)
 
-    response_text = opus_response.content[0].text.strip()
-    console.print(f"Input Tokens: {opus_response.usage.input_tokens}, Output Tokens: {opus_response.usage.output_tokens}")
-    total_cost = calculate_subagent_cost(REFINER_MODEL, opus_response.usage.input_tokens, opus_response.usage.output_tokens)
+    response_text = opus_response.text.strip()
+    console.print(f"Input Tokens: {opus_response.input_tokens}, Output Tokens: {opus_response.output_tokens}, Cache Read Tokens: {opus_response.cache_read_tokens}, Cache Write Tokens: {opus_response.cache_write_tokens}")
+    total_cost = calculate_subagent_cost(REFINER_MODEL, opus_response.input_tokens, opus_response.output_tokens, opus_response.cache_read_tokens, opus_response.cache_write_tokens)
     console.print(f"Refine Cost: ${total_cost:.4f}")
 
-    if opus_response.usage.output_tokens >= 4000 and not continuation:  # Threshold set to 4000 as a precaution
-        console.print("[bold yellow]Warning:[/bold yellow] Output may be truncated. Attempting to continue the response.")
-        continuation_response_text = opus_refine(objective, sub_task_results + [response_text], filename, projectname, continuation=True)
-        response_text += "\n" + continuation_response_text
-
     console.print(Panel(response_text, title="[bold green]Final Output[/bold green]", title_align="left", border_style="green"))
     return response_text
 
-def create_folder_structure(project_name, folder_structure, code_blocks):
-    # Create the project folder
-    try:
-        os.makedirs(project_name, exist_ok=True)
-        console.print(Panel(f"Created project folder: [bold]{project_name}[/bold]", title="[bold green]Project Folder[/bold green]", title_align="left", border_style="green"))
-    except OSError as e:
-        console.print(Panel(f"Error creating project folder: [bold]{project_name}[/bold]\nError: {e}", title="[bold red]Project Folder Creation Error[/bold red]", title_align="left", border_style="red"))
-        return
-
-    # Recursively create the folder structure and files
-    create_folders_and_files(project_name, folder_structure, code_blocks)
-
-def create_folders_and_files(current_path, structure, code_blocks):
-    for key, value in structure.items():
-        path = os.path.join(current_path, key)
-        if isinstance(value, dict):
-            try:
-                os.makedirs(path, exist_ok=True)
-                console.print(Panel(f"Created folder: [bold]{path}[/bold]", title="[bold blue]Folder Creation[/bold blue]", title_align="left", border_style="blue"))
-                create_folders_and_files(path, value, code_blocks)
-            except OSError as e:
-                console.print(Panel(f"Error creating folder: [bold]{path}[/bold]\nError: {e}", title="[bold red]Folder Creation Error[/bold red]", title_align="left", border_style="red"))
+def create_folder_structure(project_name, project_writer):
+    # Write the files that are still waiting and report the whole project in a single panel
+    result = project_writer.finish(project_name)
+    style = "red" if result.errors else "yellow" if result.missing else "green"
+    console.print(Panel(result.summary(), title=f"[bold {style}]Project Files[/bold {style}]", title_align="left", border_style=style))
+    return result
+
+async def run(objective, file_content=None, use_search=False, use_parallel=False, input_file=None, output_dir=".", resume=False):
+    """Run one objective end to end without prompting.
+
+    The generated project and the exchange log are written under `output_dir`.
+    With `resume`, a run interrupted in `output_dir` picks up after its last
+    completed step instead of starting over. `input_file` is an attached file
+    too large to pass as `file_content`; it is read in chunks and reduced to
+    notes first.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Every completed step is checkpointed, so an interrupted run can pick up where it stopped
+    checkpoint = Checkpoint(output_dir)
+    state = checkpoint.begin(objective, resume, file_content=file_content, use_search=use_search, use_parallel=use_parallel, input_file=input_file, timestamp=datetime.now().strftime("%H-%M-%S"))
+    # Name the log files up front so every event can be journaled as it happens
+    sanitized_objective = re.sub(r'\W+', '_', objective)
+    timestamp = state["settings"]["timestamp"]
+    max_length = 25
+    truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+    filename = os.path.join(output_dir, f"{timestamp}_{truncated_objective}.md")
+    journal = RunJournal(os.path.splitext(filename)[0] + JOURNAL_SUFFIX)
+    if checkpoint.resumed:
+        console.print(Panel(f"Resuming after {len(state['exchanges'])} completed sub-tasks", title="[bold blue]Resuming from checkpoint[/bold blue]", title_align="left", border_style="blue"))
+    else:
+        journal.write("objective", objective=objective)
+    # Restore the history exactly as the orchestrator and the sub-agents saw it
+    task_exchanges = [(exchange["task"], exchange["result"]) for exchange in state["exchanges"]]
+    haiku_tasks = [dict(exchange) for exchange in state["exchanges"]]
+    compactor.import_summaries(state["summaries"])
+    # Index the attached file so every sub-agent gets the passages relevant to its own task
+    file_index = index_attachment(file_content, input_file)
+    if input_file is not None:
+        # The attached file is too big for one prompt: take notes on its chunks in parallel and merge them
+        file_content = state.get("input_digest")
+        if file_content is None:
+            file_content = await digest_large_input(input_file, client, SUB_AGENT_MODEL, objective, console, max_concurrency=MAX_PARALLEL_SUBAGENTS, done=state.get("chunks"), on_mapped=lambda chunk, notes: checkpoint.record("chunk", index=chunk.index, result=notes))
+            checkpoint.record("input_digest", digest=file_content)
+            journal.write("input_digest", path=input_file, digest=file_content)
+    elif file_content:
+        # The orchestrator gets the passages relevant to the objective rather than the whole file
+        file_content = file_index.context(objective, ORCHESTRATOR_CONTEXT_TOKENS)
+
+    while use_parallel:
+        pending = state["pending"]
+        if pending is not None:
+            # Resume the wave the orchestrator had already planned; finished tasks aren't run again
+            opus_result = pending["output"]
+            tasks = [SubTask(**task) for task in pending["tasks"]] if pending["tasks"] is not None else None
         else:
-            code_content = next((code for file, code in code_blocks if file == key), None)
-            if code_content:
-                try:
-                    with open(path, 'w') as file:
-                        file.write(code_content)
-                    console.print(Panel(f"Created file: [bold]{path}[/bold]", title="[bold green]File Creation[/bold green]", title_align="left", border_style="green"))
-                except IOError as e:
-                    console.print(Panel(f"Error creating file: [bold]{path}[/bold]\nError: {e}", title="[bold red]File Creation Error[/bold red]", title_align="left", border_style="red"))
+            # Ask the orchestrator for the next wave of sub-tasks with their dependencies
+            previous_results = [exchange["result"] for exchange in await compactor.compact(haiku_tasks, "orchestrator")]
+            opus_result, tasks = await opus_plan_orchestrator(objective, None if task_exchanges else file_content, previous_results, use_search)
+            checkpoint.record("plan", output=opus_result, tasks=[asdict(task) for task in tasks] if tasks is not None else None)
+            journal.write("orchestrator", output=opus_result, tasks=[task.id for task in tasks] if tasks else None)
+
+        if tasks is None:
+            final_output = opus_result.replace("The task is complete:", "").strip()
+            break
+
+        async def run_task(task, upstream):
+            done = state["pending"]["done"]
+            if task.id in done:
+                return done[task.id]
+            # Every task gets the passages of the attached file most relevant to it
+            agent_prompt = with_file_context(task.prompt, file_index)
+            # Each sub-agent only sees the results of its upstream tasks
+            sub_task_result = await haiku_sub_agent(agent_prompt, task.search_query, await compactor.compact(upstream, "sub_agent"), use_search)
+            # Checkpoint and journal each task as soon as it finishes, not when its wave does
+            checkpoint.record("task", id=task.id, result=sub_task_result)
+            journal.write("sub_agent", id=task.id, task=task.prompt, result=sub_task_result)
+            return sub_task_result
+
+        wave = await run_dag(tasks, run_task, MAX_PARALLEL_SUBAGENTS)
+        for task, sub_task_result in wave:
+            haiku_tasks.append({"task": task.prompt, "result": sub_task_result})
+            task_exchanges.append((task.prompt, sub_task_result))
+        checkpoint.record("wave", order=[task.id for task, _ in wave])
+        checkpoint.save_summaries(compactor)
+
+    while not use_parallel:
+        pending = state["pending"]
+        if pending is not None:
+            # Resume with the step the orchestrator had already handed out
+            opus_result, search_query = pending["output"], pending["search_query"]
+        else:
+            # Call Orchestrator to break down the objective into the next sub-task or provide the final output
+            previous_results = [exchange["result"] for exchange in await compactor.compact(haiku_tasks, "orchestrator")]
+            if not task_exchanges:
+                # Pass the file content only in the first iteration if available
+                opus_result, _, search_query = await opus_orchestrator(objective, file_content, previous_results, use_search)
             else:
-                console.print(Panel(f"Code content not found for file: [bold]{key}[/bold]", title="[bold yellow]Missing Code Content[/bold yellow]", title_align="left", border_style="yellow"))
+                opus_result, _, search_query = await opus_orchestrator(objective, previous_results=previous_results, use_search=use_search)
+            checkpoint.record("orchestrator", output=opus_result, search_query=search_query)
+            journal.write("orchestrator", output=opus_result, search_query=search_query)
+
+        if "The task is complete:" in opus_result:
+            # If Opus indicates the task is complete, exit the loop
+            final_output = opus_result.replace("The task is complete:", "").strip()
+            break
+        else:
+            sub_task_prompt = opus_result
+            # Every sub-agent gets the passages of the attached file most relevant to its own task
+            agent_prompt = with_file_context(sub_task_prompt, file_index)
+            # Call haiku_sub_agent with the prepared prompt, search query, and record the result
+            sub_task_result = await haiku_sub_agent(agent_prompt, search_query, await compactor.compact(haiku_tasks, "sub_agent"), use_search)
+            # Log the task and its result for future reference
+            haiku_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
+            # Record the exchange for processing and output generation
+            task_exchanges.append((sub_task_prompt, sub_task_result))
+            checkpoint.record("exchange", task=sub_task_prompt, result=sub_task_result)
+            checkpoint.save_summaries(compactor)
+            journal.write("sub_agent", task=sub_task_prompt, result=sub_task_result)
+
+    # Parse the refiner output while it streams, writing each code file as soon as its block closes
+    project_writer = ProjectWriter()
+    parser = RefinedOutputParser(
+        on_project_name=lambda name: project_writer.set_project_dir(project_path(output_dir, name)),
+        on_folder_structure=project_writer.set_structure,
+        on_file=project_writer.add_file,
+    )
+    # Call Opus to review and refine the sub-task results
+    refined_output = state["refined_output"]
+    if refined_output is None:
+        refined_output = await opus_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective, on_text=parser.feed)
+        checkpoint.record("refined", output=refined_output)
+        journal.write("refiner", output=refined_output)
+    else:
+        # Resumed after the refiner had already finished
+        parser.feed(refined_output)
+    parser.close()
 
-# Get the objective from user input
-objective = input("Please enter your objective: ")
+    project_name = parser.project_name or sanitized_objective
+    if parser.folder_structure_error:
+        e, json_string = parser.folder_structure_error
+        console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
+        console.print(Panel(f"Invalid JSON string: [bold]{json_string}[/bold]", title="[bold red]Invalid JSON String[/bold red]", title_align="left", border_style="red"))
 
-# Ask if the user wants to add a file
-add_file = input("Do you want to add a text file? (y/n): ").lower() == 'y'
+    # Write the files that were still waiting and report on the whole project
+    project_dir = project_path(output_dir, project_name)
+    create_folder_structure(project_dir, project_writer)
+
+    console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
+
+    render_report(journal.path, filename)
+    print(f"\nFull exchange log saved to {filename}")
+    # The run is complete, nothing is left to resume
+    checkpoint.clear()
+
+    return {
+        "objective": objective,
+        "refined_output": refined_output,
+        "project_dir": project_dir,
+        "log_file": filename,
+        "journal": journal.path,
+        "task_exchanges": task_exchanges,
+    }
 
-file_content = None
-if add_file:
-    file_path = input("Please enter the file path: ")
-    try:
-        with open(file_path, 'r') as file:
-            file_content = file.read()
-        console.print(Panel(f"File content:\n{file_content}", title="[bold blue]File Content[/bold blue]", title_align="left", border_style="blue"))
-    except FileNotFoundError:
-        console.print(Panel("File not found. Proceeding without file content.", title="[bold red]File Error[/bold red]", title_align="left", border_style="red"))
-    except IOError:
-        console.print(Panel("Error reading file. Proceeding without file content.", title="[bold red]File Error[/bold red]", title_align="left", border_style="red"))
-
-# Ask the user if they want to use search
-use_search = input("Do you want to use search? (y/n): ").lower() == 'y'
-
-task_exchanges = []
-haiku_tasks = []
-
-while True:
-    # Call Orchestrator to break down the objective into the next sub-task or provide the final output
-    previous_results = [result for _, result in task_exchanges]
-    if not task_exchanges:
-        # Pass the file content only in the first iteration if available
-        opus_result, file_content_for_haiku, search_query = opus_orchestrator(objective, file_content, previous_results, use_search)
-    else:
-        opus_result, _, search_query = opus_orchestrator(objective, previous_results=previous_results, use_search=use_search)
 
-    if "The task is complete:" in opus_result:
-        # If Opus indicates the task is complete, exit the loop
-        final_output = opus_result.replace("The task is complete:", "").strip()
-        break
+async def main():
+    # Offer to pick up a run that was interrupted in this directory
+    saved_run = Checkpoint().load()
+    resume = saved_run is not None and input("Do you want to continue from the last task? (y/n): ").lower() == 'y'
+    if resume:
+        objective = saved_run["objective"]
+        file_content = saved_run["settings"]["file_content"]
+        input_file = saved_run["settings"].get("input_file")
+        use_search = saved_run["settings"]["use_search"]
+        use_parallel = saved_run["settings"]["use_parallel"]
+        console.print(Panel(f"Resuming from last task: {objective}", title="[bold blue]Resuming from last task[/bold blue]", title_align="left", border_style="blue"))
     else:
-        sub_task_prompt = opus_result
-        # Append file content to the prompt for the initial call to haiku_sub_agent, if applicable
-        if file_content_for_haiku and not haiku_tasks:
-            sub_task_prompt = f"{sub_task_prompt}\n\nFile content:\n{file_content_for_haiku}"
-        # Call haiku_sub_agent with the prepared prompt, search query, and record the result
-        sub_task_result = haiku_sub_agent(sub_task_prompt, search_query, haiku_tasks, use_search)
-        # Log the task and its result for future reference
-        haiku_tasks.append({"task": sub_task_prompt, "result": sub_task_result})
-        # Record the exchange for processing and output generation
-        task_exchanges.append((sub_task_prompt, sub_task_result))
-        # Prevent file content from being included in future haiku_sub_agent calls
-        file_content_for_haiku = None
-
-# Create the .md filename
-sanitized_objective = re.sub(r'\W+', '_', objective)
-timestamp = datetime.now().strftime("%H-%M-%S")
-
-# Call Opus to review and refine the sub-task results
-refined_output = opus_refine(objective, [result for _, result in task_exchanges], timestamp, sanitized_objective)
-
-# Extract the project name from the refined output
-project_name_match = re.search(r'Project Name: (.*)', refined_output)
-project_name = project_name_match.group(1).strip() if project_name_match else sanitized_objective
-
-# Extract the folder structure from the refined output
-folder_structure_match = re.search(r'<folder_structure>(.*?)</folder_structure>', refined_output, re.DOTALL)
-folder_structure = {}
-if folder_structure_match:
-    json_string = folder_structure_match.group(1).strip()
-    try:
-        folder_structure = json.loads(json_string)
-    except json.JSONDecodeError as e:
-        console.print(Panel(f"Error parsing JSON: {e}", title="[bold red]JSON Parsing Error[/bold red]", title_align="left", border_style="red"))
-        console.print(Panel(f"Invalid JSON string: [bold]{json_string}[/bold]", title="[bold red]Invalid JSON String[/bold red]", title_align="left", border_style="red"))
+        # Get the objective from user input
+        objective = input("Please enter your objective: ")
 
-# Extract code files from the refined output
-code_blocks = re.findall(r'Filename: (\S+)\s*```[\w]*\n(.*?)\n```', refined_output, re.DOTALL)
+        # Ask if the user wants to add a file
+        add_file = input("Do you want to attach files? (y/n): ").lower() == 'y'
 
-# Create the folder structure and code files
-create_folder_structure(project_name, folder_structure, code_blocks)
+        file_content = None
+        input_file = None
+        if add_file:
+            file_path = input("Please enter files, directories or globs to attach: ")
+            try:
+                # A single file too big for a prompt is read in chunks by run(); anything else is read here
+                attachment = attach(split_path_specs(file_path), SUB_AGENT_MODEL)
+                file_content, input_file = attachment.file_content, attachment.input_file
+                console.print(Panel(attachment.summary(), title="[bold blue]Attached Files[/bold blue]", title_align="left", border_style="blue"))
+            except FileNotFoundError:
+                console.print(Panel("File not found. Proceeding without file content.", title="[bold red]File Error[/bold red]", title_align="left", border_style="red"))
+            except IOError:
+                console.print(Panel("Error reading file. Proceeding without file content.", title="[bold red]File Error[/bold red]", title_align="left", border_style="red"))
 
-# Truncate the sanitized_objective to a maximum of 50 characters
-max_length = 25
-truncated_objective = sanitized_objective[:max_length] if len(sanitized_objective) > max_length else sanitized_objective
+        # Ask the user if they want to use search
+        use_search = input("Do you want to use search? (y/n): ").lower() == 'y'
 
-# Update the filename to include the project name
-filename = f"{timestamp}_{truncated_objective}.md"
+        # Ask the user if independent sub-tasks should run in parallel
+        use_parallel = input("Do you want to run independent sub-tasks in parallel? (y/n): ").lower() == 'y'
 
-# Prepare the full exchange log
-exchange_log = f"Objective: {objective}\n\n"
-exchange_log += "=" * 40 + " Task Breakdown " + "=" * 40 + "\n\n"
-for i, (prompt, result) in enumerate(task_exchanges, start=1):
-    exchange_log += f"Task {i}:\n"
-    exchange_log += f"Prompt: {prompt}\n"
-    exchange_log += f"Result: {result}\n\n"
+    await run(objective, file_content, use_search, use_parallel, input_file=input_file, resume=resume)
 
-exchange_log += "=" * 40 + " Refined Final Output " + "=" * 40 + "\n\n"
-exchange_log += refined_output
+    if use_search:
+        console.print(search.report())
+    if response_cache:
+        console.print(response_cache.report())
+    await aclose_providers()
 
-console.print(f"\n[bold]Refined Final output:[/bold]\n{refined_output}")
 
-with open(filename, 'w') as file:
-    file.write(exchange_log)
-print(f"\nFull exchange log saved to {filename}")
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,12 @@
+from .providers import (
+    Completion,
+    Provider,
+    AnthropicProvider,
+    OpenAIProvider,
+    GroqProvider,
+    OllamaProvider,
+    LiteLLMProvider,
+    get_provider,
+    aclose_providers,
+)
+from .api import Maestro, MaestroResult, run_maestro, arun_maestro
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Requests the local server works on at once (Ollama's OLLAMA_NUM_PARALLEL); more would only queue there, out of our control
+DEFAULT_MAX_IN_FLIGHT = 4
+# Calls admitted for the loaded model in a row while calls for another model are waiting
+DEFAULT_MAX_BATCH = 32
+# Seconds a call may wait for its model before the loaded one stops taking new calls
+DEFAULT_MAX_WAIT = 60.0
+# Calls queued for a model at once; more wait in arrival order until queued ones are dispatched
+DEFAULT_MAX_QUEUED = 64
+
+
+class _Waiter:
+    def __init__(self, model, key):
+        self.model = model
+        # The group of models the call is served with
+        self.key = key
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.queued = time.monotonic()
+
+    def grant(self):
+        self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class ModelAffinityScheduler:
+    """Groups the calls of many concurrent objectives by model for one local inference server.
+
+    A local server holds few models in memory, so alternating orchestrator and
+    sub-agent models call by call makes it swap weights all the time. Calls
+    take a slot() first. The scheduler serves one model at a time, up to
+    `max_in_flight` calls at once. When that model has no calls left, it moves
+    on to the model whose call has waited longest, so e.g. every ready
+    orchestrator call runs on the large model, then every ready sub-agent call
+    on the small one. The loaded model stops taking new calls once it has taken
+    `max_batch` calls while another model waits, or once a call for another
+    model has waited `max_wait` seconds. That bounds each objective's latency.
+    Models that fit in memory together can be share()d: they are then served
+    as one, and their calls (including preloads) run side by side.
+    At most `max_queued` calls are queued by model; later callers wait in
+    arrival order for room, so a large batch can't grow the queues without
+    bound. It is thread-safe, like the rate limiters, so objectives on several
+    event loops share it.
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_batch=DEFAULT_MAX_BATCH, max_wait=DEFAULT_MAX_WAIT,
+                 max_queued=DEFAULT_MAX_QUEUED):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.max_queued = max(1, max_queued)
+        self.active = None
+        self.calls = 0
+        self.switches = 0
+        self.longest_wait = 0.0
+        self.deepest_queue = 0
+        self.held_back = 0
+        self._running = 0
+        self._served = 0
+        self._queued = 0
+        self._waiting = {}
+        # Model -> the group key it is served under; a model not listed is its own group
+        self._groups = {}
+        # Calls that arrived while `max_queued` calls were queued
+        self._overflow = deque()
+        self._lock = threading.Lock()
+
+    def share(self, models):
+        """Serve `models` as one group from now on, e.g. because they stay loaded side by side."""
+        with self._lock:
+            members = set(models)
+            for model in models:
+                key = self._groups.get(model)
+                if isinstance(key, frozenset):
+                    members |= key
+            key = frozenset(members)
+            old_keys = {self._groups.get(model, model) for model in members} - {key}
+            for model in members:
+                self._groups[model] = key
+            # Calls already queued under the old groups move to the new one, in arrival order
+            moved = [waiter for old in old_keys for waiter in self._waiting.pop(old, ())]
+            for waiter in moved:
+                waiter.key = key
+            if moved:
+                self._waiting[key] = deque(sorted(list(self._waiting.get(key, ())) + moved, key=lambda waiter: waiter.queued))
+            if self.active in old_keys:
+                self.active = key
+            self._dispatch()
+
+    def _oldest_other(self):
+        """The waiting call queued first among the groups other than the active one."""
+        heads = [queue[0] for key, queue in self._waiting.items() if queue and key != self.active]
+        return min(heads, key=lambda waiter: waiter.queued, default=None)
+
+    def _yielding(self):
+        # Whether the active model must stop taking calls so another model gets its turn
+        other = self._oldest_other()
+        if other is None:
+            return False
+        if not self._waiting.get(self.active):
+            return True
+        # Each turn takes at least one call, or two models that both waited too long would hand the turn back and forth
+        return self._served >= self.max_batch or (self._served > 0 and time.monotonic() - other.queued >= self.max_wait)
+
+    def _enqueue(self, waiter):
+        self._waiting.setdefault(waiter.key, deque()).append(waiter)
+        self._queued += 1
+        self.deepest_queue = max(self.deepest_queue, self._queued)
+
+    def _admit(self):
+        while self._overflow and self._queued < self.max_queued:
+            self._enqueue(self._overflow.popleft())
+
+    def _dispatch(self):
+        # Called with the lock held whenever a call arrives or finishes
+        self._admit()
+        if self._running == 0 and (self.active is None or self._yielding() or not self._waiting.get(self.active)):
+            other = self._oldest_other()
+            if other is not None:
+                if self.active is not None:
+                    self.switches += 1
+                self.active = other.key
+                self._served = 0
+        queue = self._waiting.get(self.active)
+        while queue and self._running < self.max_in_flight and not self._yielding():
+            waiter = queue.popleft()
+            self._queued -= 1
+            self._admit()
+            self._running += 1
+            self._served += 1
+            self.calls += 1
+            self.longest_wait = max(self.longest_wait, time.monotonic() - waiter.queued)
+            waiter.grant()
+
+    def _release(self):
+        with self._lock:
+            self._running -= 1
+            self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, model):
+        """Wait until `model` may be called, and hold its place while the call runs."""
+        with self._lock:
+            waiter = _Waiter(model, self._groups.get(model, model))
+            if self._queued >= self.max_queued or self._overflow:
+                self._overflow.append(waiter)
+                self.held_back += 1
+            else:
+                self._enqueue(waiter)
+            self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._overflow:
+                    self._overflow.remove(waiter)
+                    raise
+                queue = self._waiting.get(waiter.key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    self._queued -= 1
+                    self._dispatch()
+                    raise
+            # Granted just as the caller gave up: pass the slot on
+            self._release()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def report(self):
+        report = (
+            f"Model scheduler: {self.calls} calls, {self.switches} model switches, longest wait {self.longest_wait:.1f}s,"
+            f" deepest queue {self.deepest_queue}/{self.max_queued}"
+        )
+        if self.held_back:
+            report += f", {self.held_back} calls held back at the queue limit"
+        return report
@@ -0,0 +1,192 @@
+import asyncio
+import inspect
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+from .batch import load_variant
+from .compaction import provider_summarizer
+from .ingest import attach
+
+# The maestro scripts live next to the maestro_core package
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_VARIANT = "maestro.py"
+# The module settings each role's model is read from; maestro-ollama.py spells the sub-agent one without the underscore
+MODEL_SETTINGS = {
+    "orchestrator": ("ORCHESTRATOR_MODEL",),
+    "sub_agent": ("SUB_AGENT_MODEL", "SUBAGENT_MODEL"),
+    "refiner": ("REFINER_MODEL",),
+}
+
+
+@dataclass
+class MaestroResult:
+    """What one objective produced."""
+    objective: str
+    refined_output: str
+    project_dir: str
+    log_file: str
+    journal: str
+    task_exchanges: list
+    attached_files: list = field(default_factory=list)
+    seconds: float = 0.0
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def variant_path(variant):
+    """Resolve "anyapi", "maestro-anyapi" or "maestro-anyapi.py" to the script; paths are used as given."""
+    if os.path.isfile(variant):
+        return variant
+    name = variant if variant.endswith(".py") else variant + ".py"
+    for candidate in (name, "maestro-" + name):
+        path = os.path.join(SCRIPTS_DIR, candidate)
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f"No maestro script named {variant}")
+
+
+def _model_setting(module, role):
+    if role not in MODEL_SETTINGS:
+        raise ValueError(f"Unknown model role {role!r}, expected one of: {', '.join(MODEL_SETTINGS)}")
+    for name in MODEL_SETTINGS[role]:
+        if hasattr(module, name):
+            return name
+    raise ValueError(f"{module.__file__} has no {role} model setting")
+
+
+def configure_models(module, models):
+    """Point a loaded maestro script at other models, e.g. {"sub_agent": "gpt-4o-mini"}."""
+    for role, model in (models or {}).items():
+        setattr(module, _model_setting(module, role), model)
+    summarize = getattr(getattr(module, "compactor", None), "summarize", None)
+    if models and "sub_agent" in models and hasattr(summarize, "provider"):
+        # Old exchanges are summarized by the sub-agent model
+        module.compactor.summarize = provider_summarizer(summarize.provider, models["sub_agent"])
+
+
+class Maestro:
+    """A maestro script loaded and configured once, for running many objectives.
+
+    Loading a script builds its provider clients, response cache, search client
+    and context compactor; a session keeps them, so every objective after the
+    first reuses the same connection pools and caches. Use arun() from async
+    code. run() is for synchronous callers: it runs objectives on the session's
+    own event loop thread, because pooled connections belong to the loop that
+    opened them.
+    """
+
+    def __init__(self, variant=DEFAULT_VARIANT, models=None, quiet=False):
+        self.path = variant_path(variant)
+        self.module = load_variant(self.path)
+        configure_models(self.module, models)
+        if quiet and hasattr(self.module, "console"):
+            self.module.console.quiet = True
+        self._accepted = inspect.signature(self.module.run).parameters
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def model(self, role):
+        return getattr(self.module, _model_setting(self.module, role))
+
+    async def arun(self, objective, files=None, search=False, parallel=False, output_dir=".", resume=False):
+        """Run `objective` and return a MaestroResult.
+
+        `files` is a path, directory or glob, or a list of them, attached the
+        same way as on the command line.
+        """
+        kwargs = {"output_dir": output_dir}
+        for option, parameter, enabled in (("search", "use_search", search), ("parallel", "use_parallel", parallel)):
+            if enabled and parameter not in self._accepted:
+                raise ValueError(f"{os.path.basename(self.path)} does not support {option}")
+            if enabled:
+                kwargs[parameter] = True
+        if "resume" in self._accepted:
+            kwargs["resume"] = resume
+        attached = []
+        if files:
+            specs = [files] if isinstance(files, (str, os.PathLike)) else list(files)
+            # Reading and hashing the files is blocking work; keep it off the event loop
+            attachment = await asyncio.to_thread(attach, [os.fspath(spec) for spec in specs], self.model("sub_agent"))
+            attached = [attached_file.path for attached_file in attachment.files]
+            if attachment.input_file is not None and "input_file" in self._accepted:
+                kwargs["input_file"] = attachment.input_file
+            else:
+                kwargs["file_content"] = attachment.file_content
+        start = time.perf_counter()
+        result = await self.module.run(objective, **kwargs)
+        return MaestroResult(
+            objective=result["objective"],
+            refined_output=result["refined_output"],
+            project_dir=result["project_dir"],
+            log_file=result["log_file"],
+            journal=result["journal"],
+            task_exchanges=[list(exchange) for exchange in result["task_exchanges"]],
+            attached_files=attached,
+            seconds=round(time.perf_counter() - start, 2),
+        )
+
+    def _session_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="maestro-session", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def run(self, objective, **options):
+        """Blocking arun(), for code without an event loop of its own."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("Maestro.run() was called from a running event loop, await Maestro.arun() instead")
+        return asyncio.run_coroutine_threadsafe(self.arun(objective, **options), self._session_loop()).result()
+
+    async def aclose(self):
+        """Close the script's provider connections."""
+        await self.module.aclose_providers()
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_maestro(variant=DEFAULT_VARIANT, models=None):
+    """The shared session for `variant` with `models`, created on first use."""
+    key = (os.path.realpath(variant_path(variant)), tuple(sorted((models or {}).items())))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = Maestro(variant, models)
+        return session
+
+
+def run_maestro(objective, files=None, search=False, models=None, variant=DEFAULT_VARIANT, **options):
+    """Run one objective to completion and return a MaestroResult.
+
+    Sessions are shared between calls with the same `variant` and `models`,
+    so only the first call pays for loading the script and opening clients.
+    `models` maps "orchestrator", "sub_agent" and "refiner" to model names.
+    Other options (parallel, output_dir, resume) go to Maestro.arun().
+    """
+    return get_maestro(variant, models).run(objective, files=files, search=search, **options)
+
+
+async def arun_maestro(objective, files=None, search=False, models=None, variant=DEFAULT_VARIANT, **options):
+    """run_maestro() for async callers; the session's clients then live on the caller's loop."""
+    return await get_maestro(variant, models).arun(objective, files=files, search=search, **options)
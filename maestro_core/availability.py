@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_MODEL_CHECK_PATH = os.path.join(os.path.expanduser("~"), ".cache", "maestro", "models.json")
+# How long a model found on a server is trusted without asking again
+DEFAULT_MODEL_CHECK_TTL = 24 * 60 * 60
+
+
+class ModelCheckCache:
+    """Models known to be available, per provider endpoint, kept on disk with a TTL.
+
+    Only models that were found are remembered, so a missing model is looked
+    up again on the next run. The JSON file is rewritten atomically.
+    """
+
+    def __init__(self, path=DEFAULT_MODEL_CHECK_PATH, ttl=DEFAULT_MODEL_CHECK_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+            self._entries = {key: checked for key, checked in entries.items() if not self._expired(checked)}
+        return self._entries
+
+    def _expired(self, checked):
+        return time.time() - checked > self.ttl
+
+    def available(self, key):
+        with self._lock:
+            checked = self._load().get(key)
+            return checked is not None and not self._expired(checked)
+
+    def put(self, key):
+        with self._lock:
+            entries = self._load()
+            entries[key] = time.time()
+            self._write(entries)
+
+    def _write(self, entries):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class ModelChecker:
+    """Makes sure the models a run needs are on the provider's server, pulling missing ones.
+
+    All models are checked concurrently, and a model found once is trusted
+    for the cache's TTL, so a run started from cron usually checks nothing.
+    Concurrent runs in one process share the checks in flight.
+    """
+
+    def __init__(self, provider, cache=None, pull=True):
+        self.provider = provider
+        self.cache = cache
+        self.pull = pull
+        self.checks = 0
+        self.pulled = []
+        self._in_flight = {}
+
+    def _key(self, model):
+        return f"{self.provider.name}:{self.provider.endpoint}:{model}"
+
+    async def ensure(self, models, console=None):
+        """Check every model in `models` at once; returns the ones that had to be pulled."""
+        unique = list(dict.fromkeys(models))
+        pulled = await asyncio.gather(*(self._ensure(model, console) for model in unique))
+        return [model for model, was_pulled in zip(unique, pulled) if was_pulled]
+
+    async def _ensure(self, model, console):
+        key = self._key(model)
+        future = self._in_flight.get(key)
+        if future is None:
+            if self.cache is not None and self.cache.available(key):
+                return False
+            future = asyncio.ensure_future(self._check(model, key, console))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _check(self, model, key, console):
+        self.checks += 1
+        if await self.provider.has_model(model):
+            pulled = False
+        elif self.pull:
+            message = f"Pulling model from {self.provider.name}: {model}"
+            console.print(message) if console is not None else print(message)
+            await self.provider.pull_model(model)
+            self.pulled.append(model)
+            pulled = True
+        else:
+            raise LookupError(f"Model {model} is not available on {self.provider.endpoint or self.provider.name}")
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, key)
+        return pulled
@@ -0,0 +1,137 @@
+import asyncio
+import importlib.util
+import inspect
+import json
+import os
+import re
+import time
+import traceback
+
+from .ingest import ingest
+from .large_input import is_large_input
+
+DEFAULT_WORKERS = 4
+RESULTS_FILE = "batch_results.jsonl"
+
+
+def load_variant(path):
+    """Import a maestro script (e.g. maestro-gpt4o.py) by path and return the module."""
+    name = "maestro_variant_" + re.sub(r'\W+', '_', os.path.splitext(os.path.basename(path))[0])
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not hasattr(module, "run"):
+        raise ValueError(f"{path} has no run() entry point")
+    return module
+
+
+def read_objectives(path):
+    """Parse a JSONL file of objectives; blank lines and lines starting with # are skipped.
+
+    Each line is {"objective": ..., "id": optional, "file" or "files": optional
+    file, directory or glob path(s), "search": optional bool, "parallel": optional bool}.
+    """
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            job = json.loads(line)
+            if not job.get("objective"):
+                raise ValueError(f"{path}:{line_number}: missing 'objective'")
+            job.setdefault("id", f"{len(jobs) + 1:04d}")
+            job["id"] = str(job["id"])
+            jobs.append(job)
+    return jobs
+
+
+def read_job_files(job, base_dir="."):
+    files = job.get("files") or ([job["file"]] if job.get("file") else [])
+    if not files:
+        return None
+    return ingest([os.path.join(base_dir, file_path) for file_path in files]).file_content
+
+
+def large_job_file(job, module, base_dir="."):
+    """The job's single attached file if it is too large to pass as file content, else None."""
+    files = job.get("files") or ([job["file"]] if job.get("file") else [])
+    model = getattr(module, "SUB_AGENT_MODEL", None) or getattr(module, "SUBAGENT_MODEL", None)
+    if len(files) != 1 or model is None:
+        return None
+    path = os.path.join(base_dir, files[0])
+    return path if os.path.isfile(path) and is_large_input(path, model) else None
+
+
+def job_output_dir(output_root, job):
+    job_id = re.sub(r'[^\w.-]+', '_', job["id"])
+    slug = re.sub(r'\W+', '_', job["objective"])[:40].strip("_")
+    return os.path.join(output_root, f"{job_id}_{slug}")
+
+
+def completed_job_ids(output_root):
+    done = set()
+    try:
+        with open(os.path.join(output_root, RESULTS_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("status") == "ok":
+                    done.add(record["id"])
+    except OSError:
+        pass
+    return done
+
+
+async def run_batch(module, jobs, output_root, workers=DEFAULT_WORKERS, base_dir=".", on_result=None, resume=False):
+    """Run every job through `module.run` with at most `workers` objectives in flight.
+
+    A failing objective is recorded and does not stop the others. One JSON
+    line per finished objective is appended to RESULTS_FILE in `output_root`.
+    With `resume`, objectives interrupted earlier continue from their checkpoint.
+    """
+    os.makedirs(output_root, exist_ok=True)
+    accepted = inspect.signature(module.run).parameters
+    results_path = os.path.join(output_root, RESULTS_FILE)
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    records = []
+
+    async def worker():
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            output_dir = job_output_dir(output_root, job)
+            record = {"id": job["id"], "objective": job["objective"], "output_dir": output_dir}
+            start = time.perf_counter()
+            try:
+                # Walking, hashing and reading the files is blocking work; keep it off the event loop the other objectives stream on
+                input_file = await asyncio.to_thread(large_job_file, job, module, base_dir) if "input_file" in accepted else None
+                if input_file is not None:
+                    kwargs = {"input_file": input_file, "output_dir": output_dir}
+                else:
+                    kwargs = {"file_content": await asyncio.to_thread(read_job_files, job, base_dir), "output_dir": output_dir}
+                if "use_search" in accepted:
+                    kwargs["use_search"] = bool(job.get("search", False))
+                if "use_parallel" in accepted:
+                    kwargs["use_parallel"] = bool(job.get("parallel", False))
+                if "resume" in accepted:
+                    kwargs["resume"] = resume
+                result = await module.run(job["objective"], **kwargs)
+                record.update(status="ok", project_dir=result["project_dir"], log_file=result["log_file"])
+            except Exception as e:
+                record.update(status="error", error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+            record["seconds"] = round(time.perf_counter() - start, 2)
+            records.append(record)
+            with open(results_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if on_result is not None:
+                on_result(record)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    return records
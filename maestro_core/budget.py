@@ -0,0 +1,148 @@
+import functools
+
+# Context window sizes (tokens). Lookups try the exact model name, then the name
+# without a "provider/" prefix, then the longest matching prefix.
+CONTEXT_WINDOWS = {
+    "claude-3": 200_000,
+    "gpt-4o": 128_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4": 8_192,
+    "gpt-3.5-turbo": 16_385,
+    "gemini-1.5": 1_000_000,
+    "mixtral-8x7b-32768": 32_768,
+    "llama3-70b-8192": 8_192,
+    "llama3-8b-8192": 8_192,
+    "llama3": 8_192,
+    "lmstudio-community/Meta-Llama-3": 8_192,
+}
+DEFAULT_CONTEXT_WINDOW = 8_192
+
+# Largest completion each API accepts; local models are only bounded by their window
+MAX_OUTPUT_TOKENS = {
+    "claude-3": 4_096,
+    "claude-3-5-sonnet": 8_192,
+    "gpt-4o": 4_096,
+    "gpt-4": 4_096,
+    "gpt-3.5-turbo": 4_096,
+    "gemini-1.5": 8_192,
+}
+
+# Tokens reserved for the fixed instruction text of a stage prompt
+PROMPT_OVERHEAD_TOKENS = 1_024
+# Per-message framing tokens added by chat templates
+MESSAGE_OVERHEAD_TOKENS = 4
+# Never ask for fewer output tokens than this; fail before the call instead
+MIN_OUTPUT_TOKENS = 256
+# Room kept free for the answer when trimming history (at most a quarter of the window)
+DEFAULT_OUTPUT_RESERVE = 4_096
+# Extra headroom for models whose tokenizer we can only approximate
+APPROXIMATE_TOKENIZER_MARGIN = 1.10
+
+
+class ContextOverflowError(ValueError):
+    pass
+
+
+def _lookup(table, model, default):
+    if model in table:
+        return table[model]
+    # "gemini/gemini-1.5-flash" -> also try "gemini-1.5-flash"
+    names = (model, model.split("/", 1)[-1])
+    matches = [key for key in table if any(name.startswith(key) for name in names)]
+    return table[max(matches, key=len)] if matches else default
+
+
+def context_window(model):
+    return _lookup(CONTEXT_WINDOWS, model, DEFAULT_CONTEXT_WINDOW)
+
+
+def max_output_tokens(model):
+    return _lookup(MAX_OUTPUT_TOKENS, model, None)
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    """Return (encode, exact) for `model`, or (None, False) when tiktoken isn't installed."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None, False
+    if "gpt-4o" in model or model.startswith(("o1", "openai/o1")):
+        return tiktoken.get_encoding("o200k_base").encode, True
+    if "gpt-" in model:
+        return tiktoken.get_encoding("cl100k_base").encode, True
+    # Claude, Gemini and Llama tokenizers aren't available offline; cl100k is a close approximation
+    return tiktoken.get_encoding("cl100k_base").encode, False
+
+
+def count_tokens(text, model=""):
+    if not text:
+        return 0
+    encode, exact = _encoding(model)
+    if encode is None:
+        # Fallback when tiktoken is missing: ~4 characters per token, padded
+        return int(len(text) / 4 * APPROXIMATE_TOKENIZER_MARGIN) + 1
+    tokens = len(encode(text, disallowed_special=()))
+    return tokens if exact else int(tokens * APPROXIMATE_TOKENIZER_MARGIN) + 1
+
+
+def _content_text(content):
+    if isinstance(content, list):
+        return "".join(block.get("text", "") for block in content)
+    return content or ""
+
+
+class TokenBudget:
+    """Counts tokens for one model and keeps prompts inside its context window."""
+
+    def __init__(self, model, window=None, min_output_tokens=MIN_OUTPUT_TOKENS):
+        self.model = model
+        self.window = window or context_window(model)
+        self.min_output_tokens = min_output_tokens
+
+    def count(self, text):
+        return count_tokens(text, self.model)
+
+    def count_item(self, item):
+        if isinstance(item, dict):
+            return self.count(f"Task: {item['task']}\nResult: {item['result']}")
+        return self.count(str(item))
+
+    def count_messages(self, messages, system=None):
+        total = self.count(_content_text(system)) + (MESSAGE_OVERHEAD_TOKENS if system else 0)
+        for message in messages:
+            total += self.count(_content_text(message["content"])) + MESSAGE_OVERHEAD_TOKENS
+        return total
+
+    @property
+    def input_limit(self):
+        reserve = min(max_output_tokens(self.model) or DEFAULT_OUTPUT_RESERVE, self.window // 4)
+        return self.window - max(reserve, self.min_output_tokens)
+
+    def fit(self, items, reserved="", overhead=PROMPT_OVERHEAD_TOKENS):
+        """Drop the oldest history items until they fit next to `reserved` text in the window."""
+        items = list(items or [])
+        available = self.input_limit - overhead - self.count(reserved)
+        costs = [self.count_item(item) for item in items]
+        total = sum(costs)
+        start = 0
+        while start < len(items) and total > available:
+            total -= costs[start]
+            start += 1
+        return items[start:]
+
+    def max_tokens(self, messages, system=None, cap=None):
+        """Pick max_tokens from the room left in the window after the prompt."""
+        room = self.window - self.count_messages(messages, system)
+        if room < self.min_output_tokens:
+            raise ContextOverflowError(
+                f"Prompt for {self.model} needs {self.window - room} tokens, "
+                f"which leaves less than {self.min_output_tokens} of its {self.window}-token window for the answer"
+            )
+        limits = [limit for limit in (room, cap, max_output_tokens(self.model)) if limit]
+        return min(limits)
+
+
+@functools.lru_cache(maxsize=None)
+def token_budget(model):
+    return TokenBudget(model)
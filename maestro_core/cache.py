@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "maestro", "responses")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Bump when the key layout or the stored entry format changes
+CACHE_VERSION = 1
+
+
+def cache_key(*parts):
+    """Stable sha256 over JSON-serializable parts (dict keys are sorted)."""
+    payload = json.dumps([CACHE_VERSION, *parts], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of completions with LRU size-based eviction.
+
+    Entries are JSON files named by the hash of the request. Reading an entry
+    bumps its mtime, and when the cache grows past `max_bytes` the least
+    recently used entries are deleted first.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._sizes = None
+
+    @classmethod
+    def from_env(cls, variable="MAESTRO_CACHE_DIR"):
+        """Build a cache when `variable` is set (opt-in), else return None."""
+        directory = os.environ.get(variable)
+        if not directory:
+            return None
+        max_mb = os.environ.get("MAESTRO_CACHE_MAX_MB")
+        return cls(directory, int(float(max_mb) * 1024 * 1024) if max_mb else DEFAULT_MAX_BYTES)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _index(self):
+        # Sizes of every entry on disk, loaded once and kept up to date by put()
+        if self._sizes is None:
+            sizes = {}
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.endswith(".json"):
+                        path = os.path.join(root, name)
+                        try:
+                            sizes[path] = os.path.getsize(path)
+                        except OSError:
+                            pass
+            self._sizes = sizes
+        return self._sizes
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            sizes = self._index()
+            sizes[path] = len(data)
+            if sum(sizes.values()) > self.max_bytes:
+                self._evict(sizes)
+
+    def _evict(self, sizes):
+        def last_used(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0.0
+
+        total = sum(sizes.values())
+        for path in sorted(sizes, key=last_used):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= sizes.pop(path)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = f" ({self.hits / lookups:.0%} hit rate)" if lookups else ""
+        with self._lock:
+            stored = sum(self._index().values())
+        return f"Response cache: {self.hits} hits, {self.misses} misses{rate}, {stored / 1024 / 1024:.1f} MB in {self.directory}"
@@ -0,0 +1,183 @@
+import json
+import os
+import tempfile
+import threading
+
+CHECKPOINT_FILE = ".maestro_checkpoint.json"
+WAL_SUFFIX = ".wal"
+CHECKPOINT_VERSION = 1
+# The log is folded into the snapshot once it outgrows the snapshot (and this floor),
+# which keeps the total I/O of a run linear in its length
+COMPACT_MIN_BYTES = 256 * 1024
+
+
+def new_state(objective, settings):
+    return {
+        "version": CHECKPOINT_VERSION,
+        "seq": 0,
+        "objective": objective,
+        "settings": settings,
+        # Completed {"task", "result"} exchanges, in the order the orchestrator saw them
+        "exchanges": [],
+        # Orchestrator output (or DAG wave) whose sub-agent work hasn't completed yet
+        "pending": None,
+        # Context compactor summaries by exchange key
+        "summaries": {},
+        # Notes on each chunk of a large attached file by chunk index, then the merged digest
+        "chunks": {},
+        "input_digest": None,
+        "refined_output": None,
+    }
+
+
+def apply_record(state, record):
+    """Apply one log record to `state` in place."""
+    op = record["op"]
+    if op == "orchestrator":
+        state["pending"] = {"output": record["output"], "search_query": record.get("search_query")}
+    elif op == "exchange":
+        state["exchanges"].append({"task": record["task"], "result": record["result"]})
+        state["pending"] = None
+    elif op == "plan":
+        state["pending"] = {"output": record["output"], "tasks": record["tasks"], "done": {}}
+    elif op == "task":
+        state["pending"]["done"][record["id"]] = record["result"]
+    elif op == "wave":
+        pending = state["pending"]
+        prompts = {task["id"]: task["prompt"] for task in pending["tasks"]}
+        for task_id in record["order"]:
+            state["exchanges"].append({"task": prompts[task_id], "result": pending["done"][task_id]})
+        state["pending"] = None
+    elif op == "summaries":
+        state["summaries"].update(record["summaries"])
+    elif op == "chunk":
+        state.setdefault("chunks", {})[str(record["index"])] = record["result"]
+    elif op == "input_digest":
+        state["input_digest"] = record["digest"]
+    elif op == "refined":
+        state["refined_output"] = record["output"]
+    else:
+        raise ValueError(f"Unknown checkpoint record: {op!r}")
+    state["seq"] = record["seq"]
+
+
+class Checkpoint:
+    """Crash-safe state of one run: a JSON snapshot plus an append-only write-ahead log.
+
+    Every completed step is appended to the log and fsynced before the run moves
+    on, so an interrupted run resumes from its last completed step. Appending
+    costs the size of the step, not of the whole history; the log is folded into
+    a new snapshot (written to a temp file and renamed over the old one) only
+    when it grows larger than the snapshot. Records carry a sequence number, so a
+    crash between the rename and truncating the log replays nothing twice.
+    """
+
+    def __init__(self, directory=".", name=CHECKPOINT_FILE, compact_min_bytes=COMPACT_MIN_BYTES):
+        self.directory = directory
+        self.path = os.path.join(directory, name)
+        self.wal_path = self.path + WAL_SUFFIX
+        self.compact_min_bytes = compact_min_bytes
+        self.state = None
+        self._snapshot_bytes = 0
+        self._wal_bytes = 0
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """The saved state with the log replayed on top, or None if there is no checkpoint."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("version") != CHECKPOINT_VERSION:
+            return None
+        try:
+            with open(self.wal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write; everything before it is intact
+                        break
+                    if record["seq"] > state["seq"]:
+                        apply_record(state, record)
+        except OSError:
+            pass
+        return state
+
+    def begin(self, objective, resume=False, **settings):
+        """Restore the saved run for `objective` if `resume` is set and there is one, else start afresh.
+
+        Returns the state; its settings are those the run was started with.
+        """
+        state = self.load() if resume else None
+        if state is not None and state["objective"] == objective:
+            self.state = state
+            # Fold the replayed log into a fresh snapshot before carrying on
+            self.compact()
+            return state
+        self.state = new_state(objective, settings)
+        self.compact()
+        return self.state
+
+    @property
+    def resumed(self):
+        return self.state is not None and self.state["seq"] > 0
+
+    def record(self, op, **fields):
+        """Apply a step to the state and append it to the log before returning."""
+        with self._lock:
+            record = {"op": op, "seq": self.state["seq"] + 1, **fields}
+            apply_record(self.state, record)
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            with open(self.wal_path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._wal_bytes += len(line.encode("utf-8"))
+            if self._wal_bytes > max(self.compact_min_bytes, self._snapshot_bytes):
+                self._compact()
+
+    def save_summaries(self, compactor):
+        """Log the compactor summaries of this run's exchanges that aren't saved yet."""
+        summaries = compactor.export_summaries(self.state["exchanges"])
+        new = {key: text for key, text in summaries.items() if key not in self.state["summaries"]}
+        if new:
+            self.record("summaries", summaries=new)
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        os.makedirs(self.directory or ".", exist_ok=True)
+        data = json.dumps(self.state, ensure_ascii=False)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory or ".", prefix=".checkpoint-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        # Records up to state["seq"] are in the snapshot now, so the log can start over
+        with open(self.wal_path, "w", encoding="utf-8"):
+            pass
+        self._snapshot_bytes = len(data.encode("utf-8"))
+        self._wal_bytes = 0
+
+    def clear(self):
+        """Delete the checkpoint once the run has finished."""
+        for path in (self.wal_path, self.path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+
+from .budget import count_tokens
+
+# Token budget for the history each role gets to see
+DEFAULT_BUDGETS = {
+    "orchestrator": 8000,
+    "sub_agent": 6000,
+}
+# Exchanges always kept verbatim, newest first
+DEFAULT_KEEP_RECENT = 2
+SUMMARY_MAX_TOKENS = 300
+
+SUMMARY_PROMPT = (
+    "Summarize the following sub-task and its result in at most 150 words. Keep decisions, names, "
+    "file names, function signatures, numbers and open issues; drop explanations and boilerplate.\n\n"
+    "Task: {task}\n\nResult: {result}"
+)
+
+
+def exchange_tokens(exchange, count_tokens=count_tokens):
+    return count_tokens(f"Task: {exchange['task']}\nResult: {exchange['result']}")
+
+
+def provider_summarizer(provider, model, max_tokens=SUMMARY_MAX_TOKENS):
+    """Build a summarize(task, result) coroutine that calls `model` through `provider`."""
+    async def summarize(task, result):
+        response = await provider.complete(
+            model,
+            [{"role": "user", "content": SUMMARY_PROMPT.format(task=task, result=result)}],
+            max_tokens=max_tokens
+        )
+        return response.text.strip()
+    # Kept so the summarizer can be rebuilt for another model on the same provider
+    summarize.provider = provider
+    summarize.model = model
+    return summarize
+
+
+class ContextCompactor:
+    """Keeps recent {'task', 'result'} exchanges verbatim and replaces older ones with summaries.
+
+    Summaries are computed once per exchange (keyed by content hash) and reused on
+    every later call, so compaction costs one small call per exchange in total.
+    """
+
+    def __init__(self, summarize, budgets=None, keep_recent=DEFAULT_KEEP_RECENT, count_tokens=count_tokens):
+        self.summarize = summarize
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.keep_recent = keep_recent
+        self.count_tokens = count_tokens
+        self._summaries = {}
+
+    @staticmethod
+    def _key(exchange):
+        return hashlib.sha256(f"{exchange['task']}\0{exchange['result']}".encode("utf-8")).hexdigest()
+
+    async def _summary(self, exchange):
+        key = self._key(exchange)
+        future = self._summaries.get(key)
+        if future is None:
+            # Share the in-flight call between concurrent sub-agents
+            future = asyncio.ensure_future(self.summarize(exchange["task"], exchange["result"]))
+            self._summaries[key] = future
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            self._summaries.pop(key, None)
+            raise
+
+    def export_summaries(self, exchanges):
+        """Finished summaries of `exchanges` by key, for saving in a checkpoint."""
+        summaries = {}
+        for exchange in exchanges:
+            future = self._summaries.get(self._key(exchange))
+            if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                summaries[self._key(exchange)] = future.result()
+        return summaries
+
+    def import_summaries(self, summaries):
+        """Reuse summaries saved by export_summaries instead of computing them again."""
+        loop = asyncio.get_running_loop()
+        for key, summary in summaries.items():
+            if key not in self._summaries:
+                future = loop.create_future()
+                future.set_result(summary)
+                self._summaries[key] = future
+
+    async def compact(self, exchanges, role="sub_agent"):
+        exchanges = list(exchanges or [])
+        budget = self.budgets[role]
+        costs = [exchange_tokens(exchange, self.count_tokens) for exchange in exchanges]
+        if sum(costs) <= budget:
+            return exchanges
+
+        # Walk back from the newest exchange, keeping as many verbatim as the budget allows
+        used = 0
+        split = len(exchanges)
+        while split > 0:
+            cost = costs[split - 1]
+            kept = len(exchanges) - split
+            if kept >= self.keep_recent and used + cost > budget:
+                break
+            used += cost
+            split -= 1
+        recent = exchanges[split:]
+        older = exchanges[:split]
+
+        summaries = await asyncio.gather(*(self._summary(exchange) for exchange in older))
+
+        # Fill the remaining budget with the newest summaries; the oldest ones are dropped
+        compacted = []
+        for exchange, summary in zip(reversed(older), reversed(summaries)):
+            entry = {"task": f"(summarized) {exchange['task'][:200]}", "result": summary}
+            cost = exchange_tokens(entry, self.count_tokens)
+            if used + cost > budget:
+                break
+            used += cost
+            compacted.append(entry)
+        compacted.reverse()
+        return compacted + recent
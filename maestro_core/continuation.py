@@ -0,0 +1,141 @@
+from dataclasses import replace
+
+from .budget import ContextOverflowError
+from .streaming import stream_to_console
+
+# Extra rounds allowed after a response is cut off by max_tokens
+MAX_CONTINUATION_ROUNDS = 3
+# Used when the backend can't continue a prefilled assistant turn
+CONTINUE_PROMPT = "Continue exactly where your previous message stopped. Do not repeat anything or add any preamble."
+# Longest repeated stretch trimmed where a continuation overlaps the text before it
+MAX_OVERLAP_CHARS = 400
+
+
+def _trim_overlap(previous, continuation):
+    # Without prefill, models often restate the last line before carrying on
+    for size in range(min(len(previous), len(continuation), MAX_OVERLAP_CHARS), 20, -1):
+        if previous.endswith(continuation[:size]):
+            return continuation[size:]
+    return continuation
+
+
+class _TextForwarder:
+    """Passes streamed text on to `on_text` in pieces that add up to the joined continuation text.
+
+    Trailing whitespace is held back until more text follows, because a
+    prefilled round continues from the stripped text. Without prefill, the
+    start of a round is held until the overlap with the text before it can be
+    trimmed.
+    """
+
+    def __init__(self, on_text):
+        self.on_text = on_text
+        self._held = ""
+        self._previous = None
+        self._head = ""
+
+    def start_round(self, prefill, text):
+        if prefill:
+            self._held = ""
+        else:
+            # The text is kept as it was, trailing whitespace included
+            if self._held:
+                self.on_text(self._held)
+                self._held = ""
+            self._previous = text
+            self._head = ""
+
+    def feed(self, delta):
+        if self._previous is None:
+            self._emit(delta)
+            return
+        self._head += delta
+        if len(self._head) >= MAX_OVERLAP_CHARS:
+            self.end_round()
+
+    def end_round(self):
+        if self._previous is not None:
+            head = _trim_overlap(self._previous, self._head)
+            self._previous = None
+            self._head = ""
+            self._emit(head)
+
+    def close(self):
+        self.end_round()
+        if self._held:
+            self.on_text(self._held)
+            self._held = ""
+
+    def _emit(self, text):
+        text = self._held + text
+        stripped = text.rstrip()
+        self._held = text[len(stripped):]
+        if stripped:
+            self.on_text(stripped)
+
+
+def continuation_messages(provider, model, messages, partial):
+    """Messages asking `model` to carry on from `partial`, the text generated so far."""
+    if provider.supports_prefill(model):
+        # The API continues a trailing assistant turn (which must not end in whitespace)
+        return list(messages) + [{"role": "assistant", "content": partial.rstrip()}]
+    return list(messages) + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": CONTINUE_PROMPT},
+    ]
+
+
+async def stream_with_continuation(provider, model, messages, console, title, border_style="blue",
+                                   system=None, max_tokens=4096, budget=None,
+                                   max_rounds=MAX_CONTINUATION_ROUNDS, on_text=None, **params):
+    """Stream a completion and, while it stops because of max_tokens, continue it.
+
+    Continuation is driven by the API's stop reason, not by a token threshold.
+    Each extra round prefills the assistant turn with the text so far (or asks
+    to continue, where prefill isn't supported), so the model picks up
+    mid-sentence instead of starting over. At most `max_rounds` extra calls
+    are made. Returns one Completion with the joined text and summed usage.
+
+    `on_text(text)` receives the joined text incrementally while it streams.
+    """
+    forwarder = _TextForwarder(on_text) if on_text is not None else None
+    completion = await stream_to_console(
+        provider.stream(model, messages, system=system, max_tokens=max_tokens, **params),
+        console, title, border_style, on_delta=forwarder.feed if forwarder else None,
+    )
+    text = completion.text
+    total = replace(completion, extra=dict(completion.extra))
+    rounds = 0
+    while completion.truncated and rounds < max_rounds:
+        rounds += 1
+        prefill = provider.supports_prefill(model)
+        next_messages = continuation_messages(provider, model, messages, text)
+        round_max_tokens = max_tokens
+        if budget is not None:
+            try:
+                round_max_tokens = min(max_tokens, budget.max_tokens(next_messages, system=system))
+            except ContextOverflowError:
+                console.print("[bold yellow]Warning:[/bold yellow] No room left in the context window to continue the response.")
+                break
+        console.print(f"[bold yellow]Response hit the token limit, continuing (round {rounds}/{max_rounds})[/bold yellow]")
+        if forwarder is not None:
+            forwarder.start_round(prefill, text)
+        completion = await stream_to_console(
+            provider.stream(model, next_messages, system=system, max_tokens=round_max_tokens, **params),
+            console, f"{title} (continued)", border_style, on_delta=forwarder.feed if forwarder else None,
+        )
+        if forwarder is not None:
+            forwarder.end_round()
+        text = text.rstrip() + completion.text if prefill else text + _trim_overlap(text, completion.text)
+        total.input_tokens += completion.input_tokens
+        total.output_tokens += completion.output_tokens
+        total.cache_read_tokens += completion.cache_read_tokens
+        total.cache_write_tokens += completion.cache_write_tokens
+        total.latency += completion.latency
+        total.stop_reason = completion.stop_reason
+        total.raw_stop_reason = completion.raw_stop_reason
+    if forwarder is not None:
+        forwarder.close()
+    total.text = text
+    total.extra["continuation_rounds"] = rounds
+    return total
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+PLAN_INSTRUCTIONS = (
+    "Break the remaining work into sub-tasks that can be executed by independent subagents. "
+    "Sub-tasks that do not need each other's output must not depend on each other so they can run in parallel. "
+    "Respond with a JSON object wrapped in <task_plan> tags, with no additional text, formatted like this:\n"
+    "<task_plan>{\"tasks\": [{\"id\": \"t1\", \"prompt\": \"<detailed prompt for the subagent>\", \"depends_on\": []}, "
+    "{\"id\": \"t2\", \"prompt\": \"<detailed prompt>\", \"depends_on\": [\"t1\"]}]}</task_plan>\n"
+    "Each subagent only sees the results of the tasks listed in its depends_on, so include every upstream task it needs."
+)
+
+
+@dataclass
+class SubTask:
+    id: str
+    prompt: str
+    depends_on: list = field(default_factory=list)
+    # One query or a list of queries to run concurrently
+    search_query: Optional[Union[str, list]] = None
+
+
+def parse_task_plan(text):
+    """Parse the orchestrator's <task_plan> JSON into a list of SubTask, validating the graph."""
+    match = re.search(r'<task_plan>(.*?)</task_plan>', text, re.DOTALL)
+    json_string = match.group(1) if match else text[text.find('{'):text.rfind('}') + 1]
+    plan = json.loads(json_string)
+    tasks = [
+        SubTask(
+            id=str(item["id"]),
+            prompt=item["prompt"],
+            depends_on=[str(dep) for dep in item.get("depends_on", [])],
+            search_query=item.get("search_queries") or item.get("search_query"),
+        )
+        for item in plan["tasks"]
+    ]
+    topological_order(tasks)
+    return tasks
+
+
+def topological_order(tasks):
+    by_id = {}
+    for task in tasks:
+        if task.id in by_id:
+            raise ValueError(f"Duplicate task id in plan: {task.id}")
+        by_id[task.id] = task
+    for task in tasks:
+        for dep in task.depends_on:
+            if dep not in by_id:
+                raise ValueError(f"Task {task.id} depends on unknown task {dep}")
+
+    # Kahn's algorithm, keeping the planner's order among ready tasks
+    remaining = {task.id: len(set(task.depends_on)) for task in tasks}
+    dependents = {task.id: [] for task in tasks}
+    for task in tasks:
+        for dep in set(task.depends_on):
+            dependents[dep].append(task.id)
+    ready = [task.id for task in tasks if remaining[task.id] == 0]
+    order = []
+    while ready:
+        task_id = ready.pop(0)
+        order.append(by_id[task_id])
+        for child in dependents[task_id]:
+            remaining[child] -= 1
+            if remaining[child] == 0:
+                ready.append(child)
+    if len(order) != len(tasks):
+        raise ValueError("Task plan contains a dependency cycle")
+    return order
+
+
+async def run_dag(tasks, run_task, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Run `run_task(task, upstream)` for every task once its dependencies finish.
+
+    `upstream` is the list of {"task", "result"} dicts of the task's direct
+    dependencies. At most `max_concurrency` tasks run at once. Returns
+    (task, result) pairs in topological order.
+    """
+    order = topological_order(tasks)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    futures = {task.id: asyncio.get_running_loop().create_future() for task in order}
+
+    async def run_one(task):
+        try:
+            upstream = []
+            for dep in task.depends_on:
+                dep_task, dep_result = await futures[dep]
+                upstream.append({"task": dep_task.prompt, "result": dep_result})
+            async with semaphore:
+                result = await run_task(task, upstream)
+            futures[task.id].set_result((task, result))
+        except BaseException as e:
+            futures[task.id].set_exception(e)
+            raise
+
+    runners = [asyncio.create_task(run_one(task)) for task in order]
+    try:
+        await asyncio.gather(*runners)
+    finally:
+        for runner in runners:
+            runner.cancel()
+        # Retrieve exceptions of futures nobody awaited to avoid "never retrieved" warnings
+        for future in futures.values():
+            if future.done() and not future.cancelled():
+                future.exception()
+    return [futures[task.id].result() for task in order]
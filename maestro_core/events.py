@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Events kept per channel for subscribers that connect late or reconnect
+DEFAULT_HISTORY = 5000
+# Finished channels kept around for late subscribers
+DEFAULT_CLOSED_CHANNELS = 100
+END_EVENT = "end"
+
+_current = ContextVar("maestro_events", default=None)
+
+
+class Subscription:
+    """Events of one channel, in order: the kept history after `last_id`, then live ones."""
+
+    def __init__(self, bus, channel, backlog):
+        self.bus = bus
+        self.channel = channel
+        self._queue = queue.Queue()
+        for record in backlog:
+            self._queue.put(record)
+
+    def get(self, timeout=None):
+        """The next event, or None if none arrived within `timeout` seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.bus._unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Channel:
+    def __init__(self, history):
+        self.history = deque(maxlen=history)
+        self.subscribers = []
+        self.next_id = 1
+        self.closed = False
+
+
+class EventBus:
+    """In-process publish/subscribe of run events, safe to use across threads.
+
+    The orchestration loop publishes to one channel per run (e.g. a job id)
+    from its event loop; any number of subscribers, e.g. web requests on other
+    threads, get their own queue. Events are numbered per channel so a
+    subscriber can reconnect and continue after the last one it saw.
+    """
+
+    def __init__(self, history=DEFAULT_HISTORY, closed_channels=DEFAULT_CLOSED_CHANNELS):
+        self.history = history
+        self.closed_channels = closed_channels
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _channel(self, name):
+        channel = self._channels.get(name)
+        if channel is None:
+            channel = self._channels[name] = _Channel(self.history)
+        return channel
+
+    def publish(self, name, event, **data):
+        with self._lock:
+            channel = self._channel(name)
+            record = {"id": channel.next_id, "event": event, "time": round(time.time(), 3), **data}
+            channel.next_id += 1
+            channel.history.append(record)
+            for subscription in channel.subscribers:
+                subscription._queue.put(record)
+        return record
+
+    def close(self, name):
+        """Publish the end of a channel; it is dropped once enough newer channels have closed."""
+        self.publish(name, END_EVENT)
+        with self._lock:
+            self._channels[name].closed = True
+            self._channels.move_to_end(name)
+            closed = [key for key, channel in self._channels.items() if channel.closed and not channel.subscribers]
+            for key in closed[:max(0, len(closed) - self.closed_channels)]:
+                del self._channels[key]
+
+    def subscribe(self, name, last_id=0):
+        with self._lock:
+            channel = self._channel(name)
+            subscription = Subscription(self, name, [record for record in channel.history if record["id"] > last_id])
+            channel.subscribers.append(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            channel = self._channels.get(subscription.channel)
+            if channel is not None and subscription in channel.subscribers:
+                channel.subscribers.remove(subscription)
+                # Forget channels that were only ever subscribed to
+                if not channel.subscribers and channel.next_id == 1:
+                    del self._channels[subscription.channel]
+
+    @contextmanager
+    def publishing(self, name):
+        """Send every emit() made in this context, including tasks it starts, to channel `name`."""
+        token = _current.set(lambda event, **data: self.publish(name, event, **data))
+        try:
+            yield
+        finally:
+            _current.reset(token)
+            self.close(name)
+
+
+def emit(event, **data):
+    """Publish an event to the channel of the current run, if anything is listening."""
+    publish = _current.get()
+    if publish is not None:
+        publish(event, **data)
+
+
+def current_emitter():
+    """The emit function of the current run, for code that reports from other threads."""
+    publish = _current.get()
+    if publish is None:
+        return lambda event, **data: None
+    return publish
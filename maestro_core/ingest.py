@@ -0,0 +1,437 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from .budget import count_tokens
+from .large_input import is_large_input
+from .materialize import write_file_atomic
+
+DEFAULT_FILE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "maestro", "files")
+IGNORE_FILES = (".gitignore", ".maestroignore")
+DEFAULT_IGNORE_PATTERNS = (
+    ".git/", ".hg/", ".svn/", "__pycache__/", "node_modules/", ".venv/", "venv/", ".tox/", ".nox/",
+    ".mypy_cache/", ".pytest_cache/", ".ruff_cache/", "*.py[cod]", ".DS_Store", ".maestro_checkpoint.json*",
+)
+# Files bigger than this are skipped when a directory or glob is attached
+MAX_FILE_BYTES = 1024 * 1024
+MAX_READ_WORKERS = 16
+# Bytes sniffed to tell text from binary files
+SNIFF_BYTES = 8192
+# Bump when the stored entry format changes
+FILE_CACHE_VERSION = 1
+
+FILE_OPEN = '<file path="{path}">'
+FILE_CLOSE = "</file>"
+_FILE_OPEN = re.compile(r'<file path="(.*)">')
+
+
+def _glob_regex(pattern):
+    # Translate one gitignore glob into a regex over "/"-separated relative paths
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                regex += re.escape(pattern[i])
+                i += 1
+            else:
+                body = pattern[i + 1:end]
+                regex += "[" + ("^" + body[1:] if body.startswith("!") else body) + "]"
+                i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+class IgnoreRules:
+    """The gitignore subset that matters for attaching files.
+
+    Supports comments, "!" negation, trailing "/" for directories only, leading
+    or inner "/" to anchor a pattern to the directory of its ignore file, and
+    "*", "?", "[...]" and "**" globs. The last matching rule wins, as in git.
+    """
+
+    def __init__(self, patterns=DEFAULT_IGNORE_PATTERNS):
+        self._rules = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern, base=""):
+        pattern = pattern.rstrip("\n").rstrip()
+        if not pattern or pattern.startswith("#"):
+            return
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+        directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        regex = _glob_regex(pattern.lstrip("/"))
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        prefix = re.escape(base + "/") if base else ""
+        self._rules.append((re.compile(prefix + regex + r"\Z"), negate, directory_only))
+
+    def add_file(self, path, base=""):
+        """Add the rules of the ignore file at `path`, relative to the directory `base`."""
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    self.add(line, base)
+        except OSError:
+            pass
+
+    def ignored(self, relative_path, is_dir=False):
+        ignored = False
+        for regex, negate, directory_only in self._rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                ignored = not negate
+        return ignored
+
+
+def is_binary(sample):
+    """Whether a file starting with the bytes `sample` looks binary rather than UTF-8 text."""
+    if b"\0" in sample:
+        return True
+    try:
+        sample.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sample is still text
+        return e.start < len(sample) - 3
+    return False
+
+
+def walk_files(directory, rules=None):
+    """Yield the files under `directory` that no ignore rule excludes, in sorted order.
+
+    Ignore files found on the way apply to their own directory and below, and
+    ignored directories are not descended into.
+    """
+    rules = rules or IgnoreRules()
+    for root, dirs, files in os.walk(directory):
+        base = os.path.relpath(root, directory).replace(os.sep, "/")
+        base = "" if base == "." else base
+        for name in IGNORE_FILES:
+            if name in files:
+                rules.add_file(os.path.join(root, name), base)
+
+        def relative(name):
+            return f"{base}/{name}" if base else name
+
+        dirs[:] = sorted(name for name in dirs if not rules.ignored(relative(name), is_dir=True))
+        for name in sorted(files):
+            if not rules.ignored(relative(name)):
+                yield os.path.join(root, name)
+
+
+def expand_paths(specs):
+    """Expand files, directories and glob patterns into a de-duplicated list of (path, explicit) pairs.
+
+    `explicit` is True for files named directly, which are taken even if an
+    ignore rule or the size limit would have skipped them in a directory.
+    """
+    seen = set()
+    paths = []
+
+    def take(path, explicit):
+        path = os.path.normpath(path)
+        key = os.path.realpath(path)
+        if key not in seen:
+            seen.add(key)
+            paths.append((path, explicit))
+
+    for spec in specs:
+        spec = os.path.expanduser(spec)
+        if os.path.isfile(spec):
+            take(spec, True)
+        elif os.path.isdir(spec):
+            for path in walk_files(spec):
+                take(path, False)
+        elif glob.has_magic(spec):
+            # Ignore rules apply from the directory before the first wildcard
+            root = os.path.dirname(spec[:re.search(r"[*?[]", spec).start()])
+            rules = IgnoreRules()
+            for name in IGNORE_FILES:
+                rules.add_file(os.path.join(root or ".", name))
+            for path in sorted(glob.glob(spec, recursive=True)):
+                relative = os.path.relpath(path, root or ".").replace(os.sep, "/")
+                if os.path.isfile(path) and not any(rules.ignored(prefix, is_dir=True) for prefix in _parents(relative)) and not rules.ignored(relative):
+                    take(path, False)
+        else:
+            raise FileNotFoundError(f"No such file, directory or pattern: {spec}")
+    return paths
+
+
+def _parents(relative_path):
+    parts = relative_path.split("/")[:-1]
+    return ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+class FileStore:
+    """Content-addressed cache of attached files, shared between runs.
+
+    Files are stored as UTF-8 text with their token count, keyed by the sha256
+    of their bytes. A manifest maps each path to its size, mtime and hash, so an
+    unchanged file is taken from the store without being read, decoded or
+    tokenized again, and a file that only changed mtime (e.g. after a checkout)
+    is hashed but not tokenized again.
+    """
+
+    def __init__(self, directory=DEFAULT_FILE_CACHE_DIR):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._manifest = None
+        self._dirty = False
+
+    def _load_manifest(self):
+        if self._manifest is None:
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {}
+            if manifest.get("version") != FILE_CACHE_VERSION:
+                manifest = {"version": FILE_CACHE_VERSION, "files": {}}
+            self._manifest = manifest
+        return self._manifest["files"]
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], f"{digest}.json")
+
+    def _read_blob(self, digest):
+        try:
+            with open(self._blob_path(digest), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, path):
+        """Return (sha256, text, tokens) for the file at `path`, or (sha256, None, 0) if it is binary."""
+        stat = os.stat(path)
+        key = os.path.realpath(path)
+        with self._lock:
+            known = self._load_manifest().get(key)
+        if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            if known["binary"]:
+                with self._lock:
+                    self.hits += 1
+                return known["sha256"], None, 0
+            blob = self._read_blob(known["sha256"])
+            if blob is not None:
+                with self._lock:
+                    self.hits += 1
+                return known["sha256"], blob["text"], blob["tokens"]
+
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        binary = is_binary(data[:SNIFF_BYTES])
+        text, tokens = None, 0
+        if not binary:
+            blob = self._read_blob(digest)
+            if blob is None:
+                text = data.decode("utf-8", errors="replace")
+                tokens = count_tokens(text)
+                blob_path = self._blob_path(digest)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                write_file_atomic(blob_path, json.dumps({"text": text, "tokens": tokens}, ensure_ascii=False))
+            else:
+                text, tokens = blob["text"], blob["tokens"]
+        with self._lock:
+            self.misses += 1
+            self._load_manifest()[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest, "binary": binary}
+            self._dirty = True
+        return digest, text, tokens
+
+    def save(self):
+        """Write the manifest if anything was added since it was loaded."""
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            write_file_atomic(self.manifest_path, json.dumps(self._manifest, ensure_ascii=False))
+            self._dirty = False
+
+
+@dataclass
+class AttachedFile:
+    path: str
+    sha256: str
+    tokens: int
+    text: str
+
+
+@dataclass
+class Attachment:
+    # Set when a single file is too large to read whole and goes to large-input mode instead
+    input_file: str = None
+    files: list = field(default_factory=list)
+    # (path, reason) for files that were left out
+    skipped: list = field(default_factory=list)
+
+    @property
+    def total_tokens(self):
+        return sum(attached.tokens for attached in self.files)
+
+    @property
+    def file_content(self):
+        """The attached files as one text, or None if nothing was read."""
+        if not self.files:
+            return None
+        if len(self.files) == 1:
+            return self.files[0].text
+        return render_files((attached.path, attached.text) for attached in self.files)
+
+    def summary(self, max_listed=20):
+        if self.input_file is not None:
+            return f"{self.input_file} ({os.path.getsize(self.input_file)} bytes) will be processed in chunks."
+        lines = [f"Attached {len(self.files)} files ({self.total_tokens} tokens)"]
+        lines += [f"  {attached.path} ({attached.tokens} tokens)" for attached in self.files[:max_listed]]
+        if len(self.files) > max_listed:
+            lines.append(f"  ... and {len(self.files) - max_listed} more")
+        if self.skipped:
+            lines.append(f"Skipped {len(self.skipped)} files: " + ", ".join(f"{path} ({reason})" for path, reason in self.skipped[:max_listed]))
+        return "\n".join(lines)
+
+
+def render_files(files):
+    """Join (path, text) pairs into one text, each file wrapped in <file path="..."> tags."""
+    return "\n\n".join(f"{FILE_OPEN.format(path=path)}\n{text.rstrip()}\n{FILE_CLOSE}" for path, text in files)
+
+
+def split_files(text):
+    """Yield the (path, text) pairs of a text made by render_files; any other text is one (None, text) pair."""
+    if not text.startswith('<file path="'):
+        yield None, text
+        return
+    path = None
+    lines = []
+    for line in text.splitlines(keepends=True):
+        if path is None:
+            match = _FILE_OPEN.fullmatch(line.rstrip("\n"))
+            if match:
+                path = match.group(1)
+                lines = []
+        elif line.rstrip("\n") == FILE_CLOSE:
+            yield path, "".join(lines)
+            path = None
+        else:
+            lines.append(line)
+    if path is not None:
+        yield path, "".join(lines)
+
+
+def ingest(specs, store=None, max_workers=MAX_READ_WORKERS, max_file_bytes=MAX_FILE_BYTES):
+    """Read the files, directories and globs in `specs` in parallel into an Attachment.
+
+    Binary files are skipped, as are files over `max_file_bytes` unless they
+    were named directly. Files go through `store` (a FileStore, or one in the
+    default location), so unchanged files aren't read or tokenized again.
+    """
+    store = store if store is not None else FileStore()
+    attachment = Attachment()
+    paths = expand_paths(specs)
+
+    def load(path, explicit):
+        if not explicit and os.path.getsize(path) > max_file_bytes:
+            return path, "too large", None
+        try:
+            digest, text, tokens = store.load(path)
+        except OSError as e:
+            return path, str(e), None
+        if text is None:
+            return path, "binary", None
+        return path, None, AttachedFile(path, digest, tokens, text)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for path, reason, attached in executor.map(lambda item: load(*item), paths):
+            if attached is None:
+                attachment.skipped.append((path, reason))
+            else:
+                attachment.files.append(attached)
+    store.save()
+    return attachment
+
+
+def attach(specs, model, store=None):
+    """Attach files, directories and globs for a run on `model`.
+
+    A single file too large for one prompt is only named, so run() can read it
+    in chunks; anything else is ingested.
+    """
+    if len(specs) == 1 and os.path.isfile(specs[0]) and is_large_input(specs[0], model):
+        return Attachment(input_file=specs[0])
+    return ingest(specs, store)
+
+
+# "@" at the start of a word, possibly after an opening quote or bracket
+_MARKED_PATH = re.compile(r"(?<!\S)(['\"(\[]*)@(\S+)")
+
+
+def split_path_specs(text):
+    """Split a line of paths and globs, honoring shell quoting where it parses."""
+    try:
+        return shlex.split(text)
+    except ValueError:
+        return text.split()
+
+
+def extract_paths(objective):
+    """Pull the files, directories and globs marked with "@" out of a free-text objective.
+
+    Returns the objective without the "@" paths and the list of paths. Only
+    "@" words that match something on disk are taken; the filesystem root and
+    the home directory are never attached whole. Every other character of the
+    objective, whitespace included, is left as written.
+    """
+    specs = []
+
+    def take(match):
+        rest = match.group(2)
+        candidate = rest.rstrip("'\")],;:")
+        # A sentence may end right after the path
+        for path in (candidate, candidate.rstrip(".")):
+            if _names_path(path):
+                specs.append(path)
+                # Quotes or brackets around the path go with it; other punctuation stays
+                return rest[len(path):].lstrip("'\")]")
+        return match.group(0)
+
+    return _MARKED_PATH.sub(take, objective), specs
+
+
+def _names_path(path):
+    if not path:
+        return False
+    expanded = os.path.expanduser(path)
+    if glob.has_magic(expanded):
+        return bool(glob.glob(expanded, recursive=True))
+    if not os.path.exists(expanded):
+        return False
+    real = os.path.realpath(expanded)
+    return real != os.path.dirname(real) and real != os.path.realpath(os.path.expanduser("~"))
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+DEFAULT_CONCURRENCY = 2
+# How often idle workers look for jobs submitted by other processes
+POLL_INTERVAL = 2.0
+# Seconds a running job stays claimed without a heartbeat from its process; it is then taken over
+LEASE_SECONDS = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    objective TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    owner TEXT,
+    lease REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created);
+"""
+_COLUMNS = ("id", "objective", "params", "status", "result", "error", "created", "started", "finished")
+# Columns added after the first release, for databases created before them
+_ADDED_COLUMNS = (("owner", "TEXT"), ("lease", "REAL"))
+
+
+def _row(row):
+    if row is None:
+        return None
+    job = dict(zip(_COLUMNS, row))
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+    return job
+
+
+class JobQueue:
+    """A durable queue of objectives run by a pool of async workers in a background thread.
+
+    Jobs live in a SQLite database, so they survive a restart, and several
+    processes (e.g. web server workers) may share one. A running job holds a
+    lease its process renews every `lease_seconds / 3`; when the process stops,
+    the lease runs out and any worker takes the job over (the handler can
+    resume it from its checkpoint). All workers of a queue share one event
+    loop, and so one set of provider connection pools, and at most
+    `concurrency` jobs run at once. `handler(job)` is a coroutine returning a
+    JSON-serializable result.
+    """
+
+    def __init__(self, path, handler, concurrency=DEFAULT_CONCURRENCY, poll_interval=POLL_INTERVAL, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._claim_lock = threading.Lock()
+        self._thread = None
+        self._loop = None
+        self._wakeup = None
+        self._stopping = False
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+            existing = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+            for column, kind in _ADDED_COLUMNS:
+                if column not in existing:
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    @contextmanager
+    def _connect(self, isolation_level=""):
+        # One short-lived connection per operation, so any thread may use the queue
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=isolation_level)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def submit(self, objective, **params):
+        """Queue `objective` and return its job id at once."""
+        job_id = uuid.uuid4().hex
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, objective, params, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, objective, json.dumps(params), time.time()),
+            )
+        self._notify()
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as db:
+            return _row(db.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def recent(self, limit=20):
+        with self._connect() as db:
+            rows = db.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [_row(row) for row in rows]
+
+    def position(self, job_id):
+        """How many queued jobs are ahead of `job_id`."""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created < (SELECT created FROM jobs WHERE id = ?)",
+                (job_id,),
+            ).fetchone()
+        return row[0]
+
+    def _claim(self):
+        # The lock keeps this process's workers apart; BEGIN IMMEDIATE keeps other processes out
+        with self._claim_lock, self._connect(isolation_level=None) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                # Queued jobs, and running ones whose process stopped renewing the lease (or predates leases)
+                row = db.execute(
+                    f"SELECT {', '.join(_COLUMNS)} FROM jobs"
+                    " WHERE status = 'queued' OR (status = 'running' AND (lease IS NULL OR lease < ?))"
+                    " ORDER BY created LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', started = ?, owner = ?, lease = ? WHERE id = ?",
+                        (now, self.owner, now + self.lease_seconds, row[0]),
+                    )
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        job = _row(row)
+        if job is not None:
+            job["status"] = "running"
+        return job
+
+    def _finish(self, job_id, result=None, error=None):
+        # Only while this process still holds the job: one that lost its lease must not overwrite the new run
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, lease = NULL WHERE id = ? AND owner = ?",
+                ("error" if error is not None else "done", json.dumps(result) if error is None else None, error, time.time(), job_id, self.owner),
+            )
+
+    def _renew(self):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET lease = ? WHERE owner = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, self.owner),
+            )
+
+    def start(self):
+        """Start the workers; jobs of processes that stopped are taken over once their lease expires."""
+        if self._thread is not None:
+            return
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name="maestro-jobs", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self, timeout=None):
+        """Stop taking new jobs and wait for the running ones."""
+        self._stopping = True
+        self._notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _notify(self):
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # The loop closed in the meantime
+                pass
+
+    def _run_loop(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        ready.set()
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._loop.close()
+            self._loop = None
+
+    async def _serve(self):
+        heartbeat = asyncio.ensure_future(self._heartbeat())
+        try:
+            await asyncio.gather(*(self._worker() for _ in range(self.concurrency)))
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self._renew)
+            except sqlite3.Error:
+                # Retried on the next beat, well before the lease runs out
+                pass
+
+    async def _worker(self):
+        # SQLite calls may wait on other processes' locks; run them off the loop the jobs stream on
+        while not self._stopping:
+            self._wakeup.clear()
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                result = await self.handler(job)
+            except Exception as e:
+                await asyncio.to_thread(self._finish, job["id"], error=f"{type(e).__name__}: {e}\n{traceback.format_exc()}")
+            else:
+                await asyncio.to_thread(self._finish, job["id"], result=result)
@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+import time
+
+from .events import emit
+
+JOURNAL_SUFFIX = ".jsonl"
+
+
+class RunJournal:
+    """Append-only JSONL log of one run, one line per orchestrator, sub-agent or refiner event.
+
+    Every event is written and flushed to disk as soon as it happens, so a crash
+    or Ctrl-C keeps everything recorded up to that point. The file is reopened
+    in append mode for each event; that costs far less than the model call that
+    produced it and leaves no handle to close when a run is interrupted.
+    """
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, event, **fields):
+        record = {"event": event, "time": round(time.time(), 3), **fields}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        emit(event, **fields)
+        return record
+
+
+def read_journal(path):
+    """Yield the events of a journal in order, skipping a torn last line left by a crash."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def render_report(journal_path, report_path):
+    """Write the Markdown exchange log for a run from its journal.
+
+    Events are streamed from the journal to the report one at a time, so the
+    log is never held in memory as a whole.
+    """
+    task_number = 0
+    breakdown_started = False
+    with open(report_path, "w", encoding="utf-8") as report:
+        for record in read_journal(journal_path):
+            event = record["event"]
+            if event == "objective":
+                report.write(f"Objective: {record['objective']}\n\n")
+            elif event == "sub_agent":
+                if not breakdown_started:
+                    report.write("=" * 40 + " Task Breakdown " + "=" * 40 + "\n\n")
+                    breakdown_started = True
+                task_number += 1
+                report.write(f"Task {task_number}:\n")
+                report.write(f"Prompt: {record['task']}\n")
+                report.write(f"Result: {record['result']}\n\n")
+            elif event == "refiner":
+                if not breakdown_started:
+                    report.write("=" * 40 + " Task Breakdown " + "=" * 40 + "\n\n")
+                    breakdown_started = True
+                report.write("=" * 40 + " Refined Final Output " + "=" * 40 + "\n\n")
+                report.write(record["output"])
+    return report_path
@@ -0,0 +1,240 @@
+import asyncio
+import codecs
+import mmap
+import os
+from collections import deque
+from dataclasses import dataclass
+
+from .budget import count_tokens, token_budget
+
+# Files estimated above this share of the sub-agent's input window are mapped chunk by chunk
+LARGE_INPUT_FRACTION = 0.5
+# Rough size of a token on disk, used to decide without reading the file
+BYTES_PER_TOKEN = 4
+DEFAULT_CHUNK_TOKENS = 8000
+DEFAULT_OVERLAP_TOKENS = 200
+DEFAULT_MAX_CONCURRENCY = 4
+NOTES_MAX_TOKENS = 1024
+READ_BLOCK_BYTES = 1024 * 1024
+# How much of an attached file is shown on the console
+PREVIEW_CHARS = 2000
+
+MAP_PROMPT = (
+    "You are reading part {number} of a large file, lines {start_line}-{end_line}. Consecutive parts overlap "
+    "by a few lines. Extract everything in this part that is relevant to the objective below: facts, names, "
+    "errors, numbers, code signatures and anything unusual. Be concise and don't speculate about the parts "
+    "you can't see.\n\nObjective: {objective}\n\nFile part:\n{text}"
+)
+REDUCE_PROMPT = (
+    "The notes below were taken from consecutive parts of a large file, in order. Merge them into one set of "
+    "notes relevant to the objective, removing duplicates caused by the overlap between parts and keeping "
+    "every distinct fact, name, error and number.\n\nObjective: {objective}\n\n{notes}"
+)
+
+
+@dataclass
+class Chunk:
+    index: int
+    start_line: int
+    end_line: int
+    text: str
+
+
+def estimated_tokens(path):
+    return os.path.getsize(path) // BYTES_PER_TOKEN
+
+
+def is_large_input(path, model, fraction=LARGE_INPUT_FRACTION):
+    """Whether the file at `path` is too big to paste into one prompt for `model`."""
+    return estimated_tokens(path) > token_budget(model).input_limit * fraction
+
+
+def preview(text, limit=PREVIEW_CHARS):
+    """The start of `text` for display, noting how much was left out."""
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}\n... ({len(text) - limit} more characters)"
+
+
+def iter_lines(path, block_bytes=READ_BLOCK_BYTES):
+    """Yield the lines of a UTF-8 text file, keeping line endings, through a read-only memory map.
+
+    Only one block and the current line are decoded at a time, so memory use
+    doesn't depend on the size of the file.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        partial = ""
+        for start in range(0, len(mapped), block_bytes):
+            text = partial + decoder.decode(mapped[start:start + block_bytes])
+            *lines, partial = text.split("\n")
+            for line in lines:
+                yield line + "\n"
+        partial += decoder.decode(b"", final=True)
+        if partial:
+            yield partial
+
+
+def _split_long_line(line, tokens, max_tokens, count):
+    # Hard-wrap a single line that doesn't fit in a chunk on its own
+    while tokens > max_tokens:
+        cut = max(1, len(line) * max_tokens // tokens)
+        piece = line[:cut]
+        yield piece, count(piece)
+        line = line[cut:]
+        tokens = count(line)
+    if line:
+        yield line, tokens
+
+
+def chunk_lines(lines, max_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_OVERLAP_TOKENS, count_tokens=count_tokens):
+    """Group `lines` (with their line endings) into chunks of at most `max_tokens`.
+
+    Each chunk starts with the last lines of the one before it, up to
+    `overlap_tokens`, so nothing spanning a boundary is seen only in halves.
+    Chunks are produced lazily as the lines are consumed.
+    """
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    window = deque()
+    used = 0
+    fresh = False
+    index = 0
+    line_number = 0
+
+    def emit():
+        return Chunk(index, window[0][2], window[-1][2], "".join(line for line, _, _ in window))
+
+    for raw_line in lines:
+        line_number += 1
+        for line, tokens in _split_long_line(raw_line, count_tokens(raw_line), max_tokens, count_tokens):
+            if used + tokens > max_tokens and fresh:
+                yield emit()
+                index += 1
+                # Carry the tail of this chunk over as the head of the next one
+                while window and (used > overlap_tokens or used + tokens > max_tokens):
+                    _, dropped, _ = window.popleft()
+                    used -= dropped
+                fresh = False
+            window.append((line, tokens, line_number))
+            used += tokens
+            fresh = True
+    if fresh:
+        yield emit()
+
+
+def iter_chunks(path, max_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_OVERLAP_TOKENS, count_tokens=count_tokens):
+    """Split the file at `path` into overlapping chunks of at most `max_tokens`, reading it lazily."""
+    return chunk_lines(iter_lines(path), max_tokens, overlap_tokens, count_tokens)
+
+
+async def map_chunks(chunks, map_chunk, max_concurrency=DEFAULT_MAX_CONCURRENCY, done=None, on_mapped=None):
+    """Run `map_chunk(chunk)` for every chunk with at most `max_concurrency` at once.
+
+    Chunks are pulled from the iterator only as workers free up, so at most
+    `max_concurrency` of them are in memory. Results in `done` (by chunk index,
+    e.g. from a checkpoint) are reused; `on_mapped(chunk, result)` is called as
+    each new one finishes. Returns the results in chunk order.
+    """
+    done = done or {}
+    results = {}
+    chunks = iter(chunks)
+
+    async def worker():
+        for chunk in chunks:
+            if str(chunk.index) in done:
+                results[chunk.index] = done[str(chunk.index)]
+                continue
+            result = await map_chunk(chunk)
+            results[chunk.index] = result
+            if on_mapped is not None:
+                on_mapped(chunk, result)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, max_concurrency))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Don't leave the other workers mapping chunks after one has failed
+        for task in workers:
+            task.cancel()
+        raise
+    return [results[index] for index in sorted(results)]
+
+
+async def reduce_notes(notes, reduce, max_tokens, count_tokens=count_tokens, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Merge `notes` with `reduce(batch)` until a single text is left.
+
+    Consecutive notes are grouped into batches of at most `max_tokens` and each
+    batch is reduced in parallel; that repeats level by level, so any number of
+    notes is reduced in a logarithmic number of rounds.
+    """
+    notes = [note for note in notes if note.strip()]
+    if not notes:
+        return ""
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def reduce_batch(batch):
+        async with semaphore:
+            return await reduce(batch)
+
+    while len(notes) > 1:
+        batches = [[]]
+        used = 0
+        for note in notes:
+            tokens = count_tokens(note)
+            # Every batch merges at least two notes, so each round makes progress
+            if len(batches[-1]) >= 2 and used + tokens > max_tokens:
+                batches.append([])
+                used = 0
+            batches[-1].append(note)
+            used += tokens
+        if len(batches[-1]) == 1 and len(batches) > 1:
+            last = batches.pop()
+            batches[-1] += last
+        notes = await asyncio.gather(*(reduce_batch(batch) for batch in batches))
+    return notes[0]
+
+
+def chunk_mapper(provider, model, objective, max_tokens=NOTES_MAX_TOKENS, **params):
+    """Build a map_chunk(chunk) coroutine that takes notes on one chunk with `model`."""
+    async def map_chunk(chunk):
+        prompt = MAP_PROMPT.format(number=chunk.index + 1, start_line=chunk.start_line, end_line=chunk.end_line, objective=objective, text=chunk.text)
+        response = await provider.complete(model, [{"role": "user", "content": prompt}], max_tokens=max_tokens, **params)
+        return response.text.strip()
+    return map_chunk
+
+
+def notes_reducer(provider, model, objective, max_tokens=NOTES_MAX_TOKENS * 2, **params):
+    """Build a reduce(notes) coroutine that merges a batch of notes with `model`."""
+    async def reduce(notes):
+        text = "\n\n".join(f"Notes {number}:\n{note}" for number, note in enumerate(notes, 1))
+        prompt = REDUCE_PROMPT.format(objective=objective, notes=text)
+        response = await provider.complete(model, [{"role": "user", "content": prompt}], max_tokens=max_tokens, **params)
+        return response.text.strip()
+    return reduce
+
+
+async def digest_large_input(path, provider, model, objective, console=None, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                             chunk_tokens=DEFAULT_CHUNK_TOKENS, overlap_tokens=DEFAULT_OVERLAP_TOKENS,
+                             done=None, on_mapped=None, **params):
+    """Reduce a file too big for one prompt to notes relevant to `objective`.
+
+    The file is read lazily and split into overlapping chunks sized for
+    `model`; each chunk is summarized by its own sub-agent call, in parallel,
+    and the notes are merged into one text that stands in for the file content.
+    """
+    budget = token_budget(model)
+    chunk_tokens = min(chunk_tokens, budget.input_limit // 2)
+    chunks = iter_chunks(path, chunk_tokens, overlap_tokens, budget.count)
+    map_chunk = chunk_mapper(provider, model, objective, **params)
+
+    def mapped(chunk, result):
+        if console is not None:
+            console.print(f"Mapped part {chunk.index + 1} of {path} (lines {chunk.start_line}-{chunk.end_line})", style="blue")
+        if on_mapped is not None:
+            on_mapped(chunk, result)
+
+    notes = await map_chunks(chunks, map_chunk, max_concurrency, done, mapped)
+    reduce = notes_reducer(provider, model, objective, **params)
+    return await reduce_notes(notes, reduce, chunk_tokens, budget.count, max_concurrency)
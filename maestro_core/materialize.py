@@ -0,0 +1,220 @@
+import os
+import re
+import tempfile
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from .events import current_emitter
+
+MAX_WRITE_WORKERS = 16
+
+
+def _path_parts(path):
+    parts = [part for part in path.replace("\\", "/").split("/") if part and part != "."]
+    return tuple(parts)
+
+
+@dataclass
+class MaterializeResult:
+    project_dir: str
+    folders: list = field(default_factory=list)
+    files: list = field(default_factory=list)
+    # Files in the structure without a matching code block
+    missing: list = field(default_factory=list)
+    # (path, error message) for folders and files that couldn't be written
+    errors: list = field(default_factory=list)
+    # Code blocks that no file in the structure asked for
+    unused: list = field(default_factory=list)
+
+    def summary(self):
+        lines = [f"Project folder: [bold]{self.project_dir}[/bold]",
+                 f"Created {len(self.folders)} folders and {len(self.files)} files"]
+        if self.missing:
+            lines.append(f"Code content not found for {len(self.missing)} files: " + ", ".join(self.missing))
+        if self.unused:
+            lines.append(f"{len(self.unused)} code blocks not in the folder structure: " + ", ".join(self.unused))
+        for path, error in self.errors:
+            lines.append(f"Error writing [bold]{path}[/bold]: {error}")
+        return "\n".join(lines)
+
+
+def project_path(output_dir, project_name):
+    """The folder for `project_name` inside `output_dir`.
+
+    The name comes from the model, so it is reduced to a single folder name
+    of word characters, single dots and dashes that can't start with a dot.
+    """
+    name = re.sub(r"\.{2,}", ".", re.sub(r"[^\w.-]+", "_", project_name)).lstrip(".")
+    path = os.path.join(output_dir, name or "project")
+    root = os.path.realpath(output_dir)
+    if os.path.commonpath([root, os.path.realpath(path)]) != root:
+        raise ValueError(f"Project folder {project_name!r} is outside {output_dir}")
+    return path
+
+
+def write_file_atomic(path, content):
+    """Write `content` to a temp file next to `path` and rename it into place.
+
+    Readers see either the old file or the complete new one, never a partial write.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ProjectWriter:
+    """Writes project files as soon as both their place in the folder structure and their code are known.
+
+    Feed it the project folder, the folder structure and code blocks in any
+    order, e.g. straight from a streaming parser. Each file is written by a
+    thread pool, atomically, while the rest of the output is still arriving.
+
+    A code block is matched to a file in the structure on the longest suffix of
+    its path ("src/app/main.py", then "app/main.py", then "main.py") that names
+    a file not written yet. Full paths map exactly, and repeated bare basenames
+    go to the matching files in structure order instead of all getting the same
+    block. Each lookup costs the depth of the path.
+    """
+
+    def __init__(self, project_dir=None, max_workers=MAX_WRITE_WORKERS):
+        self.project_dir = project_dir
+        self.max_workers = max_workers
+        self.structure = None
+        self.result = None
+        self._started = False
+        self._waiting = []
+        self._files = []
+        self._paths = {}
+        self._by_suffix = defaultdict(deque)
+        self._written = set()
+        self._unused = []
+        self._executor = None
+        self._futures = []
+
+    def set_project_dir(self, project_dir):
+        # Files may already be going to the old folder once writing has started
+        if not self._started:
+            self.project_dir = project_dir
+            self._maybe_start()
+
+    def set_structure(self, structure):
+        if not self._started:
+            self.structure = structure or {}
+            self._maybe_start()
+
+    def add_file(self, name, content):
+        if self._started:
+            self._write(name, content)
+        else:
+            self._waiting.append((name, content))
+
+    def _maybe_start(self):
+        if self.project_dir is None or self.structure is None:
+            return
+        self._started = True
+        self.result = MaterializeResult(self.project_dir)
+        try:
+            os.makedirs(self.project_dir, exist_ok=True)
+        except OSError as e:
+            self.result.errors.append((self.project_dir, str(e)))
+            self.structure = {}
+        self._walk(self.project_dir, "", self.structure, os.path.realpath(self.project_dir))
+        for relative_path, _ in self._files:
+            parts = _path_parts(relative_path)
+            for start in range(len(parts)):
+                self._by_suffix[parts[start:]].append(relative_path)
+        self._paths = dict(self._files)
+        waiting, self._waiting = self._waiting, []
+        for name, content in waiting:
+            self._write(name, content)
+
+    def _walk(self, current_path, relative, structure, root):
+        # Folders are created up front, in the order the structure lists them
+        for key, value in structure.items():
+            path = os.path.join(current_path, key)
+            relative_path = f"{relative}/{key}" if relative else key
+            # Refuse names like "../x" or absolute paths that would land outside the project
+            if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                self.result.errors.append((path, "path is outside the project folder"))
+                continue
+            if isinstance(value, dict):
+                try:
+                    os.makedirs(path, exist_ok=True)
+                except OSError as e:
+                    self.result.errors.append((path, str(e)))
+                    continue
+                self.result.folders.append(path)
+                self._walk(path, relative_path, value, root)
+            else:
+                self._files.append((relative_path, path))
+
+    def _claim(self, name):
+        parts = _path_parts(name)
+        for start in range(len(parts)):
+            candidates = self._by_suffix.get(parts[start:])
+            while candidates and candidates[0] in self._written:
+                candidates.popleft()
+            if candidates:
+                relative_path = candidates.popleft()
+                self._written.add(relative_path)
+                return self._paths[relative_path]
+        return None
+
+    def _write(self, name, content):
+        path = self._claim(name)
+        if path is None:
+            self._unused.append(name)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+        future = self._executor.submit(write_file_atomic, path, content)
+        # Report each file as soon as it is on disk, from the writer thread
+        emit = current_emitter()
+        future.add_done_callback(
+            lambda done: emit("file", path=path, error=str(done.exception()) if done.exception() else None)
+        )
+        self._futures.append((path, future))
+
+    def finish(self, project_dir=None):
+        """Write whatever is left (into `project_dir` if no folder was set), wait and return a MaterializeResult."""
+        if not self._started:
+            if self.project_dir is None:
+                self.project_dir = project_dir
+            if self.structure is None:
+                self.structure = {}
+            self._maybe_start()
+        for path, future in self._futures:
+            try:
+                future.result()
+                self.result.files.append(path)
+            except OSError as e:
+                self.result.errors.append((path, str(e)))
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.result.missing = [relative_path for relative_path, _ in self._files if relative_path not in self._written]
+        self.result.unused = list(self._unused)
+        return self.result
+
+
+def materialize_project(project_dir, folder_structure, code_blocks, max_workers=MAX_WRITE_WORKERS):
+    """Create `folder_structure` under `project_dir` and write each file's code block into it.
+
+    Folders are created first, then all files are written concurrently, each
+    atomically. Nothing is printed; the returned MaterializeResult has a
+    one-panel summary of what was written, missing or failed.
+    """
+    writer = ProjectWriter(project_dir, max_workers)
+    writer.set_structure(folder_structure)
+    for name, content in code_blocks:
+        writer.add_file(name, content)
+    return writer.finish()
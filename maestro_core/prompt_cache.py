@@ -0,0 +1,49 @@
+# Anthropic caches the prompt prefix that ends at each block marked with cache_control.
+# Other providers ignore the marker (content blocks are flattened to plain text).
+CACHE_CONTROL = {"type": "ephemeral"}
+# Anthropic accepts at most this many breakpoints per request
+MAX_CACHE_BREAKPOINTS = 4
+
+
+def text_block(text, cache=False):
+    block = {"type": "text", "text": text}
+    if cache:
+        block["cache_control"] = dict(CACHE_CONTROL)
+    return block
+
+
+def history_blocks(header, items, empty="None"):
+    """`header` and one text block per history item, with a cache breakpoint on the last block.
+
+    A later call whose history extends this one shares every block up to the
+    old last item, so the provider finds the cached prefix at that boundary.
+    An empty history gets no breakpoint: the prefix would be too short to
+    cache and would use up one of the few a request may have.
+    """
+    items = [item for item in items if item]
+    if not items:
+        return [text_block(f"{header}\n{empty}")]
+    blocks = [text_block(f"{header}\n{items[0]}")] + [text_block(f"\n{item}") for item in items[1:]]
+    blocks[-1]["cache_control"] = dict(CACHE_CONTROL)
+    return blocks
+
+
+def limit_breakpoints(system, messages, limit=MAX_CACHE_BREAKPOINTS):
+    """`system` and `messages` with only the last `limit` cache breakpoints kept.
+
+    The prompt builders mark every stable prefix, which can add up to more
+    breakpoints than Anthropic accepts. Later breakpoints cover the longest
+    prefixes, so the earliest ones are dropped. Blocks are copied, not changed.
+    """
+    contents = [system] + [message["content"] for message in messages]
+    marked = [block for content in contents if isinstance(content, list) for block in content if "cache_control" in block]
+    if len(marked) <= limit:
+        return system, messages
+    dropped = {id(block) for block in marked[:len(marked) - limit]}
+
+    def strip(content):
+        if not isinstance(content, list):
+            return content
+        return [{key: value for key, value in block.items() if key != "cache_control"} if id(block) in dropped else block for block in content]
+
+    return strip(system), [dict(message, content=strip(message["content"])) for message in messages]
@@ -0,0 +1,659 @@
+import asyncio
+import contextlib
+import itertools
+import os
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .budget import context_window, count_tokens, token_budget
+from .cache import cache_key
+from .prompt_cache import limit_breakpoints
+from .ratelimit import get_rate_limiter, handle_retryable
+
+# Connection pool settings shared by every provider. Connections are kept alive
+# between calls so orchestrator, sub-agent and refiner requests reuse the same
+# TLS sessions instead of paying a new handshake each time.
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 120.0
+REQUEST_TIMEOUT = 600.0
+CONNECT_TIMEOUT = 10.0
+
+# Retries are done by maestro_core.ratelimit so they respect the shared limits;
+# the SDKs' own retry loops are turned off to avoid retrying twice.
+SDK_CLIENT_DEFAULTS = {"max_retries": 0}
+
+# One pool per (event loop, key). httpx async clients can't be shared across loops.
+_http_pools = weakref.WeakKeyDictionary()
+
+
+@dataclass
+class Completion:
+    text: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    # Normalized to "stop" or "length"; the provider's own value is kept in raw_stop_reason
+    stop_reason: Optional[str] = None
+    raw_stop_reason: Optional[str] = None
+    latency: float = 0.0
+    model: str = ""
+    # Prompt-cache usage where the API reports it (Anthropic: not included in input_tokens)
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    extra: dict = field(default_factory=dict)
+
+    @property
+    def truncated(self):
+        return self.stop_reason == "length"
+
+
+def _pool_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _pool_timeout():
+    import httpx
+    return httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def shared_http_client(key="default"):
+    """Return the keep-alive httpx.AsyncClient for `key` on the running event loop."""
+    import httpx
+    loop = asyncio.get_running_loop()
+    pools = _http_pools.setdefault(loop, {})
+    client = pools.get(key)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(limits=_pool_limits(), timeout=_pool_timeout())
+        pools[key] = client
+    return client
+
+
+async def aclose_http_clients():
+    loop = asyncio.get_running_loop()
+    pools = _http_pools.pop(loop, {})
+    for client in pools.values():
+        if not client.is_closed:
+            await client.aclose()
+
+
+def _normalize_stop_reason(reason):
+    if reason in ("max_tokens", "length"):
+        return "length"
+    return "stop" if reason else None
+
+
+def _block_text(content):
+    if isinstance(content, list):
+        return "\n".join(block["text"] for block in content if block.get("type") == "text")
+    return content
+
+
+def _split_system(messages, system=None):
+    # Accept OpenAI-style system messages and move them to a separate system prompt
+    rest = [message for message in messages if message["role"] != "system"]
+    system_parts = [_block_text(message["content"]) for message in messages if message["role"] == "system"]
+    if isinstance(system, list) and not any(system_parts):
+        # Content blocks (e.g. with cache_control breakpoints) are passed through as they are
+        return system, rest
+    system_parts = [_block_text(system)] + system_parts if system else system_parts
+    return "\n\n".join(part for part in system_parts if part) or None, rest
+
+
+def _flatten_content(messages):
+    # Anthropic-style content blocks -> plain strings for OpenAI-compatible APIs
+    flat = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            content = "".join(block["text"] for block in content if block.get("type") == "text")
+        flat.append({"role": message["role"], "content": content})
+    return flat
+
+
+class CompletionStream:
+    """Async iterator over the text deltas of a streamed completion.
+
+    Once iteration ends (or the stream is closed early with `aclose`), the
+    `completion` attribute holds the assembled `Completion`.
+    """
+
+    def __init__(self, events, model, messages=(), system=None):
+        self._events = events
+        self.model = model
+        self._prompt = (messages, system)
+        self.text = ""
+        self.completion = None
+        self.first_token_latency = None
+        self._start = time.perf_counter()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        async for event in self._events:
+            if isinstance(event, Completion):
+                self.completion = event
+                continue
+            if self.first_token_latency is None:
+                self.first_token_latency = time.perf_counter() - self._start
+            self.text += event
+            yield event
+        self._finish()
+
+    async def aclose(self, reason="cancelled"):
+        # Closing the generator closes the HTTP response, so the server stops generating
+        await self._events.aclose()
+        self._finish(reason)
+
+    def _finish(self, reason=None):
+        if self.completion is None:
+            self.completion = Completion(text="", stop_reason="stop" if reason else None, raw_stop_reason=reason)
+        completion = self.completion
+        completion.text = self.text
+        completion.model = self.model
+        completion.latency = time.perf_counter() - self._start
+        completion.extra.setdefault("first_token_latency", self.first_token_latency)
+        # Some servers don't report usage for streams (or we stopped early)
+        if not completion.input_tokens and not completion.cache_read_tokens:
+            completion.input_tokens = token_budget(self.model).count_messages(*self._prompt)
+        if not completion.output_tokens and self.text:
+            completion.output_tokens = count_tokens(self.text, self.model)
+
+
+class Provider:
+    """Base class for async chat-completion backends.
+
+    Subclasses build their SDK client lazily, once per event loop, on top of a
+    pooled HTTP client, and translate responses into a `Completion`. `stream`
+    yields text deltas as they arrive. With a `ResponseCache`, identical
+    requests are answered from disk. With a scheduler (e.g. a
+    ModelAffinityScheduler), every request waits for a slot for its model.
+    """
+
+    name = "base"
+    pool_key = "default"
+
+    def __init__(self, cache=None, scheduler=None, **client_kwargs):
+        self.client_kwargs = client_kwargs
+        self.cache = cache
+        self.scheduler = scheduler
+        self._clients = weakref.WeakKeyDictionary()
+
+    @property
+    def endpoint(self):
+        return self.client_kwargs.get("base_url", "")
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._make_client()
+            self._clients[loop] = client
+        return client
+
+    def _make_client(self):
+        raise NotImplementedError
+
+    def _slot(self, model):
+        return self.scheduler.slot(model) if self.scheduler is not None else contextlib.nullcontext()
+
+    async def has_model(self, model):
+        """Whether `model` can be called; hosted APIs are taken to serve every model they are asked for."""
+        return True
+
+    async def pull_model(self, model):
+        raise NotImplementedError(f"{self.name} cannot download models")
+
+    async def _create(self, model, messages, system, max_tokens, params):
+        raise NotImplementedError
+
+    def _stream(self, model, messages, system, max_tokens, params):
+        """Async generator of text deltas, ending with a Completion carrying usage and stop reason."""
+        raise NotImplementedError
+
+    def supports_prefill(self, model):
+        """Whether a trailing assistant message is continued rather than treated as a finished turn."""
+        return False
+
+    @property
+    def rate_limit_key(self):
+        # Self-hosted OpenAI-compatible servers get their own (unlimited) key
+        return f"{self.name}:{self.endpoint}" if self.endpoint else self.name
+
+    def _cache_key(self, model, messages, system, max_tokens, params):
+        return cache_key(self.name, self.endpoint, model, messages, system, max_tokens, params)
+
+    def _reserved_tokens(self, model, messages, system, max_tokens):
+        # Counted against tokens-per-minute up front; the unused part is refunded afterwards
+        return token_budget(model).count_messages(messages, system) + (max_tokens or 0)
+
+    async def _create_with_retries(self, model, messages, system, max_tokens, params):
+        limiter = get_rate_limiter(self.rate_limit_key, model)
+        reserved = self._reserved_tokens(model, messages, system, max_tokens) if limiter else 0
+        for attempt in itertools.count():
+            # Only what the limiter actually took is refunded, which is less than `reserved` for requests over its capacity
+            taken = await limiter.acquire(reserved) if limiter else 0
+            try:
+                async with self._slot(model):
+                    completion = await self._create(model, messages, system, max_tokens, dict(params))
+            except Exception as e:
+                if limiter:
+                    limiter.refund(taken)
+                await handle_retryable(e, attempt, limiter)
+                continue
+            if limiter:
+                limiter.refund(taken - completion.input_tokens - completion.cache_write_tokens - completion.output_tokens)
+            return completion
+
+    async def _stream_with_retries(self, model, messages, system, max_tokens, params):
+        # A failed stream can only be retried before its first delta reaches the caller
+        limiter = get_rate_limiter(self.rate_limit_key, model)
+        reserved = self._reserved_tokens(model, messages, system, max_tokens) if limiter else 0
+        for attempt in itertools.count():
+            taken = await limiter.acquire(reserved) if limiter else 0
+            events = self._stream(model, messages, system, max_tokens, dict(params))
+            started = False
+            deltas = []
+            try:
+                # The slot is held until the stream ends, including while the caller consumes it
+                async with self._slot(model):
+                    async for event in events:
+                        if isinstance(event, Completion):
+                            if limiter:
+                                limiter.refund(taken - event.input_tokens - event.cache_write_tokens - event.output_tokens)
+                                taken = 0
+                        else:
+                            started = True
+                            if limiter:
+                                deltas.append(event)
+                        yield event
+                return
+            except Exception as e:
+                if limiter:
+                    limiter.refund(taken)
+                    taken = 0
+                if started:
+                    raise
+                await handle_retryable(e, attempt, limiter)
+            finally:
+                await events.aclose()
+                if limiter and taken:
+                    # Closed before the usage arrived (an early stop): give back all but the prompt and the text so far
+                    used = reserved - (max_tokens or 0) + token_budget(model).count("".join(deltas))
+                    limiter.refund(taken - used)
+
+    async def complete(self, model, messages, system=None, max_tokens=4096, **params):
+        start = time.perf_counter()
+        key = self._cache_key(model, messages, system, max_tokens, params) if self.cache else None
+        completion = _cached_completion(self.cache, key)
+        if completion is None:
+            completion = await self._create_with_retries(model, messages, system, max_tokens, params)
+            _store_completion(self.cache, key, completion)
+        completion.latency = time.perf_counter() - start
+        completion.model = model
+        return completion
+
+    def stream(self, model, messages, system=None, max_tokens=4096, **params):
+        make_events = lambda: self._stream_with_retries(model, messages, system, max_tokens, params)
+        if self.cache is None:
+            events = make_events()
+        else:
+            key = self._cache_key(model, messages, system, max_tokens, params)
+            events = _cached_events(self.cache, key, make_events)
+        return CompletionStream(events, model, messages, system)
+
+
+def _cached_completion(cache, key):
+    entry = cache.get(key) if cache else None
+    if entry is None:
+        return None
+    completion = Completion(**entry)
+    completion.extra["cached"] = True
+    return completion
+
+
+def _store_completion(cache, key, completion):
+    # Responses cut short on our side are partial and must not be replayed
+    if cache and completion.raw_stop_reason != "early_stop":
+        cache.put(key, {
+            "text": completion.text,
+            "input_tokens": completion.input_tokens,
+            "output_tokens": completion.output_tokens,
+            "cache_read_tokens": completion.cache_read_tokens,
+            "cache_write_tokens": completion.cache_write_tokens,
+            "stop_reason": completion.stop_reason,
+            "raw_stop_reason": completion.raw_stop_reason,
+        })
+
+
+async def _cached_events(cache, key, make_events):
+    completion = _cached_completion(cache, key)
+    if completion is not None:
+        yield completion.text
+        yield completion
+        return
+    text = ""
+    async for event in make_events():
+        if isinstance(event, Completion):
+            # Only streams that ran to the end are stored; aclose() never gets here
+            event.text = text
+            _store_completion(cache, key, event)
+        else:
+            text += event
+        yield event
+
+
+class AnthropicProvider(Provider):
+    name = "anthropic"
+    pool_key = "anthropic"
+
+    def supports_prefill(self, model):
+        return True
+
+    def _make_client(self):
+        from anthropic import AsyncAnthropic
+        return AsyncAnthropic(http_client=shared_http_client(self.pool_key), **dict(SDK_CLIENT_DEFAULTS, **self.client_kwargs))
+
+    def _request(self, model, messages, system, max_tokens, params):
+        system, messages = limit_breakpoints(*_split_system(messages, system))
+        if system:
+            params["system"] = system
+        return dict(model=model, max_tokens=max_tokens or 4096, messages=messages, **params)
+
+    @staticmethod
+    def _completion(message, text=""):
+        return Completion(
+            text=text,
+            input_tokens=message.usage.input_tokens,
+            output_tokens=message.usage.output_tokens,
+            cache_read_tokens=getattr(message.usage, "cache_read_input_tokens", None) or 0,
+            cache_write_tokens=getattr(message.usage, "cache_creation_input_tokens", None) or 0,
+            stop_reason=_normalize_stop_reason(message.stop_reason),
+            raw_stop_reason=message.stop_reason,
+        )
+
+    async def _create(self, model, messages, system, max_tokens, params):
+        response = await self.client().messages.create(**self._request(model, messages, system, max_tokens, params))
+        text = "".join(block.text for block in response.content if block.type == "text")
+        return self._completion(response, text)
+
+    async def _stream(self, model, messages, system, max_tokens, params):
+        async with self.client().messages.stream(**self._request(model, messages, system, max_tokens, params)) as stream:
+            async for text in stream.text_stream:
+                yield text
+            message = await stream.get_final_message()
+        yield self._completion(message)
+
+
+class OpenAIProvider(Provider):
+    """OpenAI and any OpenAI-compatible server (LM Studio, vLLM, ...)."""
+
+    name = "openai"
+
+    def __init__(self, **client_kwargs):
+        super().__init__(**client_kwargs)
+        self.pool_key = f"{self.name}:{client_kwargs.get('base_url', '')}"
+        # Only the official API is known to accept stream_options
+        self.stream_usage = "base_url" not in client_kwargs
+
+    def _make_client(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(http_client=shared_http_client(self.pool_key), **dict(SDK_CLIENT_DEFAULTS, **self.client_kwargs))
+
+    def _request(self, model, messages, system, max_tokens, params):
+        if system:
+            messages = [{"role": "system", "content": system}] + list(messages)
+        if max_tokens:
+            params["max_tokens"] = max_tokens
+        return dict(model=model, messages=_flatten_content(messages), **params)
+
+    async def _create(self, model, messages, system, max_tokens, params):
+        response = await self.client().chat.completions.create(**self._request(model, messages, system, max_tokens, params))
+        choice = response.choices[0]
+        usage = response.usage
+        return Completion(
+            text=choice.message.content or "",
+            input_tokens=usage.prompt_tokens if usage else 0,
+            output_tokens=usage.completion_tokens if usage else 0,
+            stop_reason=_normalize_stop_reason(choice.finish_reason),
+            raw_stop_reason=choice.finish_reason,
+        )
+
+    async def _stream(self, model, messages, system, max_tokens, params):
+        request = self._request(model, messages, system, max_tokens, params)
+        if self.stream_usage:
+            request["stream_options"] = {"include_usage": True}
+        stream = await self.client().chat.completions.create(stream=True, **request)
+        try:
+            async for event in _openai_stream_events(stream):
+                yield event
+        finally:
+            await stream.close()
+
+
+class GroqProvider(OpenAIProvider):
+    name = "groq"
+
+    def __init__(self, **client_kwargs):
+        super().__init__(**client_kwargs)
+        # Groq reports stream usage in the x_groq field of the last chunk
+        self.stream_usage = False
+
+    def _make_client(self):
+        from groq import AsyncGroq
+        return AsyncGroq(http_client=shared_http_client(self.pool_key), **dict(SDK_CLIENT_DEFAULTS, **self.client_kwargs))
+
+
+class OllamaProvider(Provider):
+    name = "ollama"
+
+    def __init__(self, host="http://localhost:11434", **client_kwargs):
+        super().__init__(**client_kwargs)
+        self.host = host
+        # A ModelResidency, when set, chooses keep_alive for each request and is told how long loads took
+        self.residency = None
+
+    @property
+    def endpoint(self):
+        return self.host
+
+    def supports_prefill(self, model):
+        return True
+
+    def _make_client(self):
+        # The Ollama SDK owns its httpx client; give it the same keep-alive limits
+        from ollama import AsyncClient
+        return AsyncClient(host=self.host, limits=_pool_limits(), timeout=_pool_timeout(), **self.client_kwargs)
+
+    async def has_model(self, model):
+        from ollama import ResponseError
+        try:
+            await self.client().show(model)
+        except ResponseError as e:
+            if e.status_code == 404:
+                return False
+            raise
+        return True
+
+    async def pull_model(self, model):
+        await self.client().pull(model)
+
+    async def model_sizes(self):
+        """Size in bytes of every model on the server, by name."""
+        response = await self.client().list()
+        return {entry.get("model") or entry.get("name"): entry.get("size") or 0 for entry in response["models"]}
+
+    async def preload(self, model, keep_alive=None):
+        """Load `model` into memory without generating anything; returns the seconds the load took."""
+        params = {"keep_alive": keep_alive} if keep_alive is not None else {}
+        # Like any call, a load waits for its model's turn in the scheduler. ModelResidency only preloads models it
+        # has shared there with the ones in use, so that turn is now, alongside the generation in progress.
+        async with self._slot(model):
+            response = await self.client().generate(model=model, **params)
+        return (response.get("load_duration") or 0) / 1e9
+
+    def _request(self, model, messages, system, max_tokens, params):
+        if system:
+            messages = [{"role": "system", "content": system}] + list(messages)
+        options = dict(params.pop("options", None) or {})
+        if max_tokens:
+            options.setdefault("num_predict", max_tokens)
+        # Ollama defaults to a 2048-token window; use the size prompts are budgeted against
+        options.setdefault("num_ctx", context_window(model))
+        params["options"] = options
+        if self.residency is not None and "keep_alive" not in params:
+            keep_alive = self.residency.keep_alive(model)
+            if keep_alive is not None:
+                params["keep_alive"] = keep_alive
+        return dict(model=model, messages=_flatten_content(messages), **params)
+
+    async def _create(self, model, messages, system, max_tokens, params):
+        response = await self.client().chat(**self._request(model, messages, system, max_tokens, params))
+        return self._observe(model, self._completion(response, response["message"]["content"]))
+
+    async def _stream(self, model, messages, system, max_tokens, params):
+        parts = await self.client().chat(stream=True, **self._request(model, messages, system, max_tokens, params))
+        final = None
+        async for part in parts:
+            content = part["message"]["content"]
+            if content:
+                yield content
+            if part.get("done"):
+                final = part
+        if final is not None:
+            yield self._observe(model, self._completion(final))
+
+    def _observe(self, model, completion):
+        if self.residency is not None:
+            self.residency.record(model, completion)
+        return completion
+
+    @staticmethod
+    def _completion(response, text=""):
+        done_reason = response.get("done_reason")
+        return Completion(
+            text=text,
+            input_tokens=response.get("prompt_eval_count") or 0,
+            output_tokens=response.get("eval_count") or 0,
+            stop_reason=_normalize_stop_reason(done_reason),
+            raw_stop_reason=done_reason,
+            extra={
+                "load_duration": (response.get("load_duration") or 0) / 1e9,
+                "prompt_eval_duration": (response.get("prompt_eval_duration") or 0) / 1e9,
+                "eval_duration": (response.get("eval_duration") or 0) / 1e9,
+            },
+        )
+
+
+class LiteLLMProvider(Provider):
+    name = "litellm"
+    pool_key = "litellm"
+
+    def __init__(self, api_keys=None, **kwargs):
+        super().__init__(**kwargs)
+        # Keys by litellm provider ("openai", "gemini", ...), used when its <PROVIDER>_API_KEY isn't set
+        self.api_keys = api_keys or {}
+
+    def _api_key(self, model):
+        if "/" in model:
+            provider = model.split("/", 1)[0]
+        else:
+            provider = "anthropic" if model.startswith("claude") else "openai"
+        if os.environ.get(f"{provider.upper()}_API_KEY"):
+            # litellm reads it from the environment itself
+            return None
+        return self.api_keys.get(provider)
+
+    def supports_prefill(self, model):
+        return model.startswith(("anthropic/", "claude"))
+
+    def _make_client(self):
+        import litellm
+        # litellm reuses this session for every provider it routes to
+        litellm.aclient_session = shared_http_client(self.pool_key)
+        return litellm
+
+    def _request(self, model, messages, system, max_tokens, params):
+        if system:
+            messages = [{"role": "system", "content": system}] + list(messages)
+        if max_tokens:
+            params["max_tokens"] = max_tokens
+        api_key = self._api_key(model)
+        if api_key is not None and "api_key" not in params and "api_key" not in self.client_kwargs:
+            params["api_key"] = api_key
+        return dict(model=model, messages=messages, **self.client_kwargs, **params)
+
+    async def _create(self, model, messages, system, max_tokens, params):
+        litellm = self.client()
+        response = await litellm.acompletion(**self._request(model, messages, system, max_tokens, params))
+        choice = response.choices[0]
+        usage = getattr(response, "usage", None)
+        return Completion(
+            text=choice.message.content or "",
+            input_tokens=usage.prompt_tokens if usage else 0,
+            output_tokens=usage.completion_tokens if usage else 0,
+            stop_reason=_normalize_stop_reason(choice.finish_reason),
+            raw_stop_reason=choice.finish_reason,
+        )
+
+    async def _stream(self, model, messages, system, max_tokens, params):
+        litellm = self.client()
+        request = self._request(model, messages, system, max_tokens, params)
+        stream = await litellm.acompletion(stream=True, stream_options={"include_usage": True}, **request)
+        async for event in _openai_stream_events(stream):
+            yield event
+
+
+async def _openai_stream_events(stream):
+    # Shared by every OpenAI-shaped chunk stream (OpenAI, LM Studio, Groq, LiteLLM)
+    finish_reason = None
+    usage = None
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        x_groq = getattr(chunk, "x_groq", None)
+        if x_groq is not None and getattr(x_groq, "usage", None):
+            usage = x_groq.usage
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.delta is not None and choice.delta.content:
+            yield choice.delta.content
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+    yield Completion(
+        text="",
+        input_tokens=usage.prompt_tokens if usage else 0,
+        output_tokens=usage.completion_tokens if usage else 0,
+        stop_reason=_normalize_stop_reason(finish_reason),
+        raw_stop_reason=finish_reason,
+    )
+
+
+PROVIDERS = {
+    "anthropic": AnthropicProvider,
+    "openai": OpenAIProvider,
+    "lmstudio": OpenAIProvider,
+    "groq": GroqProvider,
+    "ollama": OllamaProvider,
+    "litellm": LiteLLMProvider,
+}
+
+
+def get_provider(name, **client_kwargs):
+    try:
+        provider_cls = PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown provider: {name}") from None
+    return provider_cls(**client_kwargs)
+
+
+async def aclose_providers():
+    await aclose_http_clients()
@@ -0,0 +1,186 @@
+import asyncio
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Requests and tokens per minute, by provider name or "provider/model" (the more specific entry wins).
+# These are entry-tier limits; raise them to match your account with set_rate_limit().
+# Providers without an entry (local servers) are not throttled, but still retry transient errors.
+RATE_LIMITS = {
+    "anthropic": {"rpm": 50, "tpm": 40_000},
+    "openai": {"rpm": 500, "tpm": 30_000},
+    "groq": {"rpm": 30, "tpm": 5_000},
+    "litellm": {"rpm": 60, "tpm": 60_000},
+}
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# HTTP statuses worth retrying: rate limits, timeouts, server errors and Anthropic's 529 "overloaded"
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 425, 429, 500, 502, 503, 504, 529})
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Continuously refilling bucket of `per_minute` units.
+
+    `reserve` takes units immediately (the level may go negative) and returns
+    how long the caller has to wait for them and how many units it took, so
+    concurrent callers queue up in arrival order without holding a lock while
+    they sleep. A request larger than the bucket takes the whole bucket. It is thread-safe,
+    so runs on different event loops in one process share the same budget.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill(time.monotonic())
+            taken = min(amount, self.capacity)
+            self.level -= taken
+            return (0.0 if self.level >= 0 else -self.level / self.rate), taken
+
+    def refund(self, amount):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits for one provider and model."""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    async def acquire(self, tokens=0):
+        """Wait for one request and `tokens` tokens; returns the tokens actually taken, the most refund() may return."""
+        waits = [0.0]
+        taken = 0
+        if self.requests is not None:
+            waits.append(self.requests.reserve(1)[0])
+        if self.tokens is not None and tokens:
+            wait, taken = self.tokens.reserve(tokens)
+            waits.append(wait)
+        with self._lock:
+            waits.append(self._paused_until - time.monotonic())
+        wait = max(waits)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return taken
+
+    def refund(self, tokens):
+        """Give back tokens that were reserved but not used (e.g. the unused part of max_tokens)."""
+        if self.tokens is not None and tokens > 0:
+            self.tokens.refund(tokens)
+
+    def pause(self, seconds):
+        """Hold back every caller of this limiter for `seconds` (after the server said to slow down)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def set_rate_limit(provider, model=None, rpm=None, tpm=None):
+    """Set the limits for a provider (or one of its models); None means unlimited."""
+    key = f"{provider}/{model}" if model else provider
+    RATE_LIMITS[key] = {"rpm": rpm, "tpm": tpm}
+    with _limiters_lock:
+        for limiter_key in [k for k in _limiters if k[0] == provider and (model is None or k[1] == model)]:
+            del _limiters[limiter_key]
+
+
+def get_rate_limiter(provider, model):
+    """The process-wide limiter for `provider` and `model`, or None when it has no limits."""
+    with _limiters_lock:
+        key = (provider, model)
+        if key not in _limiters:
+            limits = RATE_LIMITS.get(f"{provider}/{model}") or RATE_LIMITS.get(provider)
+            rpm, tpm = (limits.get("rpm"), limits.get("tpm")) if limits else (None, None)
+            _limiters[key] = RateLimiter(rpm, tpm) if rpm or tpm else None
+        return _limiters[key]
+
+
+def _status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error):
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # SDK connection and timeout errors (APIConnectionError, APITimeoutError, httpx.ConnectError, ...)
+    return any("Connection" in cls.__name__ or "Timeout" in cls.__name__ for cls in type(error).__mro__)
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait, from retry-after-ms / retry-after headers, else None."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # An HTTP date; anything else is ignored rather than hiding the error being retried
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+def backoff_delay(attempt, error=None):
+    """Full-jitter exponential backoff, never shorter than the server's retry-after."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    requested = retry_after(error) if error is not None else None
+    if requested is not None:
+        delay = requested + random.uniform(0, BACKOFF_BASE)
+    return delay
+
+
+async def handle_retryable(error, attempt, limiter=None, max_retries=MAX_RETRIES):
+    """Sleep before the next attempt, or re-raise `error` if it shouldn't be retried."""
+    if attempt >= max_retries or not is_retryable(error):
+        raise error
+    delay = backoff_delay(attempt, error)
+    if limiter is not None and _status_code(error) in (429, 529):
+        # Everyone sharing this limiter backs off, not just the request that got throttled
+        limiter.pause(delay)
+    logger.warning("%s (attempt %d/%d), retrying in %.1fs", error, attempt + 1, max_retries, delay)
+    await asyncio.sleep(delay)
@@ -0,0 +1,118 @@
+import json
+import re
+
+FOLDER_STRUCTURE_OPEN = "<folder_structure>"
+FOLDER_STRUCTURE_CLOSE = "</folder_structure>"
+
+_PROJECT_NAME = re.compile(r'Project Name: (.*)')
+_FILENAME = re.compile(r'Filename: (\S+)')
+_OPENING_FENCE = re.compile(r'\s*```[\w+#.-]*\s*')
+
+
+class RefinedOutputParser:
+    """Incremental parser for the refiner's project output, fed one streamed delta at a time.
+
+    It recognizes the same things as the old regexes over the whole output:
+    the first "Project Name: ..." line, the first <folder_structure> JSON and
+    every "Filename: <name>" followed by a fenced code block. Callbacks fire as
+    soon as each part is complete, so e.g. a code file can be written when its
+    closing fence arrives. Text is handled line by line and never rescanned;
+    only the current partial line and the current code block are buffered.
+    """
+
+    def __init__(self, on_project_name=None, on_folder_structure=None, on_file=None):
+        self.on_project_name = on_project_name
+        self.on_folder_structure = on_folder_structure
+        self.on_file = on_file
+        self.project_name = None
+        self.folder_structure = None
+        # (error, raw JSON) when the folder structure isn't valid JSON
+        self.folder_structure_error = None
+        self.filenames = []
+        self._buffer = ""
+        self._mode = "text"
+        self._lines = []
+        self._filename = None
+        self._folder_seen = False
+
+    def feed(self, text):
+        self._buffer += text
+        if "\n" not in text:
+            return
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._line(line)
+
+    def close(self):
+        """Handle the last line; an unterminated code block is dropped, as the regexes did."""
+        if self._buffer:
+            line, self._buffer = self._buffer, ""
+            self._line(line)
+        self._lines = []
+
+    def _line(self, line):
+        if self._mode == "code":
+            if line.startswith("```"):
+                content = "\n".join(self._lines)
+                self._lines = []
+                self._mode = "text"
+                self.filenames.append(self._filename)
+                if self.on_file is not None:
+                    self.on_file(self._filename, content)
+                self._filename = None
+            else:
+                self._lines.append(line)
+        elif self._mode == "folder":
+            self._folder_line(line)
+        else:
+            self._text_line(line)
+
+    def _folder_line(self, line):
+        end = line.find(FOLDER_STRUCTURE_CLOSE)
+        if end < 0:
+            self._lines.append(line)
+            return
+        self._lines.append(line[:end])
+        json_string = "\n".join(self._lines).strip()
+        self._lines = []
+        self._mode = "text"
+        try:
+            self.folder_structure = json.loads(json_string)
+        except json.JSONDecodeError as e:
+            self.folder_structure_error = (e, json_string)
+        else:
+            if self.on_folder_structure is not None:
+                self.on_folder_structure(self.folder_structure)
+        rest = line[end + len(FOLDER_STRUCTURE_CLOSE):]
+        if rest.strip():
+            self._text_line(rest)
+
+    def _text_line(self, line):
+        if self.project_name is None:
+            match = _PROJECT_NAME.search(line)
+            if match:
+                self.project_name = match.group(1).strip()
+                if self.on_project_name is not None:
+                    self.on_project_name(self.project_name)
+        if not self._folder_seen:
+            start = line.find(FOLDER_STRUCTURE_OPEN)
+            if start >= 0:
+                self._folder_seen = True
+                self._mode = "folder"
+                self._lines = []
+                self._folder_line(line[start + len(FOLDER_STRUCTURE_OPEN):])
+                return
+        match = _FILENAME.search(line)
+        if match:
+            self._filename = match.group(1)
+            # The fence may follow on the same line
+            line = line[match.end():]
+            if not line.strip():
+                return
+        if self._filename is not None:
+            if _OPENING_FENCE.fullmatch(line):
+                self._mode = "code"
+                self._lines = []
+            elif line.strip():
+                # Anything but blank lines between the name and the fence means it wasn't a code file
+                self._filename = None
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+
+# How long Ollama keeps a model loaded after its last request (seconds)
+DEFAULT_KEEP_ALIVE = 30 * 60
+# Memory a loaded model takes beyond its weights (KV cache, buffers), as a fraction of their size
+LOAD_OVERHEAD = 0.2
+# A load_duration under this is Ollama finding the model already in memory
+WARM_LOAD_SECONDS = 0.5
+
+
+@dataclass
+class ModelTimings:
+    calls: int = 0
+    loads: int = 0
+    load_seconds: float = 0.0
+    prompt_seconds: float = 0.0
+    generate_seconds: float = 0.0
+    preloads: int = 0
+    preload_seconds: float = 0.0
+
+
+class ModelResidency:
+    """Keeps the models of a run loaded on a local Ollama server.
+
+    A run alternates between a large orchestrator/refiner model and a small
+    sub-agent model. When both fit in `memory_budget` bytes (or no budget is
+    given), every request asks Ollama to keep its model loaded for
+    `keep_alive` seconds. Otherwise models are left to Ollama's own eviction.
+    Only with a budget that fits both does expect() load the model the run
+    needs next in the background, as a preload on a host that can't hold both
+    would force the swap it is meant to hide. Models that fit are also shared
+    in the provider's model scheduler, so their calls and preloads run side by
+    side instead of one model at a time. Load, prompt and generation times are
+    recorded per model from the durations Ollama reports.
+    """
+
+    def __init__(self, provider, memory_budget=None, keep_alive=DEFAULT_KEEP_ALIVE):
+        self.provider = provider
+        self.memory_budget = memory_budget
+        self.keep_alive_seconds = keep_alive
+        self.timings = {}
+        self._sizes = None
+        self._models = set()
+        self._last_used = {}
+        self._preloading = {}
+        provider.residency = self
+
+    @classmethod
+    def from_env(cls, provider):
+        """Budget from MAESTRO_OLLAMA_MEMORY_GB and keep-alive from MAESTRO_OLLAMA_KEEP_ALIVE (seconds), if set."""
+        memory_gb = os.environ.get("MAESTRO_OLLAMA_MEMORY_GB")
+        keep_alive = os.environ.get("MAESTRO_OLLAMA_KEEP_ALIVE")
+        return cls(
+            provider,
+            int(float(memory_gb) * 1024 ** 3) if memory_gb else None,
+            int(keep_alive) if keep_alive else DEFAULT_KEEP_ALIVE,
+        )
+
+    def _timings(self, model):
+        timings = self.timings.get(model)
+        if timings is None:
+            timings = self.timings[model] = ModelTimings()
+        return timings
+
+    async def prepare(self, models=()):
+        """Register the models a run uses and look up their sizes once, before the first request."""
+        self._models.update(models)
+        if self.memory_budget is None:
+            return
+        if self._sizes is None:
+            try:
+                self._sizes = await self.provider.model_sizes()
+            except Exception:
+                self._sizes = {}
+        scheduler = getattr(self.provider, "scheduler", None)
+        if models and scheduler is not None and self.fits(self._models):
+            # Both stay loaded, so there is no swap for the scheduler to avoid between them
+            scheduler.share(self._models)
+
+    def fits(self, models):
+        """Whether `models` can all stay loaded at once within the memory budget."""
+        if self.memory_budget is None:
+            return True
+        if self._sizes is None:
+            return False
+        needed = sum(self._sizes.get(model, 0) for model in set(models)) * (1 + LOAD_OVERHEAD)
+        return needed <= self.memory_budget
+
+    def keep_alive(self, model):
+        """keep_alive for a request to `model`, or None to leave it to the server."""
+        return self.keep_alive_seconds if self.fits(self._models | {model}) else None
+
+    def record(self, model, completion):
+        self._models.add(model)
+        self._last_used[model] = time.monotonic()
+        timings = self._timings(model)
+        timings.calls += 1
+        load = completion.extra.get("load_duration", 0.0)
+        if load >= WARM_LOAD_SECONDS:
+            timings.loads += 1
+        timings.load_seconds += load
+        timings.prompt_seconds += completion.extra.get("prompt_eval_duration", 0.0)
+        timings.generate_seconds += completion.extra.get("eval_duration", 0.0)
+
+    def _warm(self, model):
+        last_used = self._last_used.get(model)
+        return last_used is not None and time.monotonic() - last_used < self.keep_alive_seconds
+
+    def expect(self, model):
+        """Start loading `model` in the background, as the next call of the run will use it."""
+        if self.memory_budget is None or model in self._preloading or self._warm(model):
+            return
+        task = asyncio.ensure_future(self._preload(model))
+        self._preloading[model] = task
+        task.add_done_callback(lambda _: self._preloading.pop(model, None))
+
+    async def _preload(self, model):
+        await self.prepare()
+        if not self.fits(self._models | {model}):
+            return
+        try:
+            load = await self.provider.preload(model, self.keep_alive_seconds)
+        except Exception:
+            # Only an optimization: the real call loads the model if this didn't
+            return
+        self._models.add(model)
+        self._last_used[model] = time.monotonic()
+        timings = self._timings(model)
+        timings.preloads += 1
+        timings.preload_seconds += load
+
+    async def aclose(self):
+        """Cancel preloads still running, e.g. when the run has ended."""
+        tasks = list(self._preloading.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def report(self):
+        lines = ["Model timings (load / prompt / generation):"]
+        for model, timings in self.timings.items():
+            line = (
+                f"  {model}: {timings.calls} calls, {timings.loads} loads {timings.load_seconds:.1f}s"
+                f" / {timings.prompt_seconds:.1f}s / {timings.generate_seconds:.1f}s"
+            )
+            if timings.preloads:
+                line += f", {timings.preloads} preloads {timings.preload_seconds:.1f}s in the background"
+            lines.append(line)
+        return "\n".join(lines)
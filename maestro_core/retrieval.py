@@ -0,0 +1,198 @@
+import heapq
+import math
+import mmap
+import os
+from array import array
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+
+from .budget import count_tokens
+from .ingest import render_files, split_files
+from .large_input import BYTES_PER_TOKEN, chunk_lines
+from .search import text_terms
+
+# Size of the passages a document is split into for retrieval
+PASSAGE_TOKENS = 200
+DEFAULT_TOP_K = 8
+# Tokens of file content each sub-agent prompt gets, and the orchestrator's first prompt
+DEFAULT_CONTEXT_TOKENS = 2000
+ORCHESTRATOR_CONTEXT_TOKENS = 4000
+# Standard BM25 parameters: term frequency saturation and length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+@dataclass
+class Passage:
+    source: str
+    start_line: int
+    end_line: int
+    # None for passages of a mapped file, which are read back from `offset` and `length` when returned
+    text: str
+    tokens: int
+    offset: int = 0
+    length: int = 0
+
+
+class BM25Index:
+    """In-memory BM25 index over the passages of one or more attached documents.
+
+    Documents are split at line boundaries into passages of about
+    PASSAGE_TOKENS. A query costs one posting-list walk per distinct query term,
+    so each sub-task can cheaply get the few passages that matter to it instead
+    of the whole document. Files added with add_file() stay memory-mapped: only
+    each passage's byte range and term counts are kept.
+    """
+
+    def __init__(self, passage_tokens=PASSAGE_TOKENS, k1=BM25_K1, b=BM25_B, count_tokens=count_tokens):
+        self.passage_tokens = passage_tokens
+        self.k1 = k1
+        self.b = b
+        self.count_tokens = count_tokens
+        self.passages = []
+        # Per term, the passage indexes and term frequencies interleaved in one compact array
+        self._postings = defaultdict(lambda: array("I"))
+        self._lengths = []
+        self._total_length = 0
+        self._maps = {}
+        self.total_tokens = 0
+
+    def __len__(self):
+        return len(self.passages)
+
+    def add_text(self, text, source=None):
+        for chunk in chunk_lines(text.splitlines(keepends=True), self.passage_tokens, 0, self.count_tokens):
+            self._add(Passage(source, chunk.start_line, chunk.end_line, chunk.text, self.count_tokens(chunk.text)), chunk.text)
+
+    def add_file(self, path, source=None):
+        """Index a file through a read-only memory map, one passage at a time.
+
+        Passages are cut at line boundaries by size on disk rather than by
+        tokenizing the file, and their text is read back from the map only
+        when they are returned, so memory use doesn't grow with the file.
+        """
+        source = source or path
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as f:
+            mapped = self._maps[source] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(mapped)
+        target = self.passage_tokens * BYTES_PER_TOKEN
+        start = 0
+        line = 1
+        while start < size:
+            end = min(size, start + target)
+            if end < size:
+                newline = mapped.rfind(b"\n", start, end)
+                if newline >= 0:
+                    end = newline + 1
+                else:
+                    # A line longer than a passage is cut, but not inside a UTF-8 character
+                    while end > start + 1 and mapped[end] & 0xC0 == 0x80:
+                        end -= 1
+            data = mapped[start:end]
+            newlines = data.count(b"\n")
+            end_line = line + newlines - (1 if data.endswith(b"\n") else 0)
+            text = data.decode("utf-8", errors="replace")
+            self._add(Passage(source, line, end_line, None, max(1, len(data) // BYTES_PER_TOKEN), start, end - start), text)
+            line += newlines
+            start = end
+
+    def _add(self, passage, text):
+        terms = Counter(text_terms(text))
+        index = len(self.passages)
+        self.passages.append(passage)
+        self.total_tokens += passage.tokens
+        for term, frequency in terms.items():
+            self._postings[term].extend((index, frequency))
+        length = sum(terms.values())
+        self._lengths.append(length)
+        self._total_length += length
+
+    def text(self, passage):
+        if passage.text is not None:
+            return passage.text
+        mapped = self._maps[passage.source]
+        return mapped[passage.offset:passage.offset + passage.length].decode("utf-8", errors="replace")
+
+    def search(self, query, k=DEFAULT_TOP_K):
+        """The `k` best (score, passage index) pairs for `query`, best first; passages sharing no term are left out."""
+        if not self.passages:
+            return []
+        average_length = self._total_length / len(self.passages) or 1
+        scores = defaultdict(float)
+        for term in set(text_terms(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            matching = len(postings) // 2
+            idf = math.log(1 + (len(self.passages) - matching + 0.5) / (matching + 0.5))
+            for index, frequency in zip(postings[::2], postings[1::2]):
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[index] / average_length)
+                scores[index] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return heapq.nlargest(k, ((score, index) for index, score in scores.items()))
+
+    def context(self, query, max_tokens=DEFAULT_CONTEXT_TOKENS, k=DEFAULT_TOP_K):
+        """The passages most relevant to `query` that fit in `max_tokens`, in document order.
+
+        Documents that fit in the budget as a whole are returned whole. When no
+        passage matches the query, the start of the documents is used instead.
+        """
+        if not self.passages:
+            return ""
+        if self.total_tokens <= max_tokens:
+            selected = range(len(self.passages))
+        else:
+            ranked = [index for _, index in self.search(query, k)] or range(len(self.passages))
+            selected = []
+            used = 0
+            for index in ranked:
+                cost = self.passages[index].tokens
+                if used + cost > max_tokens:
+                    continue
+                used += cost
+                selected.append(index)
+                if len(selected) >= k:
+                    break
+            selected.sort()
+        return self._render(selected)
+
+    def _render(self, selected):
+        if len(selected) == len(self.passages):
+            # Documents that fit are passed through as they are
+            documents = {}
+            for passage in self.passages:
+                documents[passage.source] = documents.get(passage.source, "") + self.text(passage)
+            if len(documents) == 1:
+                return next(iter(documents.values())).rstrip()
+            return render_files(documents.items())
+        parts = []
+        for index in selected:
+            passage = self.passages[index]
+            where = f"lines {passage.start_line}-{passage.end_line}"
+            if passage.source:
+                where = f"{passage.source}, {where}"
+            parts.append(f"[{where}]\n{self.text(passage).rstrip()}")
+        return "\n\n".join(parts)
+
+
+def index_attachment(file_content=None, input_file=None):
+    """Index the attached file, from its path if it was too large to read, else from its content."""
+    if input_file is None and not file_content:
+        return None
+    index = BM25Index()
+    if input_file is not None:
+        index.add_file(input_file)
+    else:
+        # Several attached files are indexed one by one, so passages keep their file name and lines
+        for path, text in split_files(file_content):
+            index.add_text(text, path)
+    return index
+
+
+def with_file_context(prompt, index, max_tokens=DEFAULT_CONTEXT_TOKENS):
+    """`prompt` followed by the attached file passages most relevant to it, if a file was attached."""
+    if index is None:
+        return prompt
+    context = index.context(prompt, max_tokens)
+    return f"{prompt}\n\nFile content:\n{context}" if context else prompt
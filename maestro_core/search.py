@@ -0,0 +1,275 @@
+import asyncio
+import functools
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+
+from .budget import count_tokens
+
+DEFAULT_SEARCH_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "maestro", "search.json")
+DEFAULT_SEARCH_TTL = 24 * 60 * 60
+# Queries whose normalized terms overlap at least this much (Jaccard) share one lookup
+DEFAULT_SIMILARITY = 0.8
+# Queries the orchestrator may ask for per sub-task, and the tokens their merged answers may take
+MAX_SEARCH_QUERIES = 3
+DEFAULT_SEARCH_CONTEXT_TOKENS = 1500
+
+SEARCH_QUERIES_INSTRUCTIONS = (
+    f"Please also generate a JSON object containing a 'search_queries' key with a list of 1 to {MAX_SEARCH_QUERIES} "
+    "questions which, when asked online, would yield important information for solving the subtask. Each question "
+    "should be specific and targeted at a different aspect of the subtask to elicit the most relevant and helpful "
+    "resources. Format your JSON like this, with no additional text before or after:\n"
+    "{\"search_queries\": [\"<question>\", \"<question>\"]}\n"
+)
+
+_STOPWORDS = frozenset(
+    "a an and are as at be best by can do does for from how i in is it me my of on or "
+    "please should the to use using what when where which why with you your".split()
+)
+
+
+def text_terms(text):
+    """Lowercased content words of `text` in order, with stopwords dropped and trivial plurals folded."""
+    terms = []
+    for word in re.findall(r"[a-z0-9][a-z0-9+#]*", text.lower()):
+        if word in _STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+def query_terms(query):
+    """Lowercased content words of `query` with trivial plurals folded, as a frozenset."""
+    return frozenset(text_terms(query))
+
+
+def normalize_query(query):
+    terms = query_terms(query)
+    return " ".join(sorted(terms)) if terms else " ".join(query.lower().split())
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def parse_search_queries(data):
+    """Queries from the orchestrator's JSON ('search_queries' list or legacy 'search_query'), de-duplicated.
+
+    Raises TypeError when `data` isn't a JSON object.
+    """
+    if not isinstance(data, dict):
+        raise TypeError(f"expected a JSON object with search queries, got {type(data).__name__}")
+    queries = data.get("search_queries") or data.get("search_query") or []
+    if isinstance(queries, str):
+        queries = [queries]
+    elif not isinstance(queries, list):
+        queries = []
+    unique = {}
+    for query in queries:
+        if isinstance(query, str) and query.strip():
+            unique.setdefault(normalize_query(query), query.strip())
+    return list(unique.values())[:MAX_SEARCH_QUERIES]
+
+
+def _passages(text):
+    # Paragraphs, with long ones split into sentences so ranking can trim inside them
+    for paragraph in re.split(r"\n\s*\n|\n(?=[-*\d])", text):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        if len(paragraph) <= 400:
+            yield paragraph
+        else:
+            yield from (sentence for sentence in re.split(r"(?<=[.!?])\s+", paragraph) if sentence)
+
+
+def merge_search_results(results, prompt, max_tokens=DEFAULT_SEARCH_CONTEXT_TOKENS, count_tokens=count_tokens):
+    """Merge (query, answer) pairs into one block of search results that fits `max_tokens`.
+
+    Answers are split into passages, near-duplicate passages are dropped, and the
+    passages sharing the most terms with the sub-task prompt and their query are
+    kept first. Kept passages are listed under their query in the original order.
+    """
+    prompt_terms = query_terms(prompt)
+    candidates = []
+    seen = []
+    for query_index, (query, answer) in enumerate(results):
+        if not answer:
+            continue
+        terms_of_query = query_terms(query)
+        for position, passage in enumerate(_passages(str(answer))):
+            terms = query_terms(passage)
+            if any(_similarity(terms, other) >= DEFAULT_SIMILARITY for other in seen):
+                continue
+            seen.append(terms)
+            overlap = len(terms & prompt_terms) + 2 * len(terms & terms_of_query)
+            # Favour dense passages and each answer's opening lines
+            score = overlap / math.sqrt(len(terms) + 1) + 1.0 / (position + 1)
+            candidates.append((score, query_index, position, passage, overlap))
+
+    # Passages that share nothing with the prompt or their query only fill space
+    if any(candidate[4] for candidate in candidates):
+        candidates = [candidate for candidate in candidates if candidate[4]]
+
+    kept = []
+    used = 0
+    for candidate in sorted(candidates, key=lambda candidate: -candidate[0]):
+        cost = count_tokens(candidate[3])
+        if used + cost > max_tokens:
+            continue
+        used += cost
+        kept.append(candidate)
+
+    sections = []
+    for query_index, (query, _) in enumerate(results):
+        passages = [passage for _, index, _, passage, _ in sorted(kept, key=lambda c: (c[1], c[2])) if index == query_index]
+        if passages:
+            sections.append(f"Q: {query}\n" + "\n".join(passages))
+    return "\n\n".join(sections)
+
+
+@functools.lru_cache(maxsize=None)
+def tavily_client(api_key):
+    """One TavilyClient per API key for the whole process."""
+    from tavily import TavilyClient
+    return TavilyClient(api_key=api_key)
+
+
+class SearchCache:
+    """Persistent cache of search answers keyed by normalized query, with a TTL.
+
+    Entries live in a single JSON file that is rewritten atomically on every
+    update; expired entries are dropped when the file is loaded or written.
+    """
+
+    def __init__(self, path=DEFAULT_SEARCH_CACHE_PATH, ttl=DEFAULT_SEARCH_TTL, similarity=DEFAULT_SIMILARITY):
+        self.path = path
+        self.ttl = ttl
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+            self._entries = {key: entry for key, entry in entries.items() if not self._expired(entry)}
+        return self._entries
+
+    def _expired(self, entry):
+        return time.time() - entry.get("time", 0) > self.ttl
+
+    def get(self, query):
+        """Return the cached answer for `query` or a near-duplicate of it, else None."""
+        key = normalize_query(query)
+        terms = query_terms(query)
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry is None and self.similarity < 1.0:
+                best = max(
+                    entries.values(),
+                    key=lambda candidate: _similarity(terms, frozenset(candidate["terms"])),
+                    default=None,
+                )
+                if best is not None and _similarity(terms, frozenset(best["terms"])) >= self.similarity:
+                    entry = best
+            if entry is None or self._expired(entry):
+                return None
+            return entry["result"]
+
+    def put(self, query, result):
+        with self._lock:
+            entries = self._load()
+            entries[normalize_query(query)] = {
+                "query": query,
+                "terms": sorted(query_terms(query)),
+                "result": result,
+                "time": time.time(),
+            }
+            for key in [key for key, entry in entries.items() if self._expired(entry)]:
+                del entries[key]
+            self._write(entries)
+
+    def _write(self, entries):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class TavilySearch:
+    """Tavily QnA search through one shared client, with caching and query de-duplication.
+
+    Identical or near-duplicate queries (same normalized terms, or overlapping
+    above the cache's similarity threshold) are answered from the cache, and
+    concurrent duplicates wait for the lookup already in flight.
+    """
+
+    def __init__(self, api_key, cache=None):
+        self.api_key = api_key
+        self.cache = cache
+        self.lookups = 0
+        self.hits = 0
+        self._in_flight = {}
+
+    async def qna(self, query):
+        key = normalize_query(query)
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, query)
+            if cached is not None:
+                self.hits += 1
+                return cached
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(query))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.hits += 1
+        return await asyncio.shield(future)
+
+    async def _lookup(self, query):
+        self.lookups += 1
+        client = tavily_client(self.api_key)
+        result = await asyncio.to_thread(client.qna_search, query=query)
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, query, result)
+        return result
+
+    async def qna_many(self, queries):
+        """Run `queries` concurrently; returns (query, answer) pairs for the lookups that succeeded."""
+        if isinstance(queries, str):
+            queries = [queries]
+        answers = await asyncio.gather(*(self.qna(query) for query in queries), return_exceptions=True)
+        return [(query, answer) for query, answer in zip(queries, answers) if not isinstance(answer, Exception)]
+
+    async def search_context(self, queries, prompt, max_tokens=DEFAULT_SEARCH_CONTEXT_TOKENS, count_tokens=count_tokens):
+        """Answers to all `queries`, de-duplicated, ranked against `prompt` and trimmed to `max_tokens`."""
+        results = await self.qna_many(queries)
+        return merge_search_results(results, prompt, max_tokens, count_tokens)
+
+    def report(self):
+        return f"Search: {self.lookups} lookups, {self.hits} answered from cache or de-duplicated"
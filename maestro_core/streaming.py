@@ -0,0 +1,69 @@
+from .events import emit
+
+# The orchestrators announce the end of the run with this phrase
+COMPLETION_MARKER = "The task is complete:"
+# Only the beginning of a response can announce completion
+MARKER_SEARCH_CHARS = 200
+# Lines of the response shown in the live preview
+PREVIEW_LINES = 20
+
+# Only one live display can be active per console; concurrent streams render without one
+_live_active = False
+
+
+def task_complete_detector(marker=COMPLETION_MARKER):
+    """Return a stop_when(text) callback that fires once `text` starts with `marker`."""
+    def stop_when(text):
+        head = text[:MARKER_SEARCH_CHARS].lstrip(" \t\r\n*#>_`")
+        return head.startswith(marker)
+    return stop_when
+
+
+class _Preview:
+    def __init__(self, title, border_style):
+        self.title = title
+        self.border_style = border_style
+        self.text = ""
+
+    def __rich__(self):
+        from rich.panel import Panel
+        from rich.text import Text
+        tail = "\n".join(self.text.splitlines()[-PREVIEW_LINES:])
+        return Panel(Text(tail), title=f"[bold]{self.title} (streaming)[/bold]", border_style=self.border_style)
+
+
+async def stream_to_console(stream, console, title, border_style="blue", stop_when=None, on_delta=None):
+    """Consume a CompletionStream, showing its tail in a transient live panel.
+
+    If `stop_when(text)` returns True the stream is closed right away, so the
+    caller can act on the partial text without waiting for the rest.
+    `on_delta(text)` is called with each piece of text as it arrives, and
+    each piece is also emitted as a "token" event of the current run.
+    Returns the assembled Completion.
+    """
+    global _live_active
+    preview = _Preview(title, border_style)
+    live = None
+    if not _live_active and console.is_terminal:
+        # Only imported for a terminal; runs from cron or a web worker never pay for it
+        from rich.live import Live
+        live = Live(preview, console=console, transient=True, refresh_per_second=8)
+        live.start()
+        _live_active = True
+    stopped_early = False
+    try:
+        async for delta in stream:
+            preview.text += delta
+            emit("token", source=title, text=delta)
+            if on_delta is not None:
+                on_delta(delta)
+            if stop_when is not None and stop_when(stream.text):
+                stopped_early = True
+                break
+    finally:
+        if live is not None:
+            live.stop()
+            _live_active = False
+        if stream.completion is None:
+            await stream.aclose("early_stop" if stopped_early else "cancelled")
+    return stream.completion